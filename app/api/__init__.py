@@ -3,3 +3,5 @@ from app.api.cashback import *
 from app.api.mvno import *
 from app.api.courier_api import *
 from app.api.app_server_api import *
+from app.api.fcm_dispatcher import *
+from app.api.http_transport import *
@@ -1,9 +1,12 @@
 # -*- encoding: utf-8 -*-
-import traceback
+import threading
 
 import sys
 from functools import wraps
 
+import lazy_object_proxy
+
+from app.api.msisdn_pool_pager import MsisdnPoolPager
 from app.exceptions import ApiDataError, ServerError, ServerDataError
 from app_regions.data import SPB_REG_DT_ID
 from app_regions.services import get_bercut_branch_id_by_dt_reg_id
@@ -13,10 +16,18 @@ from app_bercut.exceptions import (
     BercutApiError, BercutApiValueError
 )
 from app_sbtelecom.api import SbtBercutBillingApi
+from app_utils.logger_utils import get_logger
 
 __all__ = ('MVNOApi', )
 
 
+logger = lazy_object_proxy.Proxy(lambda: get_logger('MVNOApi'))
+
+# последняя записанная в лог ошибка потока: вложенные вызовы
+# с error_wrapper пишут одну и ту же ошибку один раз
+_logged = threading.local()
+
+
 def raise_api_error(**params):
     raise BercutApiError(**params)
 
@@ -47,15 +58,10 @@ def error_wrapper():
                         error_reason=getattr(err, 'error_reason', None),
                     )
             except Exception as err:
-                try:
-                    print(err)
-                except:
-                    pass
-                try:
-                    print(traceback.format_exc())
-                except:
-                    pass
-                raise err
+                if getattr(_logged, 'error', None) is not err:
+                    logger.exception(u'MVNOApi.{}: {!r}'.format(func.__name__, err))
+                    _logged.error = err
+                raise
 
         return wrapper
     return decorator
@@ -85,22 +91,57 @@ class MVNOApi:
         except Exception as e:
             pass
 
+    # (msisdn_type, СПб?) -> msisdnTypeId, собирается один раз из MSISDN_TYPES
+    MSISDN_TYPE_IDS = {}
+    SPB_MSISDN_TYPE_SUFFIX = u' СПб'
+
+    # dt region id -> branch_id; словарь не меняется, а подменяется новым
+    BRANCH_IDS = {}
+    _branch_ids_lock = threading.Lock()
+
+    @classmethod
+    def build_msisdn_type_ids(cls):
+        msisdn_type_ids = {}
+        for name, msisdn_type_id in cls.api.MSISDN_TYPES.items():
+            if name.endswith(cls.SPB_MSISDN_TYPE_SUFFIX):
+                msisdn_type_ids[(name[:-len(cls.SPB_MSISDN_TYPE_SUFFIX)], True)] = msisdn_type_id
+            else:
+                msisdn_type_ids[(name, False)] = msisdn_type_id
+        cls.MSISDN_TYPE_IDS = msisdn_type_ids
+        return msisdn_type_ids
+
+    @classmethod
+    def warmup(cls, regions=()):
+        u"""Заполнить справочники при старте, чтобы запросы их не строили"""
+        cls.build_msisdn_type_ids()
+        for region in regions:
+            try:
+                cls.get_branch_id(region)
+            except Exception:
+                pass
+
     @classmethod
-    @error_wrapper()
     def get_branch_id(cls, dt_region_id):
+        branch_id = cls.BRANCH_IDS.get(dt_region_id)
+        if branch_id is not None:
+            return branch_id
+
         branch_id = get_bercut_branch_id_by_dt_reg_id(dt_region_id)
         if branch_id is None:
             raise ServerDataError(u'Not found branch_id for dt region: {}'.format(dt_region_id))
+
+        with cls._branch_ids_lock:
+            branch_ids = dict(cls.BRANCH_IDS)
+            branch_ids[dt_region_id] = branch_id
+            cls.BRANCH_IDS = branch_ids
         return branch_id
 
     @classmethod
-    @error_wrapper()
     def get_msisdn_type_id(cls, msisdn_type, region):
-        if region == SPB_REG_DT_ID:
-            _msisdn_type = u'{} СПб'.format(msisdn_type)
-            if _msisdn_type in cls.api.MSISDN_TYPES:
-                return cls.api.MSISDN_TYPES[_msisdn_type]
-        return cls.api.MSISDN_TYPES[msisdn_type]
+        msisdn_type_ids = cls.MSISDN_TYPE_IDS or cls.build_msisdn_type_ids()
+        if region == SPB_REG_DT_ID and (msisdn_type, True) in msisdn_type_ids:
+            return msisdn_type_ids[(msisdn_type, True)]
+        return msisdn_type_ids[(msisdn_type, False)]
 
     @classmethod
     @error_wrapper()
@@ -110,29 +151,41 @@ class MVNOApi:
             need_msisdn_format=True,
             **kwargs
     ):
-        branch_id = cls.get_branch_id(region)
-        msisdn_type_id = msisdn_type and cls.get_msisdn_type_id(msisdn_type, region)
+        # неизвестный регион или тип номера - ошибка, а не пустой пул:
+        # внутри загрузчика pager её не отличить от ошибки Bercut
+        cls.get_branch_id(region)
+        msisdn_type and cls.get_msisdn_type_id(msisdn_type, region)
 
         try:
-            data_list = cls.api.getMsisdnListPool(
-                msisdnMask=msisdn_search,
-                countRecord=offset * count + count,
-                msisdnTypeId=msisdn_type_id,
-                branchId=branch_id,
-            ).json['getMsisdnListPoolResponse'].get(
-                'MsisdnPoolList', []
+            msisdns = cls.pager.get_page(
+                region, msisdn_type, msisdn_search,
+                offset=offset, count=count,
             )
+        except (ServerError, ServerDataError):
+            raise
         except:
-            data_list = []
+            msisdns = []
 
-        msisdns = [
-            data['msisdn']
-            for data in data_list if data['msisdn']
-        ][offset * count:]
         if need_msisdn_format:
             msisdns = [cls.api.get_msisdn(msisdn) for msisdn in msisdns]
         return msisdns
 
+    @classmethod
+    def _getMsisdnListPool(cls, region, msisdn_type, msisdn_search, count):
+        u"""Первые count номеров пула -> [msisdn, ...], загрузчик для pager"""
+        branch_id = cls.get_branch_id(region)
+        msisdn_type_id = msisdn_type and cls.get_msisdn_type_id(msisdn_type, region)
+
+        data_list = cls.api.getMsisdnListPool(
+            msisdnMask=msisdn_search,
+            countRecord=count,
+            msisdnTypeId=msisdn_type_id,
+            branchId=branch_id,
+        ).json['getMsisdnListPoolResponse'].get(
+            'MsisdnPoolList', []
+        )
+        return [data['msisdn'] for data in data_list if data['msisdn']]
+
     @classmethod
     @error_wrapper()
     def getMsisdn(
@@ -203,3 +256,7 @@ class MVNOApi:
         except:
             pass
         return True
+
+
+MVNOApi.pager = MsisdnPoolPager(MVNOApi._getMsisdnListPool)
+MVNOApi.build_msisdn_type_ids()
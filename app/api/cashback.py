@@ -1,16 +1,24 @@
 # -*- encoding: utf-8 -*-
 
 import hashlib
-import requests
 import datetime
 import settings
 import json
 import hashlib
+import threading
+import time
+
+import lazy_object_proxy
+from concurrent.futures import ThreadPoolExecutor
+
+from app.api.http_transport import HttpTransport
+from app_utils.redis_utils import get_current_redis
 
 
 __all__ = (
     'SbtCashbackApi',
-    'CashbackApi'
+    'CashbackApi',
+    'CashbackCatalogCache',
 )
 
 
@@ -21,6 +29,105 @@ def utc_datetime_to_timestamp(utc_dt):
     return int((utc_dt - MIN_UNIX_DT).total_seconds())
 
 
+class CashbackCatalogCache(object):
+    u"""
+    Каталог офферов одинаков для всех абонентов, поэтому кэшируется
+    в памяти процесса и в Redis под общим ключом. Запрос к партнёру
+    по-прежнему идёт с hash абонента, который его вызвал; ключ hash
+    не содержит, в кэш попадает только каталог, без данных абонента:
+
+        cache:cashback:available_offers      -> список офферов
+        cache:cashback:offer_details:{id}    -> детали оффера
+
+    Запись свежая TIMEOUT секунд; устаревшая (до STALE_TIMEOUT) отдаётся
+    сразу, а обновляется в фоне одним запросом на процесс. Старше
+    STALE_TIMEOUT запись не отдаётся и из памяти процесса. Кэшируются
+    только удачные ответы: ошибка loader не сохраняется, None тоже.
+    """
+
+    redis_session = lazy_object_proxy.Proxy(get_current_redis)
+
+    KEY_TEMPLATE = 'cache:cashback:{name}'
+    TIMEOUT = 10 * 60  # sec
+    STALE_TIMEOUT = 24 * 60 * 60  # sec
+
+    _local = {}
+    _refreshing = set()
+    _lock = threading.Lock()
+    executor = ThreadPoolExecutor(max_workers=2)
+
+    @classmethod
+    def get_key(cls, name):
+        return cls.KEY_TEMPLATE.format(name=name)
+
+    @classmethod
+    def get(cls, name, loader):
+        entry = cls._local.get(name) or cls._get_redis(name)
+        if entry is None:
+            return cls._load(name, loader)
+
+        (fresh_until, value) = entry
+        utcnow = time.time()
+        if fresh_until - cls.TIMEOUT + cls.STALE_TIMEOUT < utcnow:
+            cls._local.pop(name, None)
+            return cls._load(name, loader)
+
+        cls._local[name] = entry
+        if fresh_until < utcnow:
+            cls._refresh(name, loader)
+        return value
+
+    @classmethod
+    def _load(cls, name, loader):
+        value = loader()
+        if value is None:
+            return value
+        entry = (time.time() + cls.TIMEOUT, value)
+        cls._local[name] = entry
+        try:
+            cls.redis_session.setex(
+                cls.get_key(name), cls.STALE_TIMEOUT, json.dumps(entry),
+            )
+        except Exception as err:
+            print('CashbackCatalogCache.set({}): {}'.format(name, err))
+        return value
+
+    @classmethod
+    def _get_redis(cls, name):
+        try:
+            entry = cls.redis_session.get(cls.get_key(name))
+        except Exception as err:
+            print('CashbackCatalogCache.get({}): {}'.format(name, err))
+            return None
+        return entry and tuple(json.loads(entry)) or None
+
+    @classmethod
+    def _refresh(cls, name, loader):
+        with cls._lock:
+            if name in cls._refreshing:
+                return
+            cls._refreshing.add(name)
+
+        def refresh():
+            try:
+                cls._load(name, loader)
+            except Exception as err:
+                print('CashbackCatalogCache.refresh({}): {}'.format(name, err))
+            finally:
+                with cls._lock:
+                    cls._refreshing.discard(name)
+
+        cls.executor.submit(refresh)
+
+    @classmethod
+    def invalidate(cls, name):
+        cls._local.pop(name, None)
+        try:
+            cls.redis_session.delete(cls.get_key(name))
+        except Exception as err:
+            print('CashbackCatalogCache.invalidate({}): {}'.format(name, err))
+
+
 class SbtCashbackApi(object):
 
     def __init__(self, device_uid, msisdn, hash=None):
@@ -46,7 +153,18 @@ class CashbackApi(object):
     except:
         API_KEY = 'TEST_API_KEY'
 
-    session = requests.Session()
+    # {connect_timeout, read_timeout, pool_maxsize, max_retries}
+    try:
+        HTTP_SETTINGS = settings.CASHBACK_HTTP_SETTINGS
+    except:
+        HTTP_SETTINGS = {}
+
+    transport = HttpTransport('cashback', **HTTP_SETTINGS)
+    session = transport.session
+    # соединений на хост: хватает и на handlers, и на SyncCashbackOffers
+    POOL_MAXSIZE = transport.pool_maxsize
+
+    catalog_cache = CashbackCatalogCache
 
     def __init__(
             self, uid, msisdn, hash=None,
@@ -78,6 +196,7 @@ class CashbackApi(object):
             '/success_user_offers/%s' % self.msisdn,
             headers=headers, need_hash=False,
             params=params or None,
+            endpoint='/success_user_offers/',
         )
         try:
             return r.json()
@@ -94,10 +213,21 @@ class CashbackApi(object):
         return r.json()
 
     def available_offers(self):
+        return self.catalog_cache.get('available_offers', self._available_offers)
+
+    def _available_offers(self):
         r = self._get('/available_offers/')
-        return r.json()
+        if r.status_code == 200:
+            return r.json()
+        raise ValueError('available_offers: {} {}'.format(r.status_code, r.text))
 
     def offer_details(self, offer_id):
+        return self.catalog_cache.get(
+            'offer_details:{}'.format(offer_id),
+            lambda: self._offer_details(offer_id),
+        )
+
+    def _offer_details(self, offer_id):
         r = self._get('/offer_details/', {"id": offer_id})
         if r.status_code == 200:
             return r.json()
@@ -116,7 +246,8 @@ class CashbackApi(object):
         r = self._put(
             '/token/{}'.format(device_id),
             data=json.dumps({'token': token}),
-            headers=headers
+            headers=headers,
+            endpoint='/token/',
         )
         return r
 
@@ -130,23 +261,32 @@ class CashbackApi(object):
             '/msisdn/{}'.format(device_id),
             data=json.dumps({'msisdn': msisdn}),
             headers=headers,
+            endpoint='/msisdn/',
         )
         return r
 
-    def _put(self, path, data, headers=None):
+    def _put(self, path, data, headers=None, endpoint=None):
         HEADERS = {
             'Accept': 'application/json',
             'Content-Type': 'application/json',
         }
         if headers:
             HEADERS.update(headers)
-        return self.session.put(self._url(path, need_hash=False), data=data, headers=HEADERS)
+        return self.transport.put(
+            self._url(path, need_hash=False), data=data, headers=HEADERS,
+            endpoint=endpoint or path,
+        )
 
-    def _get(self, path, params=None, headers=None, need_hash=True):
-        return self.session.get(self._url(path, need_hash=need_hash), params=params, headers=headers)
+    def _get(self, path, params=None, headers=None, need_hash=True, endpoint=None):
+        return self.transport.get(
+            self._url(path, need_hash=need_hash), params=params, headers=headers,
+            endpoint=endpoint or path,
+        )
 
-    def _post(self, path, data=None):
-        return self.session.post(self._url(path), data=data)
+    def _post(self, path, data=None, endpoint=None):
+        return self.transport.post(
+            self._url(path), data=data, endpoint=endpoint or path,
+        )
 
 
 if __name__ == '__main__':
@@ -0,0 +1,162 @@
+# -*- encoding: utf-8 -*-
+
+import random
+import threading
+import time
+import traceback
+from itertools import izip
+
+import requests
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from app_utils.fcm_utils import send_pushs
+
+
+__all__ = ('FcmDispatcher', 'TokenBucket')
+
+
+class TokenBucket(object):
+    u"""
+    Ограничение скорости: не больше rate единиц в секунду,
+    с накоплением до capacity. acquire() списывает единицы сразу,
+    а при нехватке баланс уходит в минус и вызывающий ждёт, пока
+    долг не погасится, поэтому запрос больше capacity тоже
+    списывается целиком.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self.tokens = self.capacity
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        with self.lock:
+            utcnow = time.time()
+            self.tokens = min(
+                self.capacity,
+                self.tokens + (utcnow - self.updated) * self.rate
+            )
+            self.updated = utcnow
+            self.tokens -= float(tokens)
+            wait_time = -self.tokens / self.rate
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+
+class FcmDispatcher(object):
+    u"""
+    Отправляет пачки fcm-токенов параллельно, держа в работе
+    не больше max_in_flight запросов:
+
+        dispatcher = FcmDispatcher(max_in_flight=8, max_sends_per_sec=1000)
+        for key, response, error in dispatcher.dispatch(
+                batches,  # iterable из (key, [fcm_token, ...])
+                title, message, data=push_data,
+        ):
+            ...
+
+    Результаты отдаются в порядке завершения. Упавший запрос и токены
+    с временной ошибкой FCM повторяются с экспоненциальной задержкой.
+    """
+
+    MAX_IN_FLIGHT = 8
+    MAX_SENDS_PER_SEC = None
+
+    MAX_RETRIES = 3
+    RETRY_DELAY = 0.5  # sec
+    RETRY_MAX_DELAY = 10  # sec
+
+    RETRIABLE_EXCEPTIONS = (requests.ConnectionError, requests.Timeout)
+    RETRIABLE_EXCEPTION_NAMES = ('FCMServerError', 'InternalPackageError')
+    RETRIABLE_RESULT_ERRORS = ('Unavailable', 'InternalServerError')
+
+    executor = ThreadPoolExecutor(max_workers=32)
+
+    def __init__(self, max_in_flight=None, max_sends_per_sec=None, send=None):
+        self.max_in_flight = max_in_flight or self.MAX_IN_FLIGHT
+        max_sends_per_sec = max_sends_per_sec or self.MAX_SENDS_PER_SEC
+        self.rate_limit = max_sends_per_sec and TokenBucket(max_sends_per_sec)
+        self.send = send or send_pushs
+
+    def dispatch(self, batches, title, message, data=None):
+        u"""-> генератор (key, response | None, exception | None)"""
+        batches = iter(batches)
+        in_flight = {}
+        exhausted = False
+
+        while True:
+            while not exhausted and len(in_flight) < self.max_in_flight:
+                try:
+                    key, fcm_tokens = next(batches)
+                except StopIteration:
+                    exhausted = True
+                    break
+                future = self.executor.submit(
+                    self.send_batch, fcm_tokens, title, message, data
+                )
+                in_flight[future] = key
+
+            if not in_flight:
+                return
+
+            done, _ = wait(list(in_flight), return_when=FIRST_COMPLETED)
+            for future in done:
+                key = in_flight.pop(future)
+                try:
+                    yield key, future.result(), None
+                except Exception as err:
+                    yield key, None, err
+
+    def send_batch(self, fcm_tokens, title, message, data=None):
+        u"""
+        -> {'success': int, 'failure': int, 'results': [{...}, ...]}
+        в том же порядке, что и fcm_tokens
+        """
+        results = [None] * len(fcm_tokens)
+        pending = range(len(fcm_tokens))
+        delay = self.RETRY_DELAY
+
+        for attempt in xrange(self.MAX_RETRIES + 1):
+            if not pending:
+                break
+            if attempt:
+                time.sleep(min(delay, self.RETRY_MAX_DELAY) * random.uniform(1, 1.5))
+                delay *= 2
+
+            tokens = [fcm_tokens[i] for i in pending]
+            if self.rate_limit:
+                self.rate_limit.acquire(len(tokens))
+
+            try:
+                _, response = self.send(title, message, tokens, data=data)
+                resp = response[0]
+            except Exception as err:
+                if not self.is_retriable(err) or attempt == self.MAX_RETRIES:
+                    if len(pending) == len(fcm_tokens):
+                        raise
+                    break
+                traceback.print_exc()
+                continue
+
+            retry = []
+            for i, result in izip(pending, resp['results']):
+                results[i] = result
+                if result.get('error') in self.RETRIABLE_RESULT_ERRORS:
+                    retry.append(i)
+            pending = retry
+
+        results = [result or {'error': 'Unavailable'} for result in results]
+        success = sum(1 for result in results if 'error' not in result)
+        return {
+            'success': success,
+            'failure': len(results) - success,
+            'results': results,
+        }
+
+    def is_retriable(self, err):
+        return (
+            isinstance(err, self.RETRIABLE_EXCEPTIONS) or
+            type(err).__name__ in self.RETRIABLE_EXCEPTION_NAMES
+        )
@@ -0,0 +1,147 @@
+# -*- encoding: utf-8 -*-
+
+import bisect
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+__all__ = ('HttpTransport', 'LatencyHistogram')
+
+
+class LatencyHistogram(object):
+    u"""Счётчики времени ответа по корзинам BUCKETS (секунды)"""
+
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self, buckets=None):
+        self.buckets = tuple(buckets or self.BUCKETS)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, seconds, error=False):
+        with self.lock:
+            self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+            self.count += 1
+            self.errors += bool(error)
+            self.total += seconds
+
+    def as_dict(self):
+        with self.lock:
+            buckets = [
+                ('<={}'.format(bucket), count)
+                for bucket, count in zip(self.buckets, self.counts)
+            ]
+            buckets.append(('>{}'.format(self.buckets[-1]), self.counts[-1]))
+            return {
+                'count': self.count,
+                'errors': self.errors,
+                'avg': self.count and self.total / self.count or 0,
+                'buckets': buckets,
+            }
+
+
+class HttpTransport(object):
+    u"""
+    requests.Session с настройками для внешних API:
+
+        transport = HttpTransport('cashback', read_timeout=10, pool_maxsize=32)
+        r = transport.get(url, endpoint='/available_offers/', params=...)
+        transport.stats()  # {endpoint: гистограмма времени ответа}
+
+    У каждого запроса есть connect/read таймаут. Идемпотентные запросы
+    (GET, PUT, DELETE...) повторяются при ошибке соединения, таймауте
+    и RETRY_STATUSES с экспоненциальной задержкой и случайным разбросом.
+    """
+
+    CONNECT_TIMEOUT = 3.05  # sec
+    READ_TIMEOUT = 15  # sec
+
+    POOL_CONNECTIONS = 4  # хостов
+    POOL_MAXSIZE = 32  # соединений на хост
+
+    MAX_RETRIES = 2
+    RETRY_DELAY = 0.2  # sec
+    RETRY_MAX_DELAY = 5  # sec
+    RETRY_STATUSES = (502, 503, 504)
+    IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+
+    def __init__(
+            self, name,
+            connect_timeout=None, read_timeout=None,
+            pool_connections=None, pool_maxsize=None,
+            max_retries=None,
+    ):
+        self.name = name
+        self.timeout = (
+            connect_timeout or self.CONNECT_TIMEOUT,
+            read_timeout or self.READ_TIMEOUT,
+        )
+        self.pool_maxsize = pool_maxsize or self.POOL_MAXSIZE
+        self.max_retries = self.MAX_RETRIES if max_retries is None else max_retries
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=pool_connections or self.POOL_CONNECTIONS,
+            pool_maxsize=self.pool_maxsize,
+        )
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request('PUT', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def request(self, method, url, endpoint=None, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        retries = self.max_retries if method.upper() in self.IDEMPOTENT_METHODS else 0
+        histogram = self.get_histogram(endpoint or url)
+
+        for attempt in xrange(retries + 1):
+            if attempt:
+                time.sleep(self.get_retry_delay(attempt))
+
+            started = time.time()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                histogram.observe(time.time() - started, error=True)
+                if attempt == retries:
+                    raise
+                continue
+
+            retry = response.status_code in self.RETRY_STATUSES
+            histogram.observe(time.time() - started, error=retry)
+            if not retry or attempt == retries:
+                return response
+
+    def get_retry_delay(self, attempt):
+        delay = min(self.RETRY_DELAY * 2 ** (attempt - 1), self.RETRY_MAX_DELAY)
+        return delay * random.uniform(0.5, 1.5)
+
+    def get_histogram(self, endpoint):
+        histogram = self.histograms.get(endpoint)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(endpoint, LatencyHistogram())
+        return histogram
+
+    def stats(self):
+        return dict(
+            (endpoint, histogram.as_dict())
+            for endpoint, histogram in self.histograms.items()
+        )
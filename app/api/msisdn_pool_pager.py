@@ -0,0 +1,140 @@
+# -*- encoding: utf-8 -*-
+
+import json
+import threading
+
+import lazy_object_proxy
+from concurrent.futures import ThreadPoolExecutor
+
+from app_utils.redis_utils import get_current_redis
+
+
+__all__ = ('MsisdnPoolPager', )
+
+
+class MsisdnPoolPager(object):
+    u"""
+    Постраничная выдача пула номеров Bercut. getMsisdnListPool умеет
+    только «первые countRecord номеров», поэтому пул кладётся в Redis
+    снимком на (регион, тип, маска):
+
+        cache:msisdn_pool:{region}:{msisdn_type}:{mask} -> {msisdns, complete}
+
+    Снимок перезапрашивается с запасом x GROWTH, только когда страница
+    выходит за его конец; следующая страница догружается в фоне заранее.
+    Занятый номер убирается из всех снимков через remove, как из
+    msisdn_pool_index, не дожидаясь истечения TIMEOUT.
+
+        pager = MsisdnPoolPager(loader)  # loader(region, msisdn_type, mask, count)
+        pager.get_page(region, msisdn_type, mask, offset=3, count=10)
+        pager.remove(msisdn)
+    """
+
+    redis_session = lazy_object_proxy.Proxy(get_current_redis)
+
+    KEY_TEMPLATE = u'cache:msisdn_pool:{region}:{msisdn_type}:{mask}'
+    SNAPSHOTS_KEY = u'cache:msisdn_pool_snapshots'  # set ключей снимков для remove
+    TIMEOUT = 5 * 60  # sec
+
+    MIN_SNAPSHOT = 100
+    GROWTH = 2
+    PREFETCH_PAGES = 1
+
+    executor = ThreadPoolExecutor(max_workers=2)
+
+    def __init__(self, loader):
+        self.loader = loader
+        self._prefetching = set()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def get_key(cls, region, msisdn_type, mask):
+        return cls.KEY_TEMPLATE.format(
+            region=region, msisdn_type=msisdn_type or '*', mask=mask or '',
+        )
+
+    def get_page(self, region, msisdn_type, mask, offset=0, count=10):
+        key = self.get_key(region, msisdn_type, mask)
+        need = (offset + 1) * count
+
+        snapshot = self._get(key)
+        if snapshot is None or (len(snapshot['msisdns']) < need and not snapshot['complete']):
+            size = max(
+                need * self.GROWTH, self.MIN_SNAPSHOT,
+                snapshot and len(snapshot['msisdns']) * self.GROWTH or 0,
+            )
+            snapshot = self._load(key, region, msisdn_type, mask, size)
+
+        msisdns = snapshot['msisdns']
+        prefetch_need = need + count * self.PREFETCH_PAGES
+        if not snapshot['complete'] and len(msisdns) < prefetch_need:
+            self._prefetch(
+                key, region, msisdn_type, mask,
+                max(prefetch_need, len(msisdns)) * self.GROWTH,
+            )
+        return msisdns[offset * count:need]
+
+    def remove(self, msisdn):
+        u"""Убирает номер из всех снимков; номера сравниваются по последним 10 цифрам"""
+        number = unicode(msisdn)[-10:]
+        try:
+            for key in self.redis_session.smembers(self.SNAPSHOTS_KEY):
+                self._remove(key, number)
+        except Exception as err:
+            print('MsisdnPoolPager.remove({}): {}'.format(msisdn, err))
+
+    def _remove(self, key, number):
+        ttl = self.redis_session.pttl(key)
+        snapshot = ttl > 0 and self._get(key)
+        if not snapshot:
+            self.redis_session.srem(self.SNAPSHOTS_KEY, key)
+            return
+
+        msisdns = [
+            msisdn for msisdn in snapshot['msisdns']
+            if unicode(msisdn)[-10:] != number
+        ]
+        if len(msisdns) < len(snapshot['msisdns']):
+            snapshot['msisdns'] = msisdns
+            self.redis_session.psetex(key, ttl, json.dumps(snapshot))
+
+    def _get(self, key):
+        try:
+            snapshot = self.redis_session.get(key)
+        except Exception as err:
+            print('MsisdnPoolPager.get({}): {}'.format(key, err))
+            return None
+        return snapshot and json.loads(snapshot) or None
+
+    def _load(self, key, region, msisdn_type, mask, size):
+        msisdns = self.loader(region, msisdn_type, mask, size)
+        snapshot = {
+            'msisdns': msisdns,
+            'complete': len(msisdns) < size,
+        }
+        try:
+            pipeline = self.redis_session.pipeline()
+            pipeline.setex(key, self.TIMEOUT, json.dumps(snapshot))
+            pipeline.sadd(self.SNAPSHOTS_KEY, key)
+            pipeline.expire(self.SNAPSHOTS_KEY, self.TIMEOUT)
+            pipeline.execute()
+        except Exception as err:
+            print('MsisdnPoolPager.set({}): {}'.format(key, err))
+        return snapshot
+
+    def _prefetch(self, key, region, msisdn_type, mask, size):
+        with self._lock:
+            if key in self._prefetching:
+                return
+            self._prefetching.add(key)
+
+        def prefetch():
+            try:
+                self._load(key, region, msisdn_type, mask, size)
+            except Exception as err:
+                print('MsisdnPoolPager.prefetch({}): {}'.format(key, err))
+            finally:
+                with self._lock:
+                    self._prefetching.discard(key)
+
+        self.executor.submit(prefetch)
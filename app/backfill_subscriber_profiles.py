@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+
+import sys
+
+import __import_utils__
+with __import_utils__.up_import(1):
+    from app_utils.db_utils import create_dbsession
+    import app.services
+    from app.models import SubscriberProfile
+    from app_models import HTTPLog
+
+
+class BackfillSubscriberProfiles(object):
+    u"""
+    Разовое заполнение SubscriberProfile из HTTPLog.
+    Логи читаются пачками от новых к старым, для каждого абонента
+    берётся последнее найденное ФИО; уже заполненные профили не трогаем.
+
+        python backfill_subscriber_profiles.py [start_id]
+    """
+
+    BATCH_SIZE = 1000
+
+    def __init__(self, db_session=None, batch_size=None):
+        self.db_session = db_session or create_dbsession()
+        self.batch_size = batch_size or self.BATCH_SIZE
+        self.seen_client_ids = set()
+
+    def handler(self, start_id=None):
+        last_id = start_id
+        created = 0
+        while True:
+            batch = self.get_batch(last_id)
+            if not batch:
+                break
+            last_id = batch[-1].id
+            created += self.store_batch(batch)
+            print('backfill subscriber profiles: id < {}, created {}'.format(
+                last_id, created
+            ))
+
+    def get_batch(self, last_id=None):
+        query = self.db_session.query(
+            HTTPLog.id, HTTPLog.client_id, HTTPLog.response,
+        ).filter(
+            HTTPLog.response.like('%fio%'),
+        )
+        if last_id is not None:
+            query = query.filter(HTTPLog.id < last_id)
+        return query.order_by(HTTPLog.id.desc()).limit(self.batch_size).all()
+
+    def store_batch(self, batch):
+        fios = {}
+        for http_log in batch:
+            if (
+                    http_log.client_id in self.seen_client_ids or
+                    http_log.client_id in fios
+            ):
+                continue
+            fio = SubscriberProfile.parse_http_log_fio(http_log.response)
+            if fio:
+                fios[http_log.client_id] = fio
+        if not fios:
+            return 0
+
+        self.seen_client_ids.update(fios)
+        exists = set(client_id for (client_id, ) in self.db_session.query(
+            SubscriberProfile.client_id
+        ).filter(
+            SubscriberProfile.client_id.in_(list(fios)),
+        ))
+
+        for client_id, fio in fios.items():
+            if client_id not in exists:
+                SubscriberProfile(
+                    client_id=client_id, fio=fio,
+                    data={'source': SubscriberProfile.SOURCE_HTTP_LOG},
+                ).save(self.db_session, commit=False)
+        self.db_session.commit()
+        return len(fios) - len(exists)
+
+
+if __name__ == '__main__':
+    BackfillSubscriberProfiles().handler(
+        start_id=int(sys.argv[1]) if len(sys.argv) > 1 else None
+    )
@@ -2,7 +2,7 @@
 
 import datetime
 
-from wtforms import StringField, validators
+from wtforms import IntegerField, StringField, validators
 
 from app.forms.base_forms import AbsApiForm, AbsModelForm
 from app.texts import _t
@@ -17,6 +17,13 @@ class ContactApiForm(AbsApiForm):
     last_datetime = StringField('last_datetime', [
         validators.Optional(),
     ])
+    cursor = StringField('cursor', [
+        validators.Optional(),
+    ])
+    limit = IntegerField('limit', [
+        validators.Optional(),
+        validators.NumberRange(min=1, message=_t('wrong_value')),
+    ])
 
     def validate_last_datetime(form, field):
         if not field.data:
@@ -1,30 +1,63 @@
 # -*- encoding: utf-8 -*-
 
+import base64
 import json
 import re
 import sys
+import threading
 import traceback
 from distutils.version import LooseVersion
 
 import lazy_object_proxy
 from app.exceptions import (ApiDataError, ApiError, AppError, AuthError,
                             ServerDataError, ServerError)
+from app.services.auth_context_cache import AuthContextCache
+from app.services.numbering_plan import get_reg_op_indexed
 from app.texts import _t
 from app_models import Client_lk, ClientToken, DeviceData
 from app_utils.alarm_utils import get_alarm_bot
-from app_utils.db_utils import get_current_dbsession
+from app_utils.db_utils import create_dbsession, get_current_dbsession
 from app_utils.logger_utils import get_logger
 from app_utils.redis_utils import get_current_redis_session
 from app_utils.wrappers import memorizing
-from methods_simple import get_reg_op
 from tornado import gen, web
 from tornado.concurrent import run_on_executor
 from tornado.escape import utf8
 
-__all__ = ('BaseHandler', 'RedirectHandler', )
+__all__ = ('BaseHandler', 'RedirectHandler', 'get_request_dbsession', )
 
 
-DB_SESSION = lazy_object_proxy.Proxy(get_current_dbsession)
+_request_state = threading.local()
+
+
+def get_request_dbsession():
+    u"""
+    Сессия запроса, который выполняется на executor (RUN_ON_EXECUTOR),
+    иначе общая get_current_dbsession()
+    """
+    db_session = getattr(_request_state, 'db_session', None)
+    if db_session is None:
+        db_session = get_current_dbsession()
+    return db_session
+
+
+class _RequestDbSession(object):
+    u"""
+    DB_SESSION: в отличие от lazy_object_proxy.Proxy сессия выбирается
+    при каждом обращении, поэтому потоки executor'а не делят общую сессию
+    """
+
+    def __getattr__(self, name):
+        return getattr(get_request_dbsession(), name)
+
+    def __iter__(self):
+        return iter(get_request_dbsession())
+
+    def __contains__(self, instance):
+        return instance in get_request_dbsession()
+
+
+DB_SESSION = _RequestDbSession()
 REDIS_SESSION = lazy_object_proxy.Proxy(get_current_redis_session)
 
 
@@ -50,6 +83,23 @@ class BaseHandler(web.RequestHandler):
     def _t(self, key, **kwargs):
         return _t(key, handler=self, **kwargs)
 
+    def encode_cursor(self, **position):
+        u"""Непрозрачный для клиента курсор постраничной выдачи"""
+        return base64.urlsafe_b64encode(
+            json.dumps(position, separators=(',', ':'), sort_keys=True)
+        )
+
+    def decode_cursor(self, cursor):
+        if not cursor:
+            return {}
+        try:
+            position = json.loads(base64.urlsafe_b64decode(utf8(cursor)))
+        except (TypeError, ValueError):
+            position = None
+        if not isinstance(position, dict):
+            raise ApiDataError(error_text=self._t('wrong_format'))
+        return position
+
     @property
     def executor(self):
         return self.application.executor
@@ -161,12 +211,33 @@ class BaseHandler(web.RequestHandler):
             None
         )
 
+    # set to None to resolve token/client/device from the db only
+    auth_context_cache = AuthContextCache
+
+    @property
+    @memorizing
+    def _cached_token_context(self):
+        if self.auth_context_cache is None or not self.token:
+            return None, None
+        return self.auth_context_cache.get_token_context(
+            self.db_session, self.token
+        )
+
     @property
     @memorizing
     def client_token(self):
-        client_token = self.token and self.db_session.query(ClientToken).filter_by(
+        if not self.token:
+            return None
+
+        client_token, _ = self._cached_token_context
+        if client_token is not None:
+            return client_token
+
+        client_token = self.db_session.query(ClientToken).filter_by(
             token=self.token, status=1, deleted=None
         ).first()
+        if client_token is not None and self.auth_context_cache is not None:
+            self.auth_context_cache.set_client_token(client_token)
         return client_token
 
     @property
@@ -177,19 +248,35 @@ class BaseHandler(web.RequestHandler):
     @property
     @memorizing
     def client(self):
-        return self.client_id and self.db_session.query(Client_lk).filter_by(
+        if not self.client_id:
+            return self.client_id
+
+        client = (
+            self.auth_context_cache is not None and
+            self.auth_context_cache.get_client(self.db_session, self.client_id)
+        )
+        if client:
+            return client
+
+        client = self.db_session.query(Client_lk).filter_by(
             number=self.client_id,
         ).first()
+        if client is not None and self.auth_context_cache is not None:
+            self.auth_context_cache.set_client(client)
+        return client
 
     @property
     @memorizing
     def region(self):
-        region, _ = get_reg_op(self.client_id, self.db_session)
+        region, _ = get_reg_op_indexed(self.client_id, self.db_session)
         return region
 
     @property
     @memorizing
     def number(self):
+        if self.client_token is not None:
+            return self.client_token.client_id
+
         client_token = self.token and self.db_session.query(ClientToken).filter_by(
             token=self.token, deleted=None
         ).first()
@@ -198,12 +285,27 @@ class BaseHandler(web.RequestHandler):
     @property
     @memorizing
     def device(self):
-        return self.token and self.client_id and self.db_session.query(
+        if not self.token or not self.client_id:
+            return None
+
+        _, device_id = self._cached_token_context
+        device = device_id and self.db_session.query(DeviceData).get(device_id)
+        if (
+                device and
+                device.token == self.token and
+                device.client_id == self.client_id
+        ):
+            return device
+
+        device = self.db_session.query(
             DeviceData
         ).filter_by(
             token=self.token,
             client_id=self.client_id,
         ).order_by(DeviceData.id.desc()).first()
+        if device is not None and self.auth_context_cache is not None:
+            self.auth_context_cache.set_device_id(self.token, device.id)
+        return device
 
     @property
     @memorizing
@@ -227,7 +329,14 @@ class BaseHandler(web.RequestHandler):
 
     NEED_SERVER_ERROR_ALERT = True
 
+    # Opt-in: run ``_get``/``_post`` on ``application.executor`` with
+    # a db session of its own instead of blocking the IOLoop.
+    RUN_ON_EXECUTOR = False
+
     def handle_request(self, handler, args, kwargs):
+        self.send(self.process_request(handler, args, kwargs))
+
+    def process_request(self, handler, args, kwargs):
         try:
             response_data = handler(*args, **kwargs)
         except (AuthError, ApiDataError) as err:
@@ -267,18 +376,43 @@ class BaseHandler(web.RequestHandler):
 
             self.db_session.rollback()
 
-        self.send(response_data)
+        return response_data
+
+    @run_on_executor
+    def process_request_on_executor(self, handler, args, kwargs):
+        # the instance attribute shadows the shared DB_SESSION proxy, and the
+        # thread-local one makes DB_SESSION/get_request_dbsession() used by
+        # anything else on this thread resolve to the same request session
+        self.db_session = _request_state.db_session = create_dbsession()
+        try:
+            return self.process_request(handler, args, kwargs)
+        finally:
+            _request_state.db_session = None
+            try:
+                self.db_session.close()
+            except Exception:
+                pass
+
+    @gen.coroutine
+    def dispatch_request(self, handler, args, kwargs):
+        if self.RUN_ON_EXECUTOR:
+            response_data = yield self.process_request_on_executor(
+                handler, args, kwargs
+            )
+            self.send(response_data)
+        else:
+            self.handle_request(handler, args, kwargs)
 
-    # @gen.coroutine
+    @gen.coroutine
     def get(self, *args, **kwargs):
-        self.handle_request(self._get, args, kwargs)
+        yield self.dispatch_request(self._get, args, kwargs)
 
     def _get(self, *args, **kwargs):
         raise ApiError(error_text='not valid method')
 
-    # @gen.coroutine
+    @gen.coroutine
     def post(self, *args, **kwargs):
-        self.handle_request(self._post, args, kwargs)
+        yield self.dispatch_request(self._post, args, kwargs)
 
     def _post(self, *args, **kwargs):
         raise ApiError(error_text='not valid method')
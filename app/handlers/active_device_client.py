@@ -9,6 +9,7 @@ from app_sbtelecom.api import SbtBercutBillingApi
 from app_sbtelecom.connectors import sbTelecomConnector
 from app.handlers import BaseHandler
 from app.models import ActiveDeviceClient, ActiveDeviceWiFi
+from app.services import UserInfoCache
 from app.wrappers import client_token_required
 from app_utils.db_utils.models import jsonb_property
 from app_regions.services import is_wifi_available_for_client
@@ -68,6 +69,8 @@ class ActiveDeviceClientHandler(BaseHandler):
 
 class ChangeDeviceWiFiHandler(BaseHandler):
 
+    RUN_ON_EXECUTOR = True
+
     data_active = jsonb_property('data', 'active')
 
     @client_token_required()
@@ -97,7 +100,10 @@ class ChangeDeviceWiFiHandler(BaseHandler):
             active_device_wifi.deleted = datetime.datetime.utcnow()
             active_device_wifi.save(self.db_session)
 
-            if self.off_wifi(active_device_wifi):
+            status = self.off_wifi(active_device_wifi)
+            UserInfoCache.bump(self.client_id)
+
+            if status:
                 return {"result": 1}
             else:
                 return {
@@ -133,7 +139,10 @@ class ChangeDeviceWiFiHandler(BaseHandler):
                     client_id=self.client_id,
                 ).save(self.db_session)
 
-            if self.on_wifi(active_device_wifi):
+            status = self.on_wifi(active_device_wifi)
+            UserInfoCache.bump(self.client_id)
+
+            if status:
                 return {"result": 1}
             else:
                 return {
@@ -190,6 +199,8 @@ class ChangeDeviceWiFiHandler(BaseHandler):
 
 class DeviceWiFiStatusHandler(BaseHandler):
 
+    RUN_ON_EXECUTOR = True
+
     @client_token_required()
     def _post(self):
         active_device_wifi = self.db_session.query(
@@ -1,5 +1,11 @@
 # -*- encoding: utf-8 -*-
 
+import datetime
+
+from sqlalchemy import or_, tuple_
+
+from app_utils.db_utils import IS_ORACLE_DB
+from app.exceptions import ApiDataError
 from app.handlers import BaseHandler
 from app.models import Cashback
 from app.wrappers import client_token_required
@@ -11,6 +17,20 @@ __all__ = ('CashbackHistoryHandler', )
 
 class CashbackHistoryHandler(BaseHandler):
 
+    CURSOR_DT_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+    VIEW_COLUMNS = (
+        Cashback.id,
+        Cashback.created,
+        Cashback.status_id,
+        Cashback.offer_name,
+        Cashback.view_amount,
+        Cashback.view_category,
+        Cashback.view_reward,
+        Cashback.view_reward_delay,
+        Cashback.view_favicon,
+    )
+
     @property
     @memorizing
     def on_page(self):
@@ -27,34 +47,79 @@ class CashbackHistoryHandler(BaseHandler):
         except:
             return 0
 
+    @property
+    def is_paged(self):
+        u"""Новые клиенты листают по cursor, старые - по offset"""
+        return 'cursor' in self.data
+
     @client_token_required()
     def _post(self, *args, **kwargs):
-        cashbacks = self.db_session.query(Cashback).filter(
+        query = self.db_session.query(*self.VIEW_COLUMNS).filter(
             Cashback.client_id == self.client_id,
             Cashback.deleted == None
         ).order_by(
-            Cashback.created.desc()
-        ).offset(self.offset).limit(self.on_page).all()
+            Cashback.created.desc(),
+            Cashback.id.desc(),
+        )
+
+        if self.is_paged:
+            cursor = self.decode_cursor(self.data.get('cursor'))
+            if cursor:
+                query = query.filter(self._cursor_filter(cursor))
+        else:
+            query = query.offset(self.offset)
+
+        rows = query.limit(self.on_page).all()
+        history = self._history(rows)
 
         response = {
             "result": 1,
-            "history": [self.cashback_view(c) for c in cashbacks],
+            "history": history,
             "offset": self.offset,
             "count": self.on_page,
         }
+        if self.is_paged:
+            response['next_cursor'] = rows and self.encode_cursor(
+                created=rows[-1].created.strftime(self.CURSOR_DT_FORMAT),
+                id=rows[-1].id,
+            ) or self.data.get('cursor') or None
+            response['has_more'] = len(rows) >= self.on_page
         return response
 
+    def _cursor_filter(self, cursor):
+        try:
+            created = datetime.datetime.strptime(
+                cursor['created'], self.CURSOR_DT_FORMAT
+            )
+            cashback_id = int(cursor['id'])
+        except (KeyError, TypeError, ValueError):
+            raise ApiDataError(error_text=self._t('wrong_format'))
+
+        if IS_ORACLE_DB:
+            # Oracle не сравнивает кортежи на больше/меньше
+            return (Cashback.created <= created) & or_(
+                Cashback.created < created,
+                Cashback.id < cashback_id,
+            )
+        return tuple_(Cashback.created, Cashback.id) < (created, cashback_id)
+
+    def _history(self, rows):
+        u"""view_* старых записей заполняет migrate_cashbacks_view_columns.py"""
+        return [self.cashback_row_view(row) for row in rows]
+
     @classmethod
-    def cashback_view(cls, cashback):
+    def cashback_row_view(cls, row):
         return {
-            "id": cashback.id,
-            "amount": cashback.amount and float(cashback.amount) or 0,
-            "datetime": cashback.created.strftime('%Y-%m-%dT%H:%M:%S'),
-            "status": cashback.status_id,
-            "status_text": cashback.status_text,
-            "title": cashback.name,
-            "category": cashback.category,
-            "cashback": cashback.reward,
-            "waiting": cashback.reward_delay,
-            "favicon": cashback.favicon,
+            "id": row.id,
+            "amount": row.view_amount or 0,
+            "datetime": row.created.strftime('%Y-%m-%dT%H:%M:%S'),
+            "status": row.status_id,
+            "status_text": Cashback.STATUS_IDS_TO_TEXT.get(
+                row.status_id, Cashback.STATUSES_TO_TEXT['open']
+            ),
+            "title": row.offer_name or '',
+            "category": row.view_category,
+            "cashback": row.view_reward,
+            "waiting": row.view_reward_delay,
+            "favicon": row.view_favicon,
         }
@@ -5,6 +5,7 @@ from app.constants import MsisdnType, MSISDN_TYPE_PRICES
 from app.exceptions import ApiError
 from app.handlers import BaseHandler
 from app.models import ChangeNumberOrder
+from app.services import MsisdnReservation, UserInfoCache, msisdn_pool_index
 from app.texts import _t
 from app.wrappers import client_token_required, validate
 from app_sbtelecom.api import sbTelecomApi
@@ -48,6 +49,8 @@ class AvailableChangeNumbersHandler(BaseHandler):
 }
     '''
 
+    RUN_ON_EXECUTOR = True
+
     data_search = json_property('data', 'search', default='')
     data_tier = json_property('data', 'tier', default=None)
     data_offset = json_property('data', 'offset', default=0, handler=int)
@@ -67,18 +70,39 @@ class AvailableChangeNumbersHandler(BaseHandler):
             autologin=True
         )['balance']
 
+        # номера, которые сейчас меняют другие абоненты, не показываем
+        reserved = MsisdnReservation.get_reserved()
+
         if not self.data_search:
-            numbers = [(number, tier) for tier, reg_dt_id, number in get_cached_numbers_info(
-                self.data_tier or '*',
-                self.region,
-            )][self.data_offset:self.data_offset + self.data_count]
+            try:
+                numbers = msisdn_pool_index.listing(
+                    self.region, self.data_tier,
+                    offset=self.data_offset, count=self.data_count,
+                    exclude=reserved,
+                )
+            except Exception as err:
+                print(u'LIST NUMBERS: {}'.format(err))
+                numbers = [(number, tier) for tier, reg_dt_id, number in get_cached_numbers_info(
+                    self.data_tier or '*',
+                    self.region,
+                ) if number not in reserved][self.data_offset:self.data_offset + self.data_count]
             print(u'GET NUMBERS: {} numbers[{}:{}]'.format(len(numbers), self.data_offset, self.data_offset + self.data_count))
         else:
-            numbers = []
+            try:
+                numbers = msisdn_pool_index.search(
+                    self.region, self.data_search, self.data_tier,
+                    exclude=reserved,
+                )[self.data_offset:self.data_offset + self.data_count]
+            except Exception as err:
+                print(u'SEARCH NUMBERS: {}'.format(err))
+                numbers = []
 
         if not numbers:
             print('GET NUMBERS: old way')
-            numbers = self.get_numbers()
+            numbers = [
+                (number, msisdn_type) for (number, msisdn_type) in self.get_numbers()
+                if unicode(number)[-10:] not in reserved
+            ]
 
         return {
             "tiers": TIERS,
@@ -141,6 +165,8 @@ class ChangeNumberHandler(BaseHandler):
 
     data_new_number = json_property('data', 'number', default=10, handler=int)
 
+    NUMBER_RESERVED_TEXT = u'Этот номер уже выбирает другой абонент, выберите другой номер'
+
     @client_token_required()
     def _post(self, *args, **kwargs):
         if not self.client.has_sbtelecom_operator:
@@ -154,22 +180,57 @@ class ChangeNumberHandler(BaseHandler):
         if not sbt_api.isActive:
             return dict(result=0, reply=self._t("change_number_user_not_found"))
 
+        try:
+            reservation = MsisdnReservation.acquire(
+                self.data_new_number, self.client_id, self.client.region,
+            )
+        except Exception as err:
+            print('ChangeNumberHandler: reserve {}: {}'.format(
+                self.data_new_number, err
+            ))
+            return {"result": 0, "reply": self._t("something_wrong")}
+        if reservation is None:
+            return {"result": 0, "reply": self.NUMBER_RESERVED_TEXT}
+
+        # бронь снимается на любом пути, кроме удачного replaceMsisdn
+        try:
+            success, log = self._replace_msisdn(reservation)
+
+            chn_order = ChangeNumberOrder(
+                client_id=self.client_id,
+                new_number=self.data_new_number,
+            )
+            chn_order.log = log
+            chn_order.save(self.db_session)
+        finally:
+            if not reservation.completed:
+                reservation.release()
+
+        if success:
+            reply = None
+            remove_cached_number(self.data_new_number)
+            msisdn_pool_index.remove(self.data_new_number)
+            MVNOApi.pager.remove(self.data_new_number)
+            UserInfoCache.bump(self.client_id, str(self.data_new_number))
+        else:
+            reply = log and log['user_resp'] or self._t("something_wrong")
+        return {"result": success, "reply": reply}
+
+    def _replace_msisdn(self, reservation):
+        u"""-> (success, log); после удачной смены номера бронь сразу завершается"""
         sbt_api = SbtBillingApi(
             self.client_id,
             region=get_region_name_by_dt_id(self.client.region)
         )
         success = 1
 
-        chn_order = ChangeNumberOrder(
-            client_id=self.client_id,
-            new_number=self.data_new_number,
-        )
-
         log = {}
         try:
-             r = sbt_api.replaceMsisdn(self.data_new_number)
+            r = sbt_api.replaceMsisdn(self.data_new_number)
             if not r.json:
                 success = 0
+            else:
+                reservation.complete()
             log = {
                 "url": r.request_url,
                 "req": r.request_text,
@@ -210,12 +271,4 @@ class ChangeNumberHandler(BaseHandler):
             except:
                 pass
 
-        chn_order.log = log
-        chn_order.save(self.db_session)
-
-        if success:
-            reply = None
-            remove_cached_number(self.data_new_number)
-        else:
-            reply = log and log['user_resp'] or self._t("something_wrong")
-        return {"result": success, "reply": reply}
+        return success, log
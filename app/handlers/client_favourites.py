@@ -11,13 +11,12 @@ from sqlalchemy.orm import subqueryload
 from app_models import UserInfo
 from app.handlers import BaseHandler
 from app.models import ClientFavourite, ClientFavouriteNumber
-from app.services import get_region_timezone_by_dt_id
+from app.services import get_region_timezone_by_dt_id, get_reg_op_many
 from app.texts import _t
 from app.wrappers import client_token_required
 from app_sbtelecom.connectors import sbTelecomConnector
 from app_utils.datetime_utils import get_rus_date
 from app_utils.wrappers import json_property, memorizing
-from methods_simple import get_reg_op
 
 
 
@@ -167,8 +166,9 @@ class ClientFavouritesEditHandler(AbsClientFavouritesHandler):
                 "result": 1, "ok": False
             }
 
+        reg_ops = get_reg_op_many(self.data_numbers, self.db_session)
         if not all(map(lambda number: (
-                get_reg_op(number, self.db_session) == (self.client.region, 'sbt')
+                reg_ops[number] == (self.client.region, 'sbt')
             ), self.data_numbers
         )):
             return {
@@ -1,21 +1,26 @@
 # -*- encoding: utf-8 -*-
 
 import datetime
+from collections import OrderedDict
 
 from sqlalchemy import (
     or_ as sql_or,
-    and_ as sql_and
+    and_ as sql_and,
+    tuple_ as sql_tuple,
 )
 
 from app_models import Client_lk
+from app_utils.db_utils import IS_ORACLE_DB
 from app.exceptions import ApiError
 from app.forms import ContactApiForm
 from app.handlers import BaseHandler
 from app.models import Contact
+from app.services import get_reg_op_indexed, get_reg_op_many
 from app.texts import _t
 from app.wrappers import client_token_required, validate
+from app_utils.wrappers import memorizing
 from methods_simple import (
-    get_reg_op, normalize_number_to_msisdn,
+    normalize_number_to_msisdn,
 )
 
 
@@ -28,73 +33,85 @@ class AbsContactsHandler(BaseHandler):
 
     DT_FORMAT = '%Y-%m-%dT%H:%M:%S'
 
+    PAGE_LIMIT = 500
+    MAX_PAGE_LIMIT = 5000
+    CHANGE_COMMIT_LAG = datetime.timedelta(seconds=10)
+
     @validate(ContactApiForm)
     def _post_handler(self, *args, **kwargs):
         self._add_contacts()
         self._del_contacts()
 
         utcnow = datetime.datetime.utcnow()
-        contacts = self._get_contacts()
+        if self.is_paged:
+            contacts, next_cursor = self._get_contacts_page()
+        else:
+            contacts, next_cursor = self._get_contacts(), None
 
         upd_contacts, del_contacts = [], []
         for contact in contacts:
-            if contact.is_deleted:
+            if contact.deleted:
                 del_contacts.append(contact.number)
             else:
                 upd_contacts.append(dict(
                     number=contact.number,
                     calls_available=bool(contact.calls_available),
-                    info=contact.info,
+                    info=(contact.data or {}).get('info') or '',
                     op=contact.operator,
                     reg=contact.region,
                 ))
 
-        return dict(
+        response = dict(
             last_datetime=utcnow.strftime(self.DT_FORMAT),
             upd_contacts=upd_contacts,
             del_contacts=del_contacts,
         )
+        if self.is_paged:
+            response['next_cursor'] = next_cursor
+            response['has_more'] = len(contacts) >= self.limit
+        return response
+
+    @property
+    def is_paged(self):
+        u"""Новые клиенты синхронизируются по cursor/limit, старые - по last_datetime"""
+        return 'cursor' in self.data or 'limit' in self.data
+
+    @property
+    @memorizing
+    def limit(self):
+        try:
+            limit = int(self.data.get('limit') or self.PAGE_LIMIT)
+        except (TypeError, ValueError):
+            limit = self.PAGE_LIMIT
+        return max(1, min(limit, self.MAX_PAGE_LIMIT))
 
     def _add_contacts(self):
         if not self.data.get('add_contacts'):
             return
 
-        for num, contact_data in enumerate(self.data['add_contacts']):
+        infos = OrderedDict()
+        for contact_data in self.data['add_contacts']:
             number = normalize_number_to_msisdn(contact_data.get('number'))
-            if not number:
-                continue
-
-            contact = self.db_session.query(Contact).filter_by(
-                client_id=self.client_id,
-                number=number,
-            ).first() or Contact(
-                client_id=self.client_id,
-                number=number,
-            )
-
-            if not contact.device_uid:
-                contact.device_uid = (
-                    self.device and self.device.device_id
-                )
-
-            region, operator = get_reg_op(number, self.db_session)
-
-            if operator in Client_lk.sbTELECOM_OPERATORS:
-                contact.calls_available = Contact.calls_available_for_client(
-                    self.db_session, client_id=number
-                )
-            else:
-                contact.calls_available = False
-
-            contact.operator = operator
-            contact.region = region
-            contact.info = (contact_data.get('info') or contact.info)
-            contact.deleted = None
-
-            commit = True if num and not num % 100 else False
-            contact.save(self.db_session, commit=commit)
+            if number:
+                infos[number] = contact_data.get('info') or infos.get(number)
+        numbers = list(infos)
+
+        reg_ops = get_reg_op_many(numbers, self.db_session)
+        calls_available = Contact.calls_available_for_clients(
+            self.db_session, [
+                number for number in numbers
+                if reg_ops[number][1] in Client_lk.sbTELECOM_OPERATORS
+            ]
+        )
 
-        self.db_session.commit()
+        Contact.upsert_many(self.db_session, self.client_id, [
+            (number, {
+                'region': reg_ops[number][0],
+                'operator': reg_ops[number][1],
+                'calls_available': number in calls_available,
+                'info': infos[number],
+            }) for number in numbers
+        ], device_uid=self.device and self.device.device_id)
 
     def _del_contacts(self):
         del_contacts = self.data.get('del_contacts') or []
@@ -109,25 +126,21 @@ class AbsContactsHandler(BaseHandler):
         ).filter(
             Contact.number.in_(del_contacts)
         ).update(dict(
-            deleted=datetime.datetime.utcnow()
+            deleted=datetime.datetime.utcnow(),
+            updated=datetime.datetime.utcnow(),
+            change_seq=Contact.CHANGE_SEQUENCE.next_value(),
         ), synchronize_session='fetch')
         self.db_session.commit()
 
-    def _get_contacts(self):
-        contacts_query = self.db_session.query(Contact).filter_by(
+    def _contacts_query(self):
+        contacts_query = self.db_session.query(
+            Contact.id, Contact.change_seq,
+            Contact.number, Contact.calls_available, Contact.data,
+            Contact.operator, Contact.region, Contact.deleted, Contact.updated,
+        ).filter_by(
             client_id=self.client_id,
         )
 
-        if self.data.get('last_datetime'):
-            last_datetime = datetime.datetime.strptime(
-                self.data['last_datetime'], self.DT_FORMAT
-            )
-
-            contacts_query = contacts_query.filter(sql_and(
-                Contact.updated != None,
-                Contact.updated >= last_datetime
-            ))
-
         if self.data.get('only_sbt'):
             contacts_query = contacts_query.filter(
                 Contact.operator.in_(Client_lk.sbTELECOM_OPERATORS)
@@ -138,12 +151,71 @@ class AbsContactsHandler(BaseHandler):
                 Contact.calls_available == True
             )
 
+        return contacts_query
+
+    def _get_contacts_page(self):
+        u"""
+        Изменения контактов после cursor, не больше limit штук
+        -> (contacts, next_cursor)
+
+        change_seq берётся при записи, а виден после коммита, поэтому
+        страница обрывается на первом изменении моложе CHANGE_COMMIT_LAG:
+        курсор не перескакивает номер, который ещё не закоммичен.
+        Транзакция дольше CHANGE_COMMIT_LAG всё равно может быть пропущена.
+        """
+        cursor = self.decode_cursor(self.data.get('cursor'))
+
+        contacts_query = self._contacts_query()
+        if cursor:
+            seq, contact_id = cursor.get('seq', 0), cursor.get('id', 0)
+            if IS_ORACLE_DB:
+                # Oracle не сравнивает кортежи на больше/меньше
+                contacts_query = contacts_query.filter(
+                    Contact.change_seq >= seq,
+                    sql_or(Contact.change_seq > seq, Contact.id > contact_id),
+                )
+            else:
+                contacts_query = contacts_query.filter(
+                    sql_tuple(Contact.change_seq, Contact.id) > (seq, contact_id)
+                )
+
+        contacts = contacts_query.order_by(
+            Contact.change_seq, Contact.id
+        ).limit(self.limit).all()
+
+        safe_updated = datetime.datetime.utcnow() - self.CHANGE_COMMIT_LAG
+        for i, contact in enumerate(contacts):
+            if contact.updated is None or contact.updated >= safe_updated:
+                contacts = contacts[:i]
+                break
+
+        if contacts:
+            next_cursor = self.encode_cursor(
+                seq=contacts[-1].change_seq, id=contacts[-1].id,
+            )
+        else:
+            next_cursor = self.data.get('cursor') or None
+        return contacts, next_cursor
+
+    def _get_contacts(self):
+        contacts_query = self._contacts_query()
+
+        if self.data.get('last_datetime'):
+            last_datetime = datetime.datetime.strptime(
+                self.data['last_datetime'], self.DT_FORMAT
+            )
+
+            contacts_query = contacts_query.filter(sql_and(
+                Contact.updated != None,
+                Contact.updated >= last_datetime
+            ))
+
         return contacts_query.all()
 
 
 def sbt_client_required(func):
     def decorator(self, *args, **kwargs):
-        _, op = get_reg_op(self.client_id, self.db_session)
+        _, op = get_reg_op_indexed(self.client_id, self.db_session)
         if op != 'sbt':
             raise ApiError(error_text=self._t('contacts_only_for_sbt'))
         return func(self, *args, **kwargs)
@@ -160,7 +232,7 @@ class SbtContactsHandlerV1(AbsContactsHandler):
 
 def com_unity_client_required(func):
     def decorator(self, *args, **kwargs):
-        _, op = get_reg_op(self.client_id, self.db_session)
+        _, op = get_reg_op_indexed(self.client_id, self.db_session)
         if op != 'com:unity':
             raise ApiError(error_text=self._t('contacts_only_for_com:unity'))
         return func(self, *args, **kwargs)
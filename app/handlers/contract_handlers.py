@@ -7,14 +7,13 @@ from app.exceptions import ApiError
 from app.forms import SendContractToEmailModelForm
 from app.handlers import BaseHandler
 from app.models import ChangeNumberOrder
+from app.services import get_reg_op_indexed
 from app.texts import _t
 from app.wrappers import client_token_required, validate
 from app_sbtelecom.api import SbtBercutBillingApi
 from app_sbt.api.contract_storage_api import ContractStorageApi
 from app_utils.wrappers import memorizing
 
-from methods_simple import get_reg_op
-
 
 __all__ = (
     'SbtGetContractHandlerV1',
@@ -28,7 +27,7 @@ __all__ = (
 
 def sbt_client_required(func):
     def decorator(self, *args, **kwargs):
-        _, op = get_reg_op(self.client_id, self.db_session)
+        _, op = get_reg_op_indexed(self.client_id, self.db_session)
 
         if op != 'sbt':
             raise ApiError(error_text=self._t('contract_only_for_sbt'))
@@ -76,7 +75,7 @@ class SbtSendToEmailContractHandlerV1(BaseHandler):
 
 def com_unity_client_required(func):
     def decorator(self, *args, **kwargs):
-        _, op = get_reg_op(self.client_id, self.db_session)
+        _, op = get_reg_op_indexed(self.client_id, self.db_session)
 
         if op != 'com:unity':
             raise ApiError(error_text=self._t('contract_only_for_com:unity'))
@@ -5,11 +5,11 @@ import base64
 from app.exceptions import ApiError
 from app.handlers import BaseHandler
 from app.models import FixPayOrder
+from app.services import get_reg_op_indexed
 from app.texts import _t
 from app.wrappers import client_token_required, validate
 
 from app_utils.wrappers import memorizing
-from methods_simple import get_reg_op
 
 
 __all__ = (
@@ -91,7 +91,7 @@ class FixPayMoveHandler(BaseHandler, FixPayMixin):
             order_type=FixPayOrder.ORDER_TYPE_MOVE,
         )
         fpo.number = self.data['number']
-        fpo.region, fpo.operator = get_reg_op(
+        fpo.region, fpo.operator = get_reg_op_indexed(
             fpo.number, self.db_session
         )
         fpo.order_data = self.data
@@ -154,7 +154,7 @@ class FixPayMovePayHandler(BaseHandler, FixPayMixin):
             order_type=FixPayOrder.ORDER_TYPE_MOVE,
         )
         fpo.number = self.data['number']
-        fpo.region, fpo.operator = get_reg_op(
+        fpo.region, fpo.operator = get_reg_op_indexed(
             fpo.number, self.db_session
         )
         fpo.save(self.db_session)
@@ -190,7 +190,7 @@ class FixPayMovePayDetailsHandler(BaseHandler, FixPayMixin):
             (
                 self.fpo.dst_number_region,
                 self.fpo.dst_number_operator
-            ) = get_reg_op(self.fpo.dst_number, self.db_session)
+            ) = get_reg_op_indexed(self.fpo.dst_number, self.db_session)
 
         self.fpo.save(self.db_session)
         return {}
@@ -236,7 +236,7 @@ class FixPayInfoHandler(BaseHandler, FixPayMixin):
 
     @client_token_required()
     def _post(self, *args, **kwargs):
-        _, operator = get_reg_op(self.data['number'], self.db_session)
+        _, operator = get_reg_op_indexed(self.data['number'], self.db_session)
         formated_number = FixPayOrder.format_number(self.data['number'])
 
         response = self.OPERATORS_INFO.get(
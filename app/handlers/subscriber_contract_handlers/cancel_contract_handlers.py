@@ -82,7 +82,10 @@ class SubscriberContractCancelFullHandler(CORSMixin, BaseHandler):
         sco.contact_phone = self.data.pop("contact_phone")
         sco.order_data = self.data
 
-        client_data = get_subscriber_contract_data(number=number) or {}
+        client_data = get_subscriber_contract_data(
+            number=number, db_session=self.db_session
+        ) or {}
+        self.db_session.commit()
         if not (
                 self.data.get('docid') == client_data.get('docid') and
                 self.data.get('serial') == client_data.get('serial'),
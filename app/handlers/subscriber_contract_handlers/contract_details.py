@@ -17,7 +17,10 @@ class SubscriberContractDetailsHandler(BaseHandler):
         if not self.client:
             return {}
 
-        contract_data = get_subscriber_contract_data(self.client)
+        contract_data = get_subscriber_contract_data(
+            self.client, db_session=self.db_session
+        )
+        self.db_session.commit()
 
         if contract_data.get('birthdate'):
             contract_data['birthdate'] = contract_data['birthdate'].strftime('%d.%m.%Y')
@@ -58,7 +58,8 @@ class GetContractDataMixin:
                 client_id=sco.client_id
             ).first()
 
-        contract_data = get_subscriber_contract_data(client)
+        contract_data = get_subscriber_contract_data(client, db_session=self.db_session)
+        self.db_session.commit()
         if contract_data.get('birthdate'):
             contract_data['birthdate'] = contract_data['birthdate'].strftime('%d.%m.%Y')
         if contract_data.get('issued'):
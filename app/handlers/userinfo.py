@@ -2,8 +2,9 @@
 
 import copy
 import datetime
-import re
+import functools
 import uuid
+from collections import OrderedDict
 
 from distutils.version import LooseVersion
 
@@ -18,10 +19,13 @@ from app.wrappers import client_token_required
 from .ABSHandler import *
 from utils.login_util import *
 
-from app.models import Action, Subscriber
+from app.models import Action, ActiveDeviceClient, Subscriber, SubscriberProfile
 from app.services import (
+	SectionGraph,
 	get_need_update_app,
 	get_subscriber_contract_data,
+	get_reg_op_indexed,
+	UserInfoCache,
 )
 from app.texts import _t
 
@@ -34,8 +38,8 @@ from app_sbtelecom.connectors import sbTelecomConnector
 from app_sbtelecom.models import SbtHuaweiPassword, SbtApiReg
 from app_payment.models import AutoPay, AutoPup
 from app_utils.alarm_utils import get_alarm_bot
+from app_utils.db_utils import create_dbsession
 from app_utils.wrappers import memorizing
-from methods_simple import get_reg_op
 
 from settings import SBT_BASE_TARIFF_PDF, TEST_SBT_USERS
 
@@ -75,6 +79,11 @@ CHANGE_NUMBER_ENABLED_MSISDNS = set([
 
 class UserInfoHandler(AuthHandler):
 
+    # RUN_ON_EXECUTOR (abs_handlers.BaseHandler) сюда не подключить:
+    # хендлер построен на AuthHandler из ABSHandler, а не на BaseHandler.
+    # Читающие секции ответа выполняются в пуле SectionGraph параллельно
+    # с пишущими, которые идут в потоке запроса (_run_sections).
+
     WIFI_PARTNERS = None
 
     def _post(self):
@@ -90,16 +99,194 @@ class UserInfoHandler(AuthHandler):
             self.client, self.db_session,
             device=self.device,
         )
-        answer.update(self._get_caller_data())
+        if self.device:
+            ActiveDeviceClient.touch(self.db_session, self.device.id, self.client_id)
 
-        answer.update(self._action_data())
-        answer.update(self._app_config_data())
-        answer.update(self._get_license_fee_data())
-        answer.update(self._sbt_data())
-        answer.update(self._tariff_banner())
+        for section in self._run_sections().values():
+            answer.update(section or {})
 
         answer.update(get_need_update_app(self.data.get('app')) or {})
+        return answer
+
+    SECTIONS = (
+        'caller', 'action', 'app_config', 'license_fee',
+        'sbt', 'tariff_banner', 'mnp_token',
+    )
+    SECTION_BUILDERS = {
+        'caller': '_get_caller_data',
+        'action': '_action_data',
+        'app_config': '_app_config_data',
+        'license_fee': '_get_license_fee_data',
+        'sbt': '_sbt_data',
+        'tariff_banner': '_tariff_banner',
+        'mnp_token': '_mnp_token_data',
+    }
+    SECTION_DEPENDS = {}
+    SECTION_TIMEOUT = 5  # sec
+    SECTION_TIMEOUTS = {}
+
+    # секции, которые пишут в БД: выполняются по порядку в потоке запроса
+    # и в его сессии, до её коммита. sbt меняет тот же Client, что и
+    # caller_registration в _post, поэтому в отдельной сессии его запись
+    # конфликтовала бы с транзакцией запроса (блокировка строки или
+    # потерянное обновление data)
+    WRITE_SECTIONS = ('sbt', )
+    # секции без своих запросов к БД: считаются в потоке запроса,
+    # чтобы не открывать под них сессию
+    INLINE_SECTIONS = ('app_config', 'license_fee', 'tariff_banner')
+
+    # секции, которые отдаются из UserInfoCache, пока не сменилась версия
+    CACHED_SECTIONS = ('app_config', 'sbt')
+    userinfo_cache = UserInfoCache  # None - не кэшировать
+
+    # ORM-объекты, которые секция получает из своей сессии
+    SECTION_INSTANCES = ('client_token', 'client', 'device', '_db_last_info')
+    _section_instances = None
+
+    def _run_sections(self):
+        u"""
+        Читающие секции запускаются в пуле SectionGraph первыми, каждая
+        на своей копии хендлера со своей сессией; пока они выполняются,
+        поток запроса считает пишущие (WRITE_SECTIONS) и лёгкие
+        (INLINE_SECTIONS) секции. Время ответа - самая долгая из двух
+        ветвей, а не сумма секций. Упавшая или не уложившаяся в таймаут
+        читающая секция даёт пустой ответ.
+        """
+        cache_version, cached = self.userinfo_cache.get_sections(
+            self.client_id, self._userinfo_cache_variant
+        ) if self.userinfo_cache else (None, None)
+        cached = cached or {}
+
+        sections = {}
+        serial = []
+        parallel = []
+        for name in self.SECTIONS:
+            if name in cached:
+                sections[name] = cached[name]
+            elif name in self.WRITE_SECTIONS or name in self.INLINE_SECTIONS:
+                serial.append(name)
+            else:
+                parallel.append(name)
+
+        graph = None
+        if parallel:
+            instances = dict(
+                (key, getattr(self, key)) for key in self.SECTION_INSTANCES
+            )
+            graph = SectionGraph(on_error=self._on_section_error)
+            for name in parallel:
+                try:
+                    section = self._section_copy(instances)
+                except Exception as err:
+                    self._on_section_error(name, err)
+                    sections[name] = {}
+                    continue
+                graph.add(
+                    name, functools.partial(self._run_section, name, section),
+                    depends=[
+                        depend for depend in self.SECTION_DEPENDS.get(name, ())
+                        if depend in graph.sections
+                    ],
+                    timeout=self.SECTION_TIMEOUTS.get(name, self.SECTION_TIMEOUT),
+                    default={},
+                )
+            graph.start()
+
+        for name in serial:
+            sections[name] = getattr(self, self.SECTION_BUILDERS[name])()
+
+        if graph is not None:
+            sections.update(graph.run())
+
+        if not cached and self.userinfo_cache and self._is_cacheable(sections):
+            self.userinfo_cache.set_sections(
+                self.client_id, self._userinfo_cache_variant, cache_version,
+                dict((name, sections[name]) for name in self.CACHED_SECTIONS),
+            )
+        return OrderedDict((name, sections[name]) for name in self.SECTIONS)
+
+    @property
+    def _userinfo_cache_variant(self):
+        # get_app_screens зависит от версии API
+        return '{}:{}:{}'.format(
+            self.__class__.__name__, self.api_version,
+            self.device and self.device.id,
+        )
+
+    def _is_cacheable(self, sections):
+        sbt_data = sections['sbt']
+        return (
+            all(sections[name] for name in self.CACHED_SECTIONS) and
+            'update' not in sbt_data and
+            sbt_data.get('result') != 0
+        )
+
+    def _section_copy(self, instances):
+        u"""
+        Копия хендлера со своей сессией. Собирается в потоке запроса,
+        до пишущих секций, которые меняют те же объекты.
+        """
+        db_session = create_dbsession()
+        section = copy.copy(self)
+        section.db_session = db_session
+        section._section_instances = dict(
+            (key, self._merge_instance(db_session, instance))
+            for key, instance in instances.items()
+        )
+        return section
+
+    def _run_section(self, name, section):
+        try:
+            return getattr(section, self.SECTION_BUILDERS[name])()
+        finally:
+            section.db_session.rollback()
+            section.db_session.close()
+
+    @staticmethod
+    def _merge_instance(db_session, instance):
+        if instance is None:
+            return None
+        return db_session.merge(instance, load=False)
+
+    def _section_instance(self, key, default):
+        if self._section_instances is not None:
+            return self._section_instances[key]
+        return default()
+
+    def _on_section_error(self, name, error):
+        print(u'{}: section {} failed: {}'.format(
+            self.__class__.__name__, name, error
+        ))
+
+    @property
+    def client_token(self):
+        return self._section_instance(
+            'client_token', lambda: super(UserInfoHandler, self).client_token
+        )
+
+    @property
+    def client(self):
+        return self._section_instance(
+            'client', lambda: super(UserInfoHandler, self).client
+        )
 
+    @property
+    def device(self):
+        return self._section_instance(
+            'device', lambda: super(UserInfoHandler, self).device
+        )
+
+    @property
+    def _db_last_info(self):
+        return self._section_instance('_db_last_info', self._get_db_last_info)
+
+    @memorizing
+    def _get_db_last_info(self):
+        return self.db_session.query(UserInfo).filter_by(
+            client_id=self.client_id
+        ).order_by(UserInfo.id.desc()).first()
+
+    def _mnp_token_data(self):
         mnp_token = self.db_session.query(ClientToken.token).filter_by(
             client_id=self.client_id,
             status=ClientToken.STATUS_CONFIRMED,
@@ -109,16 +296,8 @@ class UserInfoHandler(AuthHandler):
             ClientToken.time_created.desc()
         ).first()
         if mnp_token:
-            answer['mnpOrderStatusToken'] = mnp_token.token
-
-        return answer
-
-    @property
-    @memorizing
-    def _db_last_info(self):
-        return self.db_session.query(UserInfo).filter_by(
-            client_id=self.client_id
-        ).order_by(UserInfo.id.desc()).first()
+            return {'mnpOrderStatusToken': mnp_token.token}
+        return {}
 
     def _get_license_fee_data(self):
         if self._db_last_info is None:
@@ -241,7 +420,7 @@ class UserInfoHandler(AuthHandler):
 
         if cl is None:
             cl = Client(number=new_number)
-            cl.region, cl.operator = get_reg_op(cl.number, self.db_session)
+            cl.region, cl.operator = get_reg_op_indexed(cl.number, self.db_session)
 
         cl.password = self.client.password
         cl.password_lk = self.client.password_lk
@@ -695,6 +874,13 @@ class UserInfoHandler(AuthHandler):
     def _get_client_name(self):
         if self.client_id in TEST_SBT_USERS:
             return TEST_SBT_USERS[self.client_id].get('fio')
+
+        profile = SubscriberProfile.get(self.db_session, self.client_id)
+        if profile is not None and profile.is_actual:
+            return profile.fio or None
+
+        # профиля ещё нет: один раз ищем ФИО по-старому и запоминаем
+        fio = None
         http_log = self.db_session.query(HTTPLog).filter_by(
             client_id=self.client_id
         ).filter(
@@ -702,16 +888,19 @@ class UserInfoHandler(AuthHandler):
         ).order_by(HTTPLog.id.desc()).first()
 
         if http_log:
-            fio = re.search(
-                "'fio': u'([^\']+)'", http_log.response,
-                re.UNICODE
-            )
-            if fio:
-                return fio.group(1).decode('unicode-escape')
-            fio = get_subscriber_contract_data(number=self.client_id).get('fio')
-            if fio:
-                return fio
-        return None
+            fio = SubscriberProfile.parse_http_log_fio(http_log.response)
+            if not fio:
+                fio = get_subscriber_contract_data(
+                    number=self.client_id, db_session=self.db_session
+                ).get('fio')
+                if fio:
+                    return fio
+
+        SubscriberProfile.store(
+            self.db_session, self.client_id, fio,
+            source=SubscriberProfile.SOURCE_HTTP_LOG, commit=False,
+        )
+        return fio
 
     def _app_config_data(self):
         app_config = {
@@ -731,6 +920,9 @@ class UserInfoHandlerV3(UserInfoHandler):
 
     WIFI_PARTNERS = ['domru', ]
 
+    # caller регистрирует клиента в caller_registration
+    WRITE_SECTIONS = ('caller', 'sbt')
+
     def _get_caller_data(self):
         caller_registration(self.client, self.db_session)
 
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+import csv
+import sys
+
+import __import_utils__
+with __import_utils__.up_import(1):
+    from app_utils.db_utils import create_dbsession
+    import app.services
+    from app.models import NumberingPlanRange
+    from app_models import Port
+    from methods_simple import get_reg_op
+
+
+class LoadNumberingPlan(object):
+    u"""
+    Загрузка реестра DEF-кодов (csv Россвязи, cp1251, разделитель ';':
+    АВС/ DEF;От;До;Емкость;Оператор;Регион) в NumberingPlanRange.
+
+    region/operator диапазона берутся из колонок Оператор и Регион реестра.
+    В термины get_reg_op каждая пара (Оператор, Регион) переводится один раз
+    по границе любого её диапазона, которая не перенесена (нет в Port),
+    поэтому перенос одного номера не меняет весь диапазон. Пары, у которых
+    все границы перенесены, не загружаются и определяются через get_reg_op.
+
+        python load_numbering_plan.py DEF-9xx.csv [...]
+    """
+
+    def __init__(self, db_session=None):
+        self.db_session = db_session or create_dbsession()
+
+    def handler(self, *paths):
+        ranges = []
+        for path in paths:
+            ranges.extend(self.read_ranges(path))
+
+        reg_ops = self.get_reg_ops(ranges)
+
+        self.db_session.query(NumberingPlanRange).delete(
+            synchronize_session=False
+        )
+        loaded = 0
+        for number_from, number_to, owner in ranges:
+            if owner not in reg_ops:
+                continue
+            region, operator = reg_ops[owner]
+            NumberingPlanRange(
+                number_from=number_from, number_to=number_to,
+                region=region, operator=operator,
+            ).save(self.db_session, commit=False)
+            loaded += 1
+        self.db_session.commit()
+        print('numbering plan: loaded {} of {} ranges'.format(loaded, len(ranges)))
+
+    def get_reg_ops(self, ranges):
+        u"""-> {(Оператор, Регион): (region, operator)}"""
+        bounds = {}
+        for number_from, number_to, owner in ranges:
+            bounds.setdefault(owner, []).extend((str(number_from), str(number_to)))
+
+        ported = self.get_ported(
+            number for owner_bounds in bounds.values() for number in owner_bounds
+        )
+
+        reg_ops = {}
+        for owner, owner_bounds in bounds.items():
+            number = next((n for n in owner_bounds if n not in ported), None)
+            if number is not None:
+                reg_ops[owner] = get_reg_op(number, self.db_session)
+        return reg_ops
+
+    def get_ported(self, numbers):
+        numbers = list(set(numbers))
+        ported = set()
+        for i in xrange(0, len(numbers), NumberingPlanRange.IN_CHUNK_SIZE):
+            ported.update(number for (number, ) in self.db_session.query(
+                Port.number
+            ).filter(
+                Port.number.in_(numbers[i:i + NumberingPlanRange.IN_CHUNK_SIZE])
+            ).distinct())
+        return ported
+
+    @staticmethod
+    def read_ranges(path):
+        with open(path, 'rb') as f:
+            reader = csv.reader(f, delimiter=';')
+            next(reader, None)
+            for row in reader:
+                try:
+                    code, number_from, number_to = map(int, row[:3])
+                    owner = (row[4].strip(), row[5].strip())
+                except (ValueError, IndexError):
+                    continue
+                yield (
+                    code * 10 ** 7 + number_from,
+                    code * 10 ** 7 + number_to,
+                    owner,
+                )
+
+
+if __name__ == '__main__':
+    LoadNumberingPlan().handler(*sys.argv[1:])
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+
+import __import_utils__
+with __import_utils__.up_import(1):
+    from app.migration import Migration
+
+
+class MigrateActiveDeviceClientsLastSeen(Migration):
+    u"""
+    Добавляет ActiveDeviceClient.last_seen (последний заход устройства,
+    по нему PushAudience фильтрует last_seen_days). Существующие строки
+    получают created; дальше last_seen обновляет UserInfoHandler.
+
+        python migrate_active_device_clients_last_seen.py
+    """
+
+    def handler(self):
+        self.add_column('active_device_clients', 'last_seen', 'TIMESTAMP', 'TIMESTAMP')
+        self.backfill(
+            'active_device_clients', 'last_seen = created', 'last_seen IS NULL',
+        )
+
+
+if __name__ == '__main__':
+    MigrateActiveDeviceClientsLastSeen().handler()
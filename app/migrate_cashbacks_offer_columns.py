@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+
+import __import_utils__
+with __import_utils__.up_import(1):
+    from app_utils.db_utils import IS_ORACLE_DB
+    from app.migration import Migration
+
+
+class MigrateCashbacksOfferColumns(Migration):
+    u"""
+    Добавляет Cashback.offer_name и Cashback.click_tm (копии из data,
+    по ним upd_cashback_offers ищет известные кешбэки и считает
+    watermark), заполняет их для существующих строк и строит индекс
+    ix_cashbacks_client_offer_click. Дробный click_tm обрезается, как
+    в Cashback.to_click_tm, иначе ключ (offer_name, click_tm) не совпадёт.
+
+        python migrate_cashbacks_offer_columns.py
+    """
+
+    def handler(self):
+        self.add_column('cashbacks', 'offer_name', 'VARCHAR', 'VARCHAR2(4000)')
+        self.add_column('cashbacks', 'click_tm', 'BIGINT', 'NUMBER(19)')
+        if IS_ORACLE_DB:
+            self.backfill(
+                'cashbacks',
+                "offer_name = json_value(data, '$.offer_name'), "
+                "click_tm = trunc(json_value(data, '$.click_tm' RETURNING NUMBER))",
+                'click_tm IS NULL',
+            )
+        else:
+            self.backfill(
+                'cashbacks',
+                "offer_name = data->>'offer_name', "
+                "click_tm = CAST(TRUNC(CAST(NULLIF(data->>'click_tm', '') AS NUMERIC)) AS BIGINT)",
+                'click_tm IS NULL',
+            )
+        self.create_index(
+            'ix_cashbacks_client_offer_click',
+            'cashbacks', 'client_id', 'offer_name', 'click_tm',
+        )
+
+
+if __name__ == '__main__':
+    MigrateCashbacksOfferColumns().handler()
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+
+import __import_utils__
+with __import_utils__.up_import(1):
+    from app.migration import Migration
+    from app.models import Cashback
+
+
+class MigrateCashbacksViewColumns(Migration):
+    u"""
+    Добавляет колонки Cashback.view_* (по ним CashbackHistoryHandler
+    отдаёт историю без разбора data), заполняет их для существующих
+    строк через Cashback.fill_columns и строит индекс
+    ix_cashbacks_client_created для листания по (created, id).
+    На PostgreSQL индекс покрывающий: колонки выдачи в INCLUDE, страница
+    истории читается index-only scan. На Oracle INCLUDE нет, а четыре
+    VARCHAR2(4000) в ключе не проходят по длине ключа индекса - там
+    индекс только по (client_id, created, id).
+
+    Запускается после migrate_cashbacks_offer_columns.py.
+
+        python migrate_cashbacks_view_columns.py
+    """
+
+    # колонки CashbackHistoryHandler.VIEW_COLUMNS и фильтра deleted
+    INCLUDE = (
+        'status_id', 'offer_name', 'deleted', 'view_amount', 'view_category',
+        'view_reward', 'view_reward_delay', 'view_favicon',
+    )
+
+    def handler(self):
+        self.add_column('cashbacks', 'view_amount', 'DOUBLE PRECISION', 'FLOAT')
+        for column in ('view_category', 'view_reward', 'view_reward_delay', 'view_favicon'):
+            self.add_column('cashbacks', column, 'VARCHAR', 'VARCHAR2(4000)')
+        self.backfill_rows(
+            Cashback,
+            (Cashback.view_amount == None) & (Cashback.deleted == None),
+            Cashback.fill_columns,
+        )
+        self.create_index(
+            'ix_cashbacks_client_created', 'cashbacks', 'client_id', 'created', 'id',
+            include=self.INCLUDE,
+        )
+
+
+if __name__ == '__main__':
+    MigrateCashbacksViewColumns().handler()
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+import __import_utils__
+with __import_utils__.up_import(1):
+    from app_utils.db_utils import IS_ORACLE_DB
+    from app.migration import Migration
+
+
+class MigrateContactsChangeSeq(Migration):
+    u"""
+    Добавляет Contact.change_seq в существующую таблицу contacts:
+
+        1. последовательность contacts_change_seq
+        2. колонка change_seq с DEFAULT из последовательности,
+           чтобы строки, которые пишет старый код, сразу получали номер
+        3. номера для существующих строк, пачками по id
+        4. NOT NULL
+        5. индекс (client_id, change_seq), на PostgreSQL - CONCURRENTLY
+
+        python migrate_contacts_change_seq.py
+    """
+
+    SEQUENCE = 'contacts_change_seq'
+    INDEX = 'ix_contacts_client_id_change_seq'
+
+    def handler(self):
+        self.create_sequence()
+        self.add_column('contacts', 'change_seq', 'BIGINT', 'NUMBER(19)')
+        self.set_default()
+        self.backfill(
+            'contacts', 'change_seq = {}'.format(self.nextval()), 'change_seq IS NULL',
+        )
+        self.set_not_null()
+        self.create_index(self.INDEX, 'contacts', 'client_id', 'change_seq')
+
+    def nextval(self):
+        if IS_ORACLE_DB:
+            return '{}.NEXTVAL'.format(self.SEQUENCE)
+        return "nextval('{}')".format(self.SEQUENCE)
+
+    def create_sequence(self):
+        if not IS_ORACLE_DB:
+            self.execute('CREATE SEQUENCE IF NOT EXISTS {}'.format(self.SEQUENCE))
+        elif not self.scalar(
+                'SELECT count(*) FROM user_sequences WHERE sequence_name = :name',
+                name=self.SEQUENCE.upper(),
+        ):
+            self.execute('CREATE SEQUENCE {}'.format(self.SEQUENCE))
+
+    def set_default(self):
+        if IS_ORACLE_DB:
+            self.execute('ALTER TABLE contacts MODIFY (change_seq DEFAULT {})'.format(
+                self.nextval()
+            ))
+        else:
+            self.execute('ALTER TABLE contacts ALTER COLUMN change_seq SET DEFAULT {}'.format(
+                self.nextval()
+            ))
+
+    def set_not_null(self):
+        if not IS_ORACLE_DB:
+            self.execute('ALTER TABLE contacts ALTER COLUMN change_seq SET NOT NULL')
+        elif self.scalar(
+                "SELECT count(*) FROM user_tab_columns WHERE table_name = 'CONTACTS' "
+                "AND column_name = 'CHANGE_SEQ' AND nullable = 'Y'"
+        ):
+            self.execute('ALTER TABLE contacts MODIFY (change_seq NOT NULL)')
+
+
+if __name__ == '__main__':
+    MigrateContactsChangeSeq().handler()
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+
+import __import_utils__
+with __import_utils__.up_import(1):
+    from app_utils.db_utils import IS_ORACLE_DB
+    from app.migration import Migration
+
+
+class MigrateContactsClientNumber(Migration):
+    u"""
+    Уникальный индекс contacts (client_id, number) для Contact.upsert_many:
+
+        1. дубли контактов клиента с одним номером удаляются,
+           остаётся последний изменённый
+        2. уникальный индекс, на PostgreSQL - CONCURRENTLY
+
+    Запускается после migrate_contacts_change_seq.py: нужны change_seq
+    и его DEFAULT, по которому upsert_many нумерует новые контакты.
+
+        python migrate_contacts_client_number.py
+    """
+
+    INDEX = 'ux_contacts_client_id_number'
+
+    def handler(self):
+        self.delete_duplicates()
+        self.create_index(
+            self.INDEX, 'contacts',
+            'client_id', 'number_' if IS_ORACLE_DB else 'number',
+            unique=True,
+        )
+
+    def delete_duplicates(self):
+        if IS_ORACLE_DB:
+            sql = (
+                'DELETE FROM contacts a WHERE EXISTS ('
+                'SELECT 1 FROM contacts b '
+                'WHERE b.client_id = a.client_id AND b.number_ = a.number_ AND ('
+                'b.change_seq > a.change_seq OR '
+                '(b.change_seq = a.change_seq AND b.rowid > a.rowid)))'
+            )
+        else:
+            sql = (
+                'DELETE FROM contacts a USING contacts b '
+                'WHERE b.client_id = a.client_id AND b.number = a.number '
+                'AND (b.change_seq, b.id) > (a.change_seq, a.id)'
+            )
+        print('contacts: deleted {} duplicates'.format(self.execute(sql).rowcount))
+
+
+if __name__ == '__main__':
+    MigrateContactsClientNumber().handler()
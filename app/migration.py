@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+
+from sqlalchemy import func, text as sql_text
+
+from app_utils.db_utils import IS_ORACLE_DB, get_dbengine, create_dbsession
+
+
+__all__ = ('Migration', )
+
+
+class Migration(object):
+    u"""
+    Основа разовых миграций существующих таблиц: create_all в sync_db.py
+    добавляет только новые таблицы и не меняет существующие.
+    Шаги проверяют, не выполнены ли они, повторный запуск безопасен:
+
+        class MigrateSomething(Migration):
+            def handler(self):
+                self.add_column('contacts', 'change_seq', 'BIGINT', 'NUMBER(19)')
+                self.backfill('contacts', 'change_seq = 0', 'change_seq IS NULL')
+                self.create_index('ix_contacts_change_seq', 'contacts', 'change_seq')
+    """
+
+    BATCH_SIZE = 10000
+
+    def __init__(self, db_engine=None, db_session=None, batch_size=None):
+        self.db_engine = db_engine or get_dbengine()
+        self.db_session = db_session or create_dbsession()
+        self.batch_size = batch_size or self.BATCH_SIZE
+
+    def handler(self):
+        raise NotImplementedError
+
+    def execute(self, sql, **params):
+        result = self.db_session.execute(sql_text(sql), params)
+        self.db_session.commit()
+        return result
+
+    def scalar(self, sql, **params):
+        return self.db_session.execute(sql_text(sql), params).scalar()
+
+    def has_column(self, table, column):
+        if IS_ORACLE_DB:
+            return bool(self.scalar(
+                'SELECT count(*) FROM user_tab_columns '
+                'WHERE table_name = :table AND column_name = :column',
+                table=table.upper(), column=column.upper(),
+            ))
+        return bool(self.scalar(
+            'SELECT count(*) FROM information_schema.columns '
+            'WHERE table_name = :table AND column_name = :column',
+            table=table, column=column,
+        ))
+
+    def add_column(self, table, column, pg_type, oracle_type):
+        u"""Колонка добавляется без DEFAULT, иначе PostgreSQL перепишет таблицу"""
+        if self.has_column(table, column):
+            return
+        if IS_ORACLE_DB:
+            self.execute('ALTER TABLE {} ADD ({} {})'.format(table, column, oracle_type))
+        else:
+            self.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(table, column, pg_type))
+
+    def backfill(self, table, assignments, where=None, **params):
+        u"""UPDATE table SET assignments [WHERE where] пачками по id"""
+        sql = 'UPDATE {} SET {} WHERE id >= :id_from AND id < :id_to'.format(
+            table, assignments
+        )
+        if where:
+            sql += ' AND ({})'.format(where)
+
+        max_id = self.scalar('SELECT max(id) FROM {}'.format(table)) or 0
+        updated = 0
+        for id_from in xrange(0, max_id + 1, self.batch_size):
+            params.update(id_from=id_from, id_to=id_from + self.batch_size)
+            updated += self.execute(sql, **params).rowcount
+            print('{}: id < {}, updated {}'.format(
+                table, id_from + self.batch_size, updated
+            ))
+        return updated
+
+    def backfill_rows(self, model, where, fill):
+        u"""
+        Как backfill, но значения считаются в python: fill(row) для строк
+        model, подходящих под where, пачками по id
+        """
+        max_id = self.db_session.query(func.max(model.id)).scalar() or 0
+        updated = 0
+        for id_from in xrange(0, max_id + 1, self.batch_size):
+            rows = self.db_session.query(model).filter(
+                model.id >= id_from,
+                model.id < id_from + self.batch_size,
+                where,
+            ).all()
+            for row in rows:
+                fill(row)
+            self.db_session.commit()
+            updated += len(rows)
+            print('{}: id < {}, updated {}'.format(
+                model.__tablename__, id_from + self.batch_size, updated
+            ))
+        return updated
+
+    def create_index(self, name, table, *columns, **kwargs):
+        u"""
+        На PostgreSQL - CONCURRENTLY, на Oracle - ONLINE, без блокировки записи;
+        unique=True - уникальный индекс, include=(...) - неключевые колонки
+        покрывающего индекса (только PostgreSQL 11+, на Oracle пропускаются)
+        """
+        columns = ', '.join(columns)
+        include = kwargs.get('include')
+        create = 'CREATE UNIQUE INDEX' if kwargs.get('unique') else 'CREATE INDEX'
+        if IS_ORACLE_DB:
+            if not self.scalar(
+                    'SELECT count(*) FROM user_indexes WHERE index_name = :name',
+                    name=name.upper(),
+            ):
+                self.execute('{} {} ON {} ({}) ONLINE'.format(
+                    create, name, table, columns
+                ))
+            return
+
+        # CREATE INDEX CONCURRENTLY нельзя выполнять внутри транзакции
+        with self.db_engine.connect() as connection:
+            connection.execution_options(isolation_level='AUTOCOMMIT').execute(
+                sql_text('{} CONCURRENTLY IF NOT EXISTS {} ON {} ({}){}'.format(
+                    create, name, table, columns,
+                    include and ' INCLUDE ({})'.format(', '.join(include)) or '',
+                ))
+            )
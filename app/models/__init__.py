@@ -14,6 +14,7 @@ from app.models.active_device_client import *
 from app.models.client_favourites import *
 from app.models.change_number_orders import *
 from app.models.subscriber_models import *
+from app.models.numbering_plan_models import *
 # from app.models.sbid_models import *
 from app.models.promocode_models import *
 from app.models.storage_models import *
@@ -4,7 +4,8 @@ import datetime
 
 from sqlalchemy import (
     Column,
-    Integer, String, DateTime
+    Integer, String, DateTime,
+    or_ as sql_or,
 )
 from sqlalchemy.orm import relationship
 from sqlalchemy.schema import ForeignKey
@@ -40,6 +41,26 @@ class ActiveDeviceClient(AppDeclBase, BaseModel):
     )
     deleted = Column(DateTime)
 
+    # последний заход с устройства (UserInfoHandler), не точнее TOUCH_INTERVAL;
+    # в существующую таблицу добавляется migrate_active_device_clients_last_seen.py
+    last_seen = Column(DateTime, default=datetime.datetime.utcnow)
+
+    TOUCH_INTERVAL = datetime.timedelta(days=1)
+
+    @classmethod
+    def touch(cls, db_session, device_id, client_id, utcnow=None):
+        u"""Отметить заход устройства; пишет не чаще раза в TOUCH_INTERVAL"""
+        utcnow = utcnow or datetime.datetime.utcnow()
+        return db_session.query(cls).filter(
+            cls.device_id == device_id,
+            cls.client_id == client_id,
+            cls.deleted == None,
+            sql_or(
+                cls.last_seen == None,
+                cls.last_seen < utcnow - cls.TOUCH_INTERVAL,
+            ),
+        ).update({cls.last_seen: utcnow}, synchronize_session=False)
+
 
 class ActiveDeviceWiFi(AppDeclBase, BaseModel):
     __tablename__ = "active_device_wifis"
@@ -3,8 +3,8 @@
 import datetime
 
 from sqlalchemy import (
-    Column, Integer, String,
-    DateTime, Boolean
+    Column, Integer, BigInteger, String, Float,
+    DateTime, Boolean, Index
 )
 from sqlalchemy import (
     or_ as sql_or
@@ -22,11 +22,24 @@ from methods_simple import get_reg_op
 
 __all__ = (
     'Cashback',
+    'CashbackWatermark',
 )
 
 
 class Cashback(AppDeclBase, BaseModel):
     __tablename__ = "cashbacks"
+    __table_args__ = (
+        Index(
+            'ix_cashbacks_client_offer_click',
+            'client_id', 'offer_name', 'click_tm',
+        ),
+        # на PostgreSQL с INCLUDE колонок выдачи,
+        # см. migrate_cashbacks_view_columns.py
+        Index(
+            'ix_cashbacks_client_created',
+            'client_id', 'created', 'id',
+        ),
+    )
 
     STATUS_REJECT = -1
     STATUS_OPEN = 0
@@ -44,6 +57,12 @@ class Cashback(AppDeclBase, BaseModel):
         'approved': u'Выполнен',
     }
 
+    STATUS_IDS_TO_TEXT = {
+        STATUS_REJECT: STATUSES_TO_TEXT['reject'],
+        STATUS_OPEN: STATUSES_TO_TEXT['open'],
+        STATUS_APPROVED: STATUSES_TO_TEXT['approved'],
+    }
+
     NO_ID_SEQUENCE = True
     id = Column(Integer, primary_key=True, autoincrement=(not IS_ORACLE_DB))
     client_id = Column(String, primary_key=IS_ORACLE_DB, index=True)
@@ -51,6 +70,25 @@ class Cashback(AppDeclBase, BaseModel):
     status_id = Column(Integer, default=STATUS_OPEN)
     data = Column(JSONB, default={})
 
+    # копии data.offer_name / data.click_tm для поиска без разбора json
+    offer_name = Column(String)
+    click_tm = Column(BigInteger)
+
+    # поля истории кешбэков (CashbackHistoryHandler), копии из data
+    view_amount = Column(Float)
+    view_category = Column(String)
+    view_reward = Column(String)
+    view_reward_delay = Column(String)
+    view_favicon = Column(String)
+
+    VIEW_COLUMNS = (
+        ('view_amount', lambda self: self.amount and float(self.amount) or 0),
+        ('view_category', lambda self: self.category),
+        ('view_reward', lambda self: self.reward),
+        ('view_reward_delay', lambda self: self.reward_delay),
+        ('view_favicon', lambda self: self.favicon),
+    )
+
     created = Column(
         DateTime,  # primary_key=IS_ORACLE_DB,
         default=datetime.datetime.utcnow
@@ -79,7 +117,48 @@ class Cashback(AppDeclBase, BaseModel):
         if self.status_id != status_id:
             self.status_id = status_id
 
+        self.fill_columns()
+
         if self.created is None:
             self.created = datetime.datetime.utcfromtimestamp(self.clicked)
 
         return super(Cashback, self).save(*args, **kwargs)
+
+    def fill_columns(self):
+        if self.offer_name != self.name:
+            self.offer_name = self.name
+        click_tm = self.to_click_tm(self.clicked)
+        if self.click_tm != click_tm:
+            self.click_tm = click_tm
+
+        for (column, get_value) in self.VIEW_COLUMNS:
+            value = get_value(self)
+            if getattr(self, column) != value:
+                setattr(self, column, value)
+
+    @property
+    def key(self):
+        return self.name, self.to_click_tm(self.clicked)
+
+    @staticmethod
+    def to_click_tm(value):
+        u"""
+        click_tm партнёра ('1700000000.5', 1700000000.5, ...) -> int без
+        дробной части; так же отбрасывает её migrate_cashbacks_offer_columns.py
+        """
+        return value and int(float(value)) or None
+
+
+class CashbackWatermark(AppDeclBase, BaseModel):
+    u"""
+    click_tm, с которого upd_cashback_offers запрашивает кешбэки абонента.
+    Сдвигается после каждой удачной сверки и назад не возвращается.
+    """
+    __tablename__ = "cashback_watermarks"
+
+    NO_ID_SEQUENCE = True
+    id = Column(Integer, primary_key=True, autoincrement=(not IS_ORACLE_DB))
+    client_id = Column(String, primary_key=IS_ORACLE_DB, index=True, unique=True)
+
+    click_tm = Column(BigInteger)
+    updated = Column(DateTime, default=datetime.datetime.utcnow)
@@ -1,11 +1,23 @@
 # -*- encoding: utf-8 -*-
 
 import datetime
+import json
+import time
+from collections import OrderedDict
 
-from sqlalchemy import Column, Integer, String, DateTime, Boolean
 from sqlalchemy import (
+    Column, Index, Sequence,
+    BigInteger, Integer, String, DateTime, Boolean,
+)
+from sqlalchemy import (
+    bindparam,
+    func as sql_func,
+    text as sql_text,
+    and_ as sql_and,
     or_ as sql_or
 )
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.exc import IntegrityError
 from app_utils.db_utils import IS_ORACLE_DB
 from app_utils.db_utils.models import JSONB
 
@@ -28,6 +40,21 @@ __all__ = (
 
 class Contact(AppDeclBase, BaseModel):
     __tablename__ = "contacts"
+    __table_args__ = (
+        Index('ix_contacts_client_id_change_seq', 'client_id', 'change_seq'),
+        # upsert_many: ON CONFLICT / MERGE по (client_id, number),
+        # в существующую таблицу добавляется migrate_contacts_client_number.py
+        Index(
+            'ux_contacts_client_id_number',
+            'client_id', 'number_' if IS_ORACLE_DB else 'number',
+            unique=True,
+        ),
+    )
+
+    # каждое изменение контакта получает следующий номер,
+    # по нему клиент досинхронизирует изменения (см. AbsContactsHandler);
+    # в существующую таблицу добавляется migrate_contacts_change_seq.py
+    CHANGE_SEQUENCE = Sequence('contacts_change_seq', metadata=AppDeclBase.metadata)
 
     NO_ID_SEQUENCE = True
     id = Column(Integer, primary_key=True, autoincrement=(not IS_ORACLE_DB))
@@ -52,10 +79,19 @@ class Contact(AppDeclBase, BaseModel):
     updated = Column(DateTime, default=datetime.datetime.utcnow)
     deleted = Column(DateTime)
 
+    # DEFAULT на стороне БД, чтобы вставка пачкой не вычисляла nextval в python
+    change_seq = Column(BigInteger, nullable=False, server_default=sql_text(
+        'contacts_change_seq.NEXTVAL' if IS_ORACLE_DB
+        else "nextval('contacts_change_seq')"
+    ))
+
     info = jsonb_property('data', 'info')
 
+    IN_CHUNK_SIZE = 1000  # Oracle: не больше 1000 значений в IN
+
     def save(self, db_session, commit=True):
         self.updated = datetime.datetime.utcnow()
+        self.change_seq = self.CHANGE_SEQUENCE.next_value()
         return super(Contact, self).save(db_session, commit=commit)
 
     def delete(self, db_session, commit=True):
@@ -72,15 +108,7 @@ class Contact(AppDeclBase, BaseModel):
             client=None, client_id=None,
             device_data=None
     ):
-        if (
-                client is not None and (
-                    not client.has_sbtelecom_operator or (
-                        not client.get_data('caller_login') and
-                        not client.get_data('caller_login_s') and
-                        not client.get_data('caller_login_h')
-                    )
-                )
-        ):
+        if client is not None and not cls._is_caller_client(client):
             return False
 
         if client is None:
@@ -93,14 +121,7 @@ class Contact(AppDeclBase, BaseModel):
                 Client_lk.operator.in_(Client_lk.sbTELECOM_OPERATORS)
             ).filter_by(number=client_id).first()
 
-            if (
-                    client is None or
-                    not client.has_sbtelecom_operator or (
-                        not client.get_data('caller_login') and
-                        not client.get_data('caller_login_s') and
-                        not client.get_data('caller_login_h')
-                    )
-            ):
+            if client is None or not cls._is_caller_client(client):
                 return False
 
         if device_data is not None:
@@ -116,39 +137,277 @@ class Contact(AppDeclBase, BaseModel):
         return calls_available
 
     @classmethod
-    def update(cls, db_session, number, **kwargs):
-        update_data = dict()
-        filters = []
-
-        number = number and normalize_number_to_msisdn(unicode(number))
-        if not number:
-            raise ValueError(u'need valid number')
+    def calls_available_for_clients(cls, db_session, numbers):
+        u"""
+        calls_available_for_client для списка номеров за два запроса
+        (на каждые IN_CHUNK_SIZE номеров)
+        -> set номеров (в том виде, в каком переданы), кому доступны звонки
+        """
+        numbers_by_client_id = {}
+        for number in numbers:
+            client_id = number and normalize_number_to_number(unicode(number))
+            if client_id:
+                numbers_by_client_id.setdefault(client_id, []).append(number)
+
+        caller_ids = []
+        client_ids = list(numbers_by_client_id)
+        for i in xrange(0, len(client_ids), cls.IN_CHUNK_SIZE):
+            caller_ids.extend(
+                client.number for client in db_session.query(Client_lk).filter(
+                    Client_lk.operator.in_(Client_lk.sbTELECOM_OPERATORS),
+                    Client_lk.number.in_(client_ids[i:i + cls.IN_CHUNK_SIZE]),
+                ) if cls._is_caller_client(client)
+            )
+
+        available = set()
+        for i in xrange(0, len(caller_ids), cls.IN_CHUNK_SIZE):
+            for (client_id, ) in db_session.query(DeviceData.client_id).filter(
+                DeviceData.client_id.in_(caller_ids[i:i + cls.IN_CHUNK_SIZE]),
+                sql_or(
+                    DeviceData.os == 'android',
+                    DeviceData.os == 'ios'
+                ),
+            ).group_by(DeviceData.client_id):
+                available.update(numbers_by_client_id.get(client_id, ()))
+        return available
+
+    @staticmethod
+    def _is_caller_client(client):
+        return client.has_sbtelecom_operator and bool(
+            client.get_data('caller_login') or
+            client.get_data('caller_login_s') or
+            client.get_data('caller_login_h')
+        )
 
-        if kwargs.get('calls_available') is not None:
-            update_data['calls_available'] = kwargs['calls_available']
-            filters.append(Contact.calls_available != bool(update_data['calls_available']))
+    @classmethod
+    def upsert_many(cls, db_session, client_id, contacts, device_uid=None, commit=True):
+        u"""
+        Добавляет или обновляет контакты клиента одним INSERT ... ON CONFLICT
+        (на Oracle - MERGE через executemany) на IN_CHUNK_SIZE номеров:
+
+            Contact.upsert_many(db_session, '79581234567', [
+                ('79581234568', {'operator': 'sbt', 'region': 77,
+                                 'calls_available': True, 'info': u'Иван'}),
+            ], device_uid=device.device_id)
+
+        Как save() для каждого контакта: device_uid ставится, только если
+        пустой, info - только непустой, удалённые контакты восстанавливаются.
+        -> количество добавленных и изменённых контактов
+        """
+        utcnow = datetime.datetime.utcnow()
+        rows = []
+        for number, fields in contacts:
+            info = fields.get('info')
+            rows.append({
+                'client_id': client_id,
+                'number': number,
+                'device_uid': device_uid,
+                'operator': fields.get('operator'),
+                'region': fields.get('region'),
+                'calls_available': bool(fields.get('calls_available')),
+                'data': {'info': info} if info else {},
+                'created': utcnow,
+                'updated': utcnow,
+            })
+
+        upsert_chunk = (
+            cls._upsert_many_merge if IS_ORACLE_DB
+            else cls._upsert_many_insert
+        )
+        upserted = 0
+        for i in xrange(0, len(rows), cls.IN_CHUNK_SIZE):
+            upserted += upsert_chunk(db_session, rows[i:i + cls.IN_CHUNK_SIZE])
+
+        commit and db_session.commit()
+        return upserted
 
-        if kwargs.get('operator') is not None:
-            update_data['operator'] = kwargs['operator']
-            filters.append(Contact.operator != update_data['operator'])
+    @classmethod
+    def _upsert_many_insert(cls, db_session, rows):
+        table = cls.__table__
+        statement = pg_insert(table).values(rows)
+        excluded = statement.excluded
+        statement = statement.on_conflict_do_update(
+            index_elements=[table.c.client_id, table.c.number],
+            set_={
+                'device_uid': sql_func.coalesce(
+                    sql_func.nullif(table.c.device_uid, ''),
+                    excluded.device_uid,
+                    table.c.device_uid,
+                ),
+                'operator': excluded.operator,
+                'region': excluded.region,
+                'calls_available': excluded.calls_available,
+                'data': sql_func.coalesce(table.c.data, excluded.data).op('||')(
+                    excluded.data
+                ),
+                'updated': excluded.updated,
+                'deleted': None,
+                'change_seq': cls.CHANGE_SEQUENCE.next_value(),
+            },
+        )
+        return db_session.execute(statement).rowcount
+
+    UPSERT_MANY_MERGE_SQL = u'''
+        MERGE INTO contacts c
+        USING (SELECT :b_client_id AS client_id, :b_number AS number_ FROM dual) v
+        ON (c.client_id = v.client_id AND c.number_ = v.number_)
+        WHEN MATCHED THEN UPDATE SET
+            device_uid = coalesce(c.device_uid, :b_device_uid),
+            operator = :b_operator,
+            region = :b_region,
+            calls_available = :b_calls_available,
+            data = json_mergepatch(coalesce(c.data, '{}'), :b_data),
+            updated = :b_updated,
+            deleted = NULL,
+            change_seq = contacts_change_seq.NEXTVAL
+        WHEN NOT MATCHED THEN INSERT (
+            id, device_uid, client_id, number_, operator, region,
+            calls_available, data, created, updated
+        ) VALUES (
+            :b_id, :b_device_uid, v.client_id, v.number_, :b_operator, :b_region,
+            :b_calls_available, :b_data, :b_created, :b_updated
+        )
+    '''
 
-        if kwargs.get('region') is not None:
-            update_data['region'] = kwargs['region']
-            filters.append(Contact.region != update_data['region'])
+    @classmethod
+    def _upsert_many_merge(cls, db_session, rows):
+        # id на Oracle без последовательности, как в BaseModel.save
+        contact_id = int(time.time()) % 2147483647
+        params = [dict(
+            ('b_' + key, value) for key, value in row.items()
+        ) for row in rows]
+        for row in params:
+            row.update(
+                b_id=contact_id,
+                b_calls_available=int(row['b_calls_available']),
+                b_data=json.dumps(row['b_data']),
+            )
+
+        try:
+            with db_session.begin_nested():
+                return db_session.execute(
+                    sql_text(cls.UPSERT_MANY_MERGE_SQL), params
+                ).rowcount
+        except IntegrityError:
+            # контакт успел добавить параллельный запрос, теперь он обновится
+            with db_session.begin_nested():
+                return db_session.execute(
+                    sql_text(cls.UPSERT_MANY_MERGE_SQL), params
+                ).rowcount
+
+    UPDATE_FIELDS = ('operator', 'region', 'calls_available')
 
-        if update_data:
-            update_data['updated'] = datetime.datetime.utcnow()
+    @classmethod
+    def update(cls, db_session, number, **kwargs):
+        number = number and normalize_number_to_msisdn(unicode(number))
+        if not number:
+            raise ValueError(u'need valid number')
 
-            db_query = db_session.query(cls).filter_by(number=number)
+        fields = dict(
+            (key, kwargs[key]) for key in cls.UPDATE_FIELDS
+            if kwargs.get(key) is not None
+        )
+        if not fields:
+            return False
 
-            if len(filters) == 1:
-                db_query = db_query.filter(filters[0])
+        cls.update_many(db_session, [(number, fields)])
+        return True
 
-            elif len(filters) > 1:
-                db_query = db_query.filter(sql_or(*filters))
+    @classmethod
+    def update_many(cls, db_session, changes, commit=True):
+        u"""
+        Contact.update для многих номеров, одним UPDATE на IN_CHUNK_SIZE номеров:
+
+            Contact.update_many(db_session, [
+                ('79581234567', {'operator': 'sbt', 'region': 77}),
+                ('79581234568', {'calls_available': False}),
+            ])
+
+        Поля со значением None не меняются; строки, где ничего
+        не поменялось, не трогаются. -> количество изменённых контактов
+        """
+        rows = OrderedDict()
+        for number, fields in changes:
+            number = number and normalize_number_to_msisdn(unicode(number))
+            if not number:
+                continue
+            calls_available = fields.get('calls_available')
+            rows[number] = {
+                'b_number': number,
+                'b_operator': fields.get('operator'),
+                'b_region': fields.get('region'),
+                'b_calls_available': (
+                    None if calls_available is None else bool(calls_available)
+                ),
+            }
+        rows = rows.values()
+
+        update_chunk = (
+            cls._update_many_executemany if IS_ORACLE_DB
+            else cls._update_many_values
+        )
+        updated = 0
+        for i in xrange(0, len(rows), cls.IN_CHUNK_SIZE):
+            updated += update_chunk(db_session, rows[i:i + cls.IN_CHUNK_SIZE])
+
+        commit and db_session.commit()
+        return updated
+
+    UPDATE_MANY_VALUES_SQL = u'''
+        UPDATE contacts SET
+            operator = coalesce(v.operator, contacts.operator),
+            region = coalesce(v.region, contacts.region),
+            calls_available = coalesce(v.calls_available, contacts.calls_available),
+            updated = :updated,
+            change_seq = nextval('contacts_change_seq')
+        FROM (VALUES {values}) AS v (number, operator, region, calls_available)
+        WHERE contacts.number = v.number AND (
+            contacts.operator IS DISTINCT FROM coalesce(v.operator, contacts.operator) OR
+            contacts.region IS DISTINCT FROM coalesce(v.region, contacts.region) OR
+            contacts.calls_available IS DISTINCT FROM
+                coalesce(v.calls_available, contacts.calls_available)
+        )
+    '''
 
-            db_query.update(update_data, synchronize_session='fetch')
-            db_session.commit()
+    @classmethod
+    def _update_many_values(cls, db_session, rows):
+        params = {'updated': datetime.datetime.utcnow()}
+        values = []
+        for i, row in enumerate(rows):
+            values.append(
+                '(:n{0}, CAST(:o{0} AS VARCHAR), '
+                'CAST(:r{0} AS INTEGER), CAST(:c{0} AS BOOLEAN))'.format(i)
+            )
+            params.update({
+                'n{}'.format(i): row['b_number'],
+                'o{}'.format(i): row['b_operator'],
+                'r{}'.format(i): row['b_region'],
+                'c{}'.format(i): row['b_calls_available'],
+            })
+        return db_session.execute(sql_text(
+            cls.UPDATE_MANY_VALUES_SQL.format(values=', '.join(values))
+        ), params).rowcount
 
-            return True
-        return False
+    @classmethod
+    def _update_many_executemany(cls, db_session, rows):
+        changed = []
+        for column in ('operator', 'region', 'calls_available'):
+            param = bindparam('b_' + column, type_=cls.__table__.c[column].type)
+            changed.append(sql_and(param != None, sql_or(
+                cls.__table__.c[column] == None,
+                cls.__table__.c[column] != param,
+            )))
+
+        statement = cls.__table__.update().where(sql_and(
+            cls.number == bindparam('b_number'),
+            sql_or(*changed),
+        )).values({
+            cls.operator: sql_func.coalesce(bindparam('b_operator'), cls.operator),
+            cls.region: sql_func.coalesce(bindparam('b_region'), cls.region),
+            cls.calls_available: sql_func.coalesce(
+                bindparam('b_calls_available'), cls.calls_available
+            ),
+            cls.updated: datetime.datetime.utcnow(),
+            cls.change_seq: cls.CHANGE_SEQUENCE.next_value(),
+        })
+        return db_session.execute(statement, list(rows)).rowcount
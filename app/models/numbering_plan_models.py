@@ -0,0 +1,38 @@
+# -*- encoding: utf-8 -*-
+
+import datetime
+
+from sqlalchemy import (
+    Column,
+    BigInteger, Integer, String, DateTime,
+)
+
+from app.models.mixins import (
+    AppDeclBase, BaseModel
+)
+from app_utils.db_utils import IS_ORACLE_DB
+
+
+__all__ = ('NumberingPlanRange',)
+
+
+class NumberingPlanRange(AppDeclBase, BaseModel):
+    u"""
+    Диапазон номеров плана нумерации (DEF-код + номер, 10 цифр)
+    с уже посчитанными region/operator в терминах get_reg_op.
+    """
+    __tablename__ = "numbering_plan_ranges"
+
+    IN_CHUNK_SIZE = 1000  # Oracle: не больше 1000 значений в IN
+
+    NO_ID_SEQUENCE = True
+    id = Column(Integer, primary_key=True, autoincrement=(not IS_ORACLE_DB))
+
+    number_from = Column(BigInteger, primary_key=IS_ORACLE_DB, index=True)
+    number_to = Column(BigInteger)
+
+    region = Column(Integer)
+    operator = Column(String(64))
+
+    created = Column(DateTime, default=datetime.datetime.utcnow)
+    deleted = Column(DateTime)
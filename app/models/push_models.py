@@ -1,23 +1,201 @@
 # -*- encoding: utf-8 -*-
 
 import datetime
+import re
 import traceback
 from collections import defaultdict
-from itertools import groupby, izip
+from itertools import izip
 
+from app.api.fcm_dispatcher import FcmDispatcher
+from app.models.active_device_client import ActiveDeviceClient, ActiveDeviceWiFi
 from app.models.mixins import AppDeclBase, BaseModel, jsonb_property
-from app_models import DeviceData, PushLog
-from app_utils.db_utils import IS_ORACLE_DB
+from app_models import Client_lk, DeviceData, PushLog, UserInfo
+from app_utils.db_utils import IS_ORACLE_DB, create_dbsession
 from app_utils.db_utils.models import JSONB
-from app_utils.fcm_utils import fcm, send_pushs
+from app_utils.fcm_utils import fcm
 from app_utils.wrappers import memorizing
-from sqlalchemy import Boolean, Column, DateTime, Integer, String
+from sqlalchemy import Boolean, Column, DateTime, Index, Integer, String, and_, case, exists, func
+from sqlalchemy.orm import aliased
 
 __all__ = (
+    'PushAudience',
+    'PushPartition',
     'PushSchedule',
+    'PushScheduleRecipient',
+    'PushScheduleBatch',
 )
 
 
+def _device_json_column(key):
+    if IS_ORACLE_DB:
+        return func.json_value(DeviceData.data, '$.{}'.format(key))
+    return DeviceData.data.op('->>')(key)
+
+
+VERSION_PART_WIDTH = 8
+VERSION_EXP = re.compile(r'^\d+(\.\d+)*')
+
+
+def version_key(version):
+    u"""'1.18.2-beta' -> '00000001.00000018.00000002', строки сравниваются как версии"""
+    version = VERSION_EXP.match(unicode(version or ''))
+    if version is None:
+        raise ValueError(u'wrong app version')
+    return u'.'.join(
+        part.zfill(VERSION_PART_WIDTH) for part in version.group(0).split('.')
+    )
+
+
+def _app_version_key_column():
+    u"""version_key(DeviceData.data.app_version) в SQL"""
+    app_version = _device_json_column('app_version')
+    pad = r'{}\1'.format('0' * VERSION_PART_WIDTH)
+    trim = r'0*(\d{{{}}})'.format(VERSION_PART_WIDTH)
+    if IS_ORACLE_DB:
+        numeric = func.regexp_substr(app_version, r'^\d+(\.\d+)*')
+        return func.regexp_replace(func.regexp_replace(numeric, r'(\d+)', pad), trim, r'\1')
+    numeric = func.substring(app_version, r'^\d+(?:\.\d+)*')
+    return func.regexp_replace(
+        func.regexp_replace(numeric, r'(\d+)', pad, 'g'), trim, r'\1', 'g'
+    )
+
+
+class PushAudience(object):
+    u"""
+    Описание аудитории рассылки вместо списка id устройств:
+
+        {
+            "operators": [...], "regions": [...], "os": ["ios", "android"],
+            "app_version_from": "1.18", "app_version_to": "2.0",
+            "tariffs": [...],           # UserInfo.name последней записи абонента
+            "wifi_calls": true,         # включены WiFi Звонки на устройстве
+            "last_seen_days": 90,       # ActiveDeviceClient.last_seen не раньше
+        }
+
+    Все условия необязательные и объединяются через И. Спецификация
+    собирается в один запрос по DeviceData, который читается по id
+    устройства; версия приложения сравнивается в SQL (version_key),
+    поэтому count_audience считает ровно тех, кому уйдёт рассылка.
+    """
+
+    FIELDS = (
+        'operators', 'regions', 'os',
+        'app_version_from', 'app_version_to',
+        'tariffs', 'wifi_calls', 'last_seen_days',
+    )
+
+    def __init__(self, spec):
+        unknown = set(spec or {}) - set(self.FIELDS)
+        if unknown:
+            raise ValueError(u'unknown audience fields: {}'.format(
+                u', '.join(sorted(unknown))
+            ))
+        self.spec = dict(spec or {})
+        for key in ('app_version_from', 'app_version_to'):
+            if self.spec.get(key):
+                version_key(self.spec[key])
+
+    def __nonzero__(self):
+        return bool(self.spec)
+
+    def get(self, key, default=None):
+        return self.spec.get(key, default)
+
+    def query(self, db_session, *columns):
+        u"""Устройства аудитории с fcm-токеном, привязанные к абоненту"""
+        fcm_token = _device_json_column('fcm_token')
+        active_device = [
+            ActiveDeviceClient.device_id == DeviceData.id,
+            ActiveDeviceClient.client_id == DeviceData.client_id,
+            ActiveDeviceClient.deleted == None,
+        ]
+        if self.get('last_seen_days'):
+            active_device.append(
+                ActiveDeviceClient.last_seen >= datetime.datetime.utcnow() - datetime.timedelta(
+                    days=self.get('last_seen_days')
+                )
+            )
+        query = db_session.query(*columns).filter(
+            fcm_token != None,
+            exists().where(and_(*active_device)),
+        )
+
+        if self.get('os'):
+            query = query.filter(DeviceData.os.in_(self.get('os')))
+
+        if self.get('operators') or self.get('regions'):
+            conditions = [Client_lk.number == DeviceData.client_id]
+            if self.get('operators'):
+                conditions.append(Client_lk.operator.in_(self.get('operators')))
+            if self.get('regions'):
+                conditions.append(Client_lk.region.in_(self.get('regions')))
+            query = query.filter(exists().where(and_(*conditions)))
+
+        if self.get('tariffs'):
+            # абоненты, у которых последняя запись UserInfo с нужным тарифом:
+            # некоррелированный подзапрос считается один раз на всю рассылку
+            newer_info = aliased(UserInfo)
+            tariff_clients = db_session.query(UserInfo.client_id).filter(
+                UserInfo.name.in_(self.get('tariffs')),
+                ~exists().where(and_(
+                    newer_info.client_id == UserInfo.client_id,
+                    newer_info.id > UserInfo.id,
+                )),
+            )
+            query = query.filter(DeviceData.client_id.in_(tariff_clients.subquery()))
+
+        if self.get('wifi_calls') is not None:
+            wifi_calls = exists().where(and_(
+                ActiveDeviceWiFi.device_id == DeviceData.id,
+                ActiveDeviceWiFi.deleted == None,
+            ))
+            query = query.filter(wifi_calls if self.get('wifi_calls') else ~wifi_calls)
+
+        if self.get('app_version_from') or self.get('app_version_to'):
+            app_version = _app_version_key_column()
+            if self.get('app_version_from'):
+                query = query.filter(app_version >= version_key(self.get('app_version_from')))
+            if self.get('app_version_to'):
+                query = query.filter(app_version <= version_key(self.get('app_version_to')))
+
+        return query
+
+
+class PushPartition(object):
+    u"""
+    Часть аудитории рассылки по регионам абонентов (Client_lk.region).
+    exclude_regions - всё, кроме перечисленных регионов, включая
+    абонентов без Client_lk.
+    """
+
+    def __init__(self, key, regions=None, exclude_regions=None, timezone=None):
+        self.key = unicode(key)
+        self.regions = regions and list(regions)
+        self.exclude_regions = exclude_regions and list(exclude_regions)
+        self.timezone = timezone
+
+    def as_dict(self):
+        return {
+            'key': self.key,
+            'regions': self.regions,
+            'exclude_regions': self.exclude_regions,
+            'timezone': self.timezone,
+        }
+
+    def filter(self, query, client_id=DeviceData.client_id):
+        if self.regions is not None:
+            query = query.filter(exists().where(and_(
+                Client_lk.number == client_id,
+                Client_lk.region.in_(self.regions),
+            )))
+        if self.exclude_regions:
+            query = query.filter(~exists().where(and_(
+                Client_lk.number == client_id,
+                Client_lk.region.in_(self.exclude_regions),
+            )))
+        return query
+
+
 class PushSchedule(BaseModel, AppDeclBase):
     __tablename__ = 'pushes_shedule'
 
@@ -46,10 +224,27 @@ class PushSchedule(BaseModel, AppDeclBase):
     count_success = jsonb_property('stats', 'count_success', int)
     count_failed = jsonb_property('stats', 'count_failed', int)
 
+    # перенесено в PushScheduleRecipient, остаётся для старых рассылок
     _devices_to_send = jsonb_property('data', 'devices_to_send', list)
     devices_success = jsonb_property('data', 'devices_success', list)
     devices_failed = jsonb_property('data', 'devices_failed', dict)
 
+    # id последнего обработанного PushScheduleRecipient
+    # (или DeviceData, если рассылка идёт по audience)
+    recipients_cursor = jsonb_property('data', 'recipients_cursor', int)
+
+    audience_spec = jsonb_property('data', 'audience', dict)
+
+    # {partition_key: {"cursor": id, "done": bool}} при отправке по часовым поясам
+    partitions = jsonb_property('data', 'partitions', dict)
+    # [PushPartition.as_dict(), ...], состав частей фиксируется при первом запуске,
+    # чтобы новые регионы Client_lk не меняли уже начатые части
+    partition_plan = jsonb_property('data', 'partition_plan', list)
+
+    max_sends_per_sec = jsonb_property('data', 'max_sends_per_sec', int)
+
+    RECIPIENTS_STEP = fcm.FCM_MAX_RECIPIENTS
+
     @property
     @memorizing
     def push_data(self):
@@ -58,107 +253,352 @@ class PushSchedule(BaseModel, AppDeclBase):
             data["url"] = self.link
         return data
 
+    @property
+    def audience(self):
+        return PushAudience(self.audience_spec)
+
+    @audience.setter
+    def audience(self, audience):
+        if not isinstance(audience, PushAudience):
+            audience = PushAudience(audience)
+        self.audience_spec = audience.spec
+
     @property
     def devices_to_send(self):
         return self._devices_to_send
 
     @devices_to_send.setter
     def devices_to_send(self, devices_to_send):
+        u"""До первой отправки id устройств хранятся в data, потом в PushScheduleRecipient"""
         if not self.progress_total:
             self.progress_total = len(devices_to_send)
         self._devices_to_send = devices_to_send
 
-    def send(self, db_session):
+    @property
+    def push_log_data(self):
+        u"""
+        Текст пуша хранится в рассылке, PushLog ссылается на неё по id:
+        {"push_schedule_id": id} -> PushSchedule.title/message/push_data
+        """
+        return {"push_schedule_id": self.id}
+
+    def add_recipients(self, db_session, device_ids, commit=True):
+        if self.id is None:
+            self.save(db_session, commit=False)
+            db_session.flush()
+
+        device_ids = list(device_ids)
+        for i in xrange(0, len(device_ids), self.RECIPIENTS_STEP):
+            db_session.execute(PushScheduleRecipient.__table__.insert(), [
+                {'push_schedule_id': self.id, 'device_id': device_id}
+                for device_id in device_ids[i:i + self.RECIPIENTS_STEP]
+            ])
+        self.progress_total = self.progress_total + len(device_ids)
+        self.save(db_session, commit=commit)
+
+    def _migrate_devices_to_send(self, db_session):
+        devices_to_send = self._devices_to_send
+        if not devices_to_send:
+            return
+
+        # результаты уже сделанных отправок переносим одной пачкой
+        devices_failed = dict(
+            (device_id, result)
+            for device_id, result in self.devices_failed.items() if device_id
+        )
+        if devices_failed or self.devices_success:
+            PushScheduleBatch(
+                push_schedule_id=self.id,
+                failed=devices_failed,
+            ).save(db_session, commit=False)
+        del self.devices_success
+        del self.devices_failed
+
+        progress_total = self.progress_total
+        del self._devices_to_send
+        self.add_recipients(db_session, devices_to_send, commit=False)
+        self.progress_total = progress_total or len(devices_to_send)
+        self.save(db_session)
+
+    def is_expired(self, utcnow=None):
+        utcnow = utcnow or datetime.datetime.utcnow()
+        return self.created < utcnow - datetime.timedelta(days=2)
+
+    def get_dispatcher(self):
+        return FcmDispatcher(max_sends_per_sec=self.max_sends_per_sec)
+
+    def get_cursor(self, partition=None):
+        if partition is None:
+            return self.recipients_cursor
+        return self.partitions.get(partition.key, {}).get('cursor', 0)
+
+    def set_cursor(self, cursor, partition=None, done=None):
+        if partition is None:
+            self.recipients_cursor = cursor
+            return
+        partitions = dict(self.partitions)
+        state = dict(partitions.get(partition.key, {}))
+        state['cursor'] = cursor
+        if done is not None:
+            state['done'] = done
+        partitions[partition.key] = state
+        self.partitions = partitions
+
+    def is_partition_done(self, partition):
+        return self.partitions.get(partition.key, {}).get('done', False)
+
+    def get_partition_plan(self):
+        return [PushPartition(**partition) for partition in self.partition_plan]
+
+    def set_partition_plan(self, partitions):
+        self.partition_plan = [partition.as_dict() for partition in partitions]
+
+    def send(self, db_session, dispatcher=None, partition=None):
+        u"""
+        Отправка рассылки (или одной её части partition) до конца.
+        -> True, если всё отправлено
+        """
         utcnow = datetime.datetime.utcnow()
 
-        if self.created < utcnow - datetime.timedelta(days=2):
+        if self.is_expired(utcnow):
             self.completed = utcnow
             self.save(db_session)
-            return
+            return False
 
-        if not self.devices_success:
-            self.devices_success = ['']
-
-        if not self.devices_failed:
-            self.devices_failed = {'': ''}
-
-        STEP = 1000
-        devices_data = []
-        for i in range(0, len(self.devices_to_send) + STEP, STEP):
-            _devices_to_send = self.devices_to_send[i:i + STEP]
-            devices_data += (
-                _devices_to_send
-                and db_session.query(
-                    DeviceData.id,
-                    DeviceData.client_id,
-                    DeviceData.data,
-                ).filter(
-                    DeviceData.id.in_(_devices_to_send),
-                ).all()
-            )
+        self._migrate_devices_to_send(db_session)
+        if self.audience and not self.progress_total:
+            self.progress_total = self.count_audience(db_session)
+            self.save(db_session)
 
-        devices_data = [(did, cid, data['fcm_token'])
-            for (did, cid, data) in devices_data
-            if data and data.get('fcm_token')
-        ]
-        devices_data.sort(key=lambda (did, cid, fcmt): (
-            fcmt, -1 * did
-        ))
+        dispatcher = dispatcher or self.get_dispatcher()
+        sent_ranges = self._get_sent_ranges(db_session, partition)
+        pages = {}
+        sent = {}  # page_no -> последний recipient_id отправленной страницы
+        next_page = 0
+        failed = []
 
-        fcm_token_devices = defaultdict(list)
-        device_client_ids = {}
-        for (did, cid, fcmt) in devices_data:
-            fcm_token_devices[fcmt].append(did)
-            device_client_ids[did] = cid
+        def batches():
+            for page_no, page in enumerate(self._iter_pages(partition, sent_ranges)):
+                if failed:
+                    return
+                pages[page_no] = page
+                yield page_no, page[1].keys()
 
-        fcm_tokens = fcm_token_devices.keys()
-        for idx in xrange(0, len(fcm_tokens), fcm.FCM_MAX_RECIPIENTS):
-            _fcm_tokens = fcm_tokens[idx:(idx + fcm.FCM_MAX_RECIPIENTS)]
-
-            try:
-                _, response = send_pushs(
-                    self.title, self.message,
-                    _fcm_tokens,
-                    data=self.push_data,
-                )
-                resp = response[0]
-            except:
+        # после ошибки новые страницы не отправляются, но ответы уже
+        # отправленных дожидаются и сохраняются вместе с PushScheduleBatch:
+        # курсор встаёт перед упавшей страницей, а следующий запуск
+        # пропускает получателей из сохранённых после неё диапазонов
+        for page_no, response, error in dispatcher.dispatch(
+                batches(), self.title, self.message, data=self.push_data,
+        ):
+            page = pages.pop(page_no)
+            if error is not None:
+                print('PushSchedule.send({}): {}'.format(self.id, error))
+                failed.append(page_no)
                 continue
 
-            self.count_success = self.count_success + resp['success']
-            self.count_failed = self.count_failed + resp['failure']
-
-            device_to_remove = set([])
-            for fcm_token, result in izip(_fcm_tokens, resp['results']):
-                device_ids = fcm_token_devices[fcm_token]
-                device_to_remove.update(device_ids)
-
-                if 'error' in result:
-                    for device_id in device_ids:
-                        self.devices_failed[device_id] = result
-                else:
-                    self.devices_success += device_ids
-                    for device_id in device_ids:
-                        db_session.add(PushLog(
-                            client_id=device_client_ids[device_id],
-                            data={
-                                "title": self.title,
-                                "message": self.message,
-                                "data": self.push_data
-                            }
-                        ))
-
-            self.progress_current = (
-                self.progress_current +
-                len(device_to_remove)
-            )
-            self.devices_to_send = list(
-                set(self.devices_to_send) -
-                device_to_remove
-            )
+            self._store_page(db_session, page, response, partition)
+            sent[page_no] = page[0][-1]
+            while next_page in sent:
+                self.set_cursor(sent.pop(next_page), partition)
+                next_page += 1
             self.save(db_session)
 
-        if not self.devices_to_send:
-            self.completed = utcnow
+        if failed:
+            return False
 
+        if partition is None:
+            self.completed = utcnow
+        else:
+            self.set_cursor(self.get_cursor(partition), partition, done=True)
         self.save(db_session)
+        return True
+
+    STREAM_YIELD_PER = 1000
+
+    def _get_sent_ranges(self, db_session, partition=None):
+        u"""
+        -> [(recipient_id_from, recipient_id_to), ...] страниц после курсора,
+        которые уже отправлены (их сохранили, пока ждали ответа на упавшую)
+        """
+        partition_key = partition and partition.key
+        return sorted(
+            (batch.recipient_id_from, batch.recipient_id_to)
+            for batch in db_session.query(PushScheduleBatch).filter(
+                PushScheduleBatch.push_schedule_id == self.id,
+                PushScheduleBatch.recipient_id_to > self.get_cursor(partition),
+            )
+            # jsonb_property отдаёт '' вместо отсутствующего ключа
+            if (batch.partition or None) == partition_key
+        )
+
+    def _iter_pages(self, partition=None, sent_ranges=()):
+        u"""
+        -> ([recipient_id, ...], {fcm_token: [device_id, ...]}, {device_id: client_id})
+        по RECIPIENTS_STEP получателей после курсора (общего или partition),
+        кроме попавших в sent_ranges
+
+        Получатели читаются одним потоковым запросом в отдельной сессии,
+        из DeviceData.data берётся только fcm_token. Повторы fcm-токена
+        по всей рассылке отсекает сам запрос (_recipients_query), так что
+        память не растёт с размером аудитории.
+        """
+        audience = self.audience
+        sent_ranges = list(sent_ranges)
+        stream_session = create_dbsession()
+        try:
+            rows = self._recipients_query(
+                stream_session, audience, partition
+            ).execution_options(
+                stream_results=True
+            ).yield_per(self.STREAM_YIELD_PER)
+
+            recipient_ids = []
+            fcm_token_devices = defaultdict(list)
+            device_client_ids = {}
+            for (rid, did, cid, fcmt) in rows:
+                while sent_ranges and sent_ranges[0][1] < rid:
+                    sent_ranges.pop(0)
+                if sent_ranges and sent_ranges[0][0] <= rid:
+                    continue
+
+                recipient_ids.append(rid)
+                if fcmt:
+                    fcm_token_devices[fcmt].append(did)
+                    device_client_ids[did] = cid
+
+                if len(recipient_ids) >= self.RECIPIENTS_STEP:
+                    yield recipient_ids, fcm_token_devices, device_client_ids
+                    recipient_ids = []
+                    fcm_token_devices = defaultdict(list)
+                    device_client_ids = {}
+
+            if recipient_ids:
+                yield recipient_ids, fcm_token_devices, device_client_ids
+        finally:
+            stream_session.close()
+
+    def _recipients_query(self, db_session, audience, partition=None):
+        u"""
+        -> query (recipient_id, device_id, client_id, fcm_token)
+
+        fcm_token отдаётся только у первого получателя с этим токеном по
+        всей рассылке (ROW_NUMBER по токену); у остальных он NULL, и пуш
+        им не уходит. Нумерация считается до курсора и до деления на
+        части, поэтому повтор не отправляется и в следующем запуске
+        или в другой части.
+        """
+        cursor = self.get_cursor(partition)
+        fcm_token = _device_json_column('fcm_token')
+        if audience:
+            recipient_id = DeviceData.id
+            query = audience.query(
+                db_session,
+                recipient_id.label('recipient_id'),
+                DeviceData.id.label('device_id'),
+            )
+        else:
+            recipient_id = PushScheduleRecipient.id
+            query = db_session.query(
+                recipient_id.label('recipient_id'),
+                PushScheduleRecipient.device_id.label('device_id'),
+            ).outerjoin(
+                DeviceData, DeviceData.id == PushScheduleRecipient.device_id,
+            ).filter(
+                PushScheduleRecipient.push_schedule_id == self.id,
+            )
+        recipients = query.add_columns(
+            DeviceData.client_id.label('client_id'),
+            fcm_token.label('fcm_token'),
+            func.row_number().over(
+                partition_by=fcm_token, order_by=recipient_id,
+            ).label('token_rank'),
+        ).subquery()
+
+        query = db_session.query(
+            recipients.c.recipient_id,
+            recipients.c.device_id,
+            recipients.c.client_id,
+            case(
+                [(recipients.c.token_rank == 1, recipients.c.fcm_token)]
+            ).label('fcm_token'),
+        ).filter(
+            recipients.c.recipient_id > cursor,
+        ).order_by(recipients.c.recipient_id)
+
+        if partition is not None:
+            query = partition.filter(query, recipients.c.client_id)
+        return query
+
+    def count_audience(self, db_session):
+        u"""Размер аудитории для progress_total"""
+        return self.audience.query(
+            db_session, func.count(DeviceData.id)
+        ).scalar()
+
+    def _store_page(self, db_session, page, resp, partition=None):
+        recipient_ids, fcm_token_devices, device_client_ids = page
+        fcm_tokens = fcm_token_devices.keys()
+
+        failed = {}
+        push_logs = []
+        for fcm_token, result in izip(fcm_tokens, resp['results']):
+            device_ids = fcm_token_devices[fcm_token]
+            if 'error' in result:
+                for device_id in device_ids:
+                    failed[device_id] = result
+            else:
+                push_logs.extend(
+                    {'client_id': device_client_ids[device_id], 'data': self.push_log_data}
+                    for device_id in device_ids
+                )
+
+        if push_logs:
+            db_session.execute(PushLog.__table__.insert(), push_logs)
+
+        PushScheduleBatch(
+            push_schedule_id=self.id,
+            recipient_id_from=recipient_ids[0],
+            recipient_id_to=recipient_ids[-1],
+            count_success=resp['success'],
+            count_failed=resp['failure'],
+            data={'failed': failed, 'partition': partition and partition.key},
+        ).save(db_session, commit=False)
+
+        self.count_success = self.count_success + resp['success']
+        self.count_failed = self.count_failed + resp['failure']
+        self.progress_current = self.progress_current + len(recipient_ids)
+
+
+class PushScheduleRecipient(BaseModel, AppDeclBase):
+    __tablename__ = 'pushes_shedule_recipients'
+    __table_args__ = (
+        Index(
+            'ix_pushes_shedule_recipients_schedule_id',
+            'push_schedule_id', 'id',
+        ),
+    )
+
+    id = Column(Integer, primary_key=True)
+    push_schedule_id = Column(Integer, nullable=False)
+    device_id = Column(Integer, nullable=False)
+
+
+class PushScheduleBatch(BaseModel, AppDeclBase):
+    u"""Результат отправки одного запроса в FCM"""
+    __tablename__ = 'pushes_shedule_batches'
+
+    id = Column(Integer, primary_key=True)
+    push_schedule_id = Column(Integer, index=True)
+    recipient_id_from = Column(Integer)
+    recipient_id_to = Column(Integer)
+
+    count_success = Column(Integer, default=0)
+    count_failed = Column(Integer, default=0)
+
+    data = Column(JSONB, default={})
+    failed = jsonb_property('data', 'failed', dict)
+    # PushPartition.key, если рассылка шла по частям
+    partition = jsonb_property('data', 'partition')
+
+    created = Column(DateTime, default=datetime.datetime.utcnow)
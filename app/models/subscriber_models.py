@@ -1,8 +1,12 @@
 # -*- encoding: utf-8 -*-
 
 import datetime
+import re
 
 from sqlalchemy import Column, Integer, String, DateTime
+from sqlalchemy import func as sql_func, or_ as sql_or
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import synonym
 from app_utils.db_utils import IS_ORACLE_DB
 from app_utils.db_utils.models import JSONB
@@ -15,6 +19,7 @@ from app_utils.wrappers import memorizing
 
 __all__ = (
     'Subscriber',
+    'SubscriberProfile',
 )
 
 
@@ -35,3 +40,129 @@ class Subscriber(AppDeclBase, BaseModel):
     msisdn = synonym('client_id')                                             # billing.msisdn
     clientId = synonym('subs_id')                                             # billing.clientId
     subscriberId = jsonb_property('data', 'subscriberId')                     # billing.subsId
+
+
+class SubscriberProfile(AppDeclBase, BaseModel):
+    u"""
+    Последние известные из биллинга ФИО и документ абонента.
+    Заполняется по ответам getContract и логина в биллинг,
+    чтобы не искать ФИО в HTTPLog.
+    """
+    __tablename__ = "subscriber_profiles"
+
+    SOURCE_CONTRACT = 'contract'
+    SOURCE_HTTP_LOG = 'http_log'
+
+    # через сколько снова искать ФИО, если в прошлый раз не нашли
+    EMPTY_FIO_TIMEOUT = datetime.timedelta(days=1)
+
+    # ФИО в HTTPLog.response лежит как repr питоновского dict
+    HTTP_LOG_FIO_EXP = re.compile(ur"'fio': u'([^']+)'", re.UNICODE)
+
+    NO_ID_SEQUENCE = True
+    id = Column(Integer, primary_key=True, autoincrement=(not IS_ORACLE_DB))
+    client_id = Column(String(30), primary_key=IS_ORACLE_DB, index=True, unique=True)
+
+    fio = Column(String(256))
+    doctype = Column(String(128))
+
+    data = Column(JSONB, default={})
+    source = jsonb_property('data', 'source')
+    sex = jsonb_property('data', 'sex')
+    citizenship = jsonb_property('data', 'citizenship')
+
+    created = Column(DateTime, default=datetime.datetime.utcnow)
+    updated = Column(DateTime, default=datetime.datetime.utcnow)
+
+    def save(self, db_session, commit=True):
+        self.updated = datetime.datetime.utcnow()
+        return super(SubscriberProfile, self).save(db_session, commit=commit)
+
+    @property
+    def is_actual(self):
+        return bool(self.fio) or (
+            self.updated is not None and
+            self.updated + self.EMPTY_FIO_TIMEOUT > datetime.datetime.utcnow()
+        )
+
+    @classmethod
+    def get(cls, db_session, client_id):
+        return db_session.query(cls).filter_by(client_id=client_id).first()
+
+    @classmethod
+    def store(cls, db_session, client_id, fio, source, commit=True, **data):
+        u"""
+        Сохраняет ФИО абонента. Пустое ФИО тоже сохраняется - это значит,
+        что его уже искали и не нашли, но уже найденное ФИО не затирает.
+
+        Пишет в savepoint, поэтому ошибка не ломает транзакцию вызывающего;
+        с commit=False коммитит вызывающий. Профиль, который параллельно
+        создал другой запрос, обновляется (ON CONFLICT / повтор на Oracle).
+        """
+        profile_data = dict(
+            (key, data[key]) for key in ('sex', 'citizenship') if data.get(key)
+        )
+        profile_data['source'] = source
+        values = {
+            'client_id': client_id,
+            'fio': fio or '',
+            'doctype': data.get('doctype') or None,
+            'data': profile_data,
+        }
+
+        if IS_ORACLE_DB:
+            try:
+                with db_session.begin_nested():
+                    cls._update_profile(db_session, values)
+            except IntegrityError:
+                # профиль успел создать параллельный запрос, теперь он найдётся
+                with db_session.begin_nested():
+                    cls._update_profile(db_session, values)
+        else:
+            with db_session.begin_nested():
+                db_session.execute(cls._upsert_statement(values))
+
+        if commit:
+            db_session.commit()
+
+    @classmethod
+    def _update_profile(cls, db_session, values):
+        profile = cls.get(db_session, values['client_id']) or cls(
+            client_id=values['client_id'], data={}
+        )
+        if profile.id is not None and not values['fio'] and profile.fio:
+            return
+
+        profile.fio = values['fio']
+        profile.doctype = values['doctype'] or profile.doctype
+        for key, value in values['data'].items():
+            setattr(profile, key, value)
+        profile.save(db_session, commit=False)
+
+    @classmethod
+    def _upsert_statement(cls, values):
+        table = cls.__table__
+        utcnow = datetime.datetime.utcnow()
+        statement = pg_insert(table).values(created=utcnow, updated=utcnow, **values)
+        excluded = statement.excluded
+        return statement.on_conflict_do_update(
+            index_elements=[table.c.client_id],
+            set_={
+                'fio': excluded.fio,
+                'doctype': sql_func.coalesce(excluded.doctype, table.c.doctype),
+                'data': sql_func.coalesce(table.c.data, excluded.data).op('||')(
+                    excluded.data
+                ),
+                'updated': excluded.updated,
+            },
+            where=sql_or(
+                excluded.fio != '',
+                table.c.fio == None,
+                table.c.fio == '',
+            ),
+        )
+
+    @classmethod
+    def parse_http_log_fio(cls, response):
+        fio = response and cls.HTTP_LOG_FIO_EXP.search(response)
+        return fio and fio.group(1).decode('unicode-escape') or None
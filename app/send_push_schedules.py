@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+
+import __import_utils__
+with __import_utils__.up_import(1):
+    from app_utils.db_utils import create_dbsession
+    from app.services import PushScheduler
+
+
+class SendPushSchedules(object):
+    u"""
+    Отправка запланированных рассылок, запускается по крону
+    (например, раз в 10 минут):
+
+        python send_push_schedules.py
+    """
+
+    def __init__(self, db_session=None):
+        self.db_session = db_session or create_dbsession()
+
+    def handler(self):
+        try:
+            PushScheduler(self.db_session).handler()
+        finally:
+            self.db_session.close()
+
+
+if __name__ == '__main__':
+    SendPushSchedules().handler()
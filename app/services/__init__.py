@@ -8,4 +8,12 @@ from app.services.need_update_app import *
 from banks import get_bank_name, check_account_number
 from app.services.mnp_auth import *
 from app.services.info_url import *
+from app.services.auth_context_cache import *
+from app.services.section_graph import *
+from app.services.userinfo_cache import *
+from app.services.numbering_plan import *
 
+from app.services.push_scheduler import *
+from app.services.msisdn_pool_index import *
+from app.services.msisdn_score import *
+from app.services.msisdn_reservation import *
@@ -0,0 +1,189 @@
+# -*- encoding: utf-8 -*-
+
+import cPickle as pickle
+
+import lazy_object_proxy
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session, object_session
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.session import make_transient_to_detached
+
+from app_models import Client_lk, ClientToken, DeviceData
+from app_utils.redis_utils import get_current_redis
+
+
+__all__ = ('AuthContextCache', )
+
+
+class AuthContextCache(object):
+    u"""
+    Кэш того, что BaseHandler достаёт по токену запроса:
+
+        cache:auth:token:{token}       -> колонки ClientToken
+        cache:auth:device:{token}      -> id последнего DeviceData
+        cache:auth:client:{client_id}  -> колонки Client_lk
+
+    Строки восстанавливаются в сессию через merge(load=False),
+    поэтому попадание в кэш не делает запросов в БД. Ключи изменённых
+    строк сбрасываются после коммита (invalidate_on_commit), иначе
+    параллельный запрос успел бы закэшировать ещё не закоммиченное.
+    """
+
+    redis_session = lazy_object_proxy.Proxy(get_current_redis)
+
+    CACHE_TOKEN_KEY_TEMPLATE = 'cache:auth:token:{token}'
+    CACHE_DEVICE_KEY_TEMPLATE = 'cache:auth:device:{token}'
+    CACHE_CLIENT_KEY_TEMPLATE = 'cache:auth:client:{client_id}'
+    CACHE_TIMEOUT = 5 * 60  # sec
+
+    SESSION_INFO_KEY = 'auth_context_cache_invalidate'
+
+    @classmethod
+    def get_token_key(cls, token):
+        return cls.CACHE_TOKEN_KEY_TEMPLATE.format(token=token)
+
+    @classmethod
+    def get_device_key(cls, token):
+        return cls.CACHE_DEVICE_KEY_TEMPLATE.format(token=token)
+
+    @classmethod
+    def get_client_key(cls, client_id):
+        return cls.CACHE_CLIENT_KEY_TEMPLATE.format(client_id=client_id)
+
+    @classmethod
+    def get_token_context(cls, db_session, token):
+        u"""-> (ClientToken | None, DeviceData.id | None)"""
+        try:
+            token_data, device_id = cls.redis_session.mget(
+                cls.get_token_key(token),
+                cls.get_device_key(token),
+            )
+        except Exception as err:
+            print('AuthContextCache.get_token_context: {}'.format(err))
+            return None, None
+
+        client_token = token_data and cls._load(
+            db_session, ClientToken, pickle.loads(token_data)
+        )
+        return client_token or None, device_id and int(device_id) or None
+
+    @classmethod
+    def set_client_token(cls, client_token):
+        cls._setex(cls.get_token_key(client_token.token), cls._dump(client_token))
+
+    @classmethod
+    def set_device_id(cls, token, device_id):
+        cls._setex(cls.get_device_key(token), device_id, need_pickle=False)
+
+    @classmethod
+    def get_client(cls, db_session, client_id):
+        try:
+            client_data = cls.redis_session.get(cls.get_client_key(client_id))
+        except Exception as err:
+            print('AuthContextCache.get_client: {}'.format(err))
+            return None
+        return client_data and cls._load(
+            db_session, Client_lk, pickle.loads(client_data)
+        ) or None
+
+    @classmethod
+    def set_client(cls, client):
+        cls._setex(cls.get_client_key(client.number), cls._dump(client))
+
+    @classmethod
+    def invalidate_tokens(cls, *tokens):
+        cls._delete(*[
+            key for token in tokens if token
+            for key in (cls.get_token_key(token), cls.get_device_key(token))
+        ])
+
+    @classmethod
+    def invalidate_devices(cls, *tokens):
+        cls._delete(*[cls.get_device_key(token) for token in tokens if token])
+
+    @classmethod
+    def invalidate_clients(cls, *client_ids):
+        cls._delete(*[
+            cls.get_client_key(client_id)
+            for client_id in client_ids if client_id
+        ])
+
+    @classmethod
+    def invalidate_on_commit(cls, db_session, *keys):
+        if db_session is None:
+            cls._delete(*keys)
+        else:
+            db_session.info.setdefault(cls.SESSION_INFO_KEY, set()).update(keys)
+
+    @classmethod
+    def _setex(cls, key, value, need_pickle=True):
+        if need_pickle:
+            value = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        try:
+            cls.redis_session.setex(key, cls.CACHE_TIMEOUT, value)
+        except Exception as err:
+            print('AuthContextCache.setex({}): {}'.format(key, err))
+
+    @classmethod
+    def _delete(cls, *keys):
+        if not keys:
+            return
+        try:
+            cls.redis_session.delete(*keys)
+        except Exception as err:
+            print('AuthContextCache.delete({}): {}'.format(keys, err))
+
+    @staticmethod
+    def _dump(instance):
+        return dict(
+            (attr.key, getattr(instance, attr.key))
+            for attr in inspect(instance).mapper.column_attrs
+        )
+
+    @staticmethod
+    def _load(db_session, model, row):
+        instance = inspect(model).class_manager.new_instance()
+        for key, value in row.items():
+            set_committed_value(instance, key, value)
+        make_transient_to_detached(instance)
+        return db_session.merge(instance, load=False)
+
+
+@event.listens_for(ClientToken, 'after_update', propagate=True)
+@event.listens_for(ClientToken, 'after_delete', propagate=True)
+def _invalidate_client_token(mapper, connection, target):
+    if target.token:
+        AuthContextCache.invalidate_on_commit(
+            object_session(target),
+            AuthContextCache.get_token_key(target.token),
+            AuthContextCache.get_device_key(target.token),
+        )
+
+
+@event.listens_for(Client_lk, 'after_update', propagate=True)
+@event.listens_for(Client_lk, 'after_delete', propagate=True)
+def _invalidate_client(mapper, connection, target):
+    if target.number:
+        AuthContextCache.invalidate_on_commit(
+            object_session(target),
+            AuthContextCache.get_client_key(target.number),
+        )
+
+
+@event.listens_for(DeviceData, 'after_insert', propagate=True)
+def _invalidate_device(mapper, connection, target):
+    if target.token:
+        AuthContextCache.invalidate_on_commit(
+            object_session(target),
+            AuthContextCache.get_device_key(target.token),
+        )
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_committed(db_session):
+    AuthContextCache._delete(*db_session.info.pop(AuthContextCache.SESSION_INFO_KEY, ()))
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_rolled_back(db_session):
+    db_session.info.pop(AuthContextCache.SESSION_INFO_KEY, None)
@@ -1,5 +1,6 @@
 # -*- encoding: utf-8 -*-
 
+from app.models import SubscriberProfile
 from app_sbtelecom.api.sbt_bercut_billing_api import SbtBercutBillingApi
 from app_regions.services import get_region_name_by_dt_id
 
@@ -8,7 +9,7 @@ __all__ = (
 )
 
 
-def get_subscriber_contract_data(client=None, number=None):
+def get_subscriber_contract_data(client=None, number=None, db_session=None):
     u"""
         return {
             fio: "Суй Во Чай",
@@ -24,10 +25,32 @@ def get_subscriber_contract_data(client=None, number=None):
             issued: "21.12.2112",
             address: "ул. Строителей,...",
         }
+
+    С db_session найденные ФИО и документ сохраняются в SubscriberProfile,
+    коммитит их вызывающий.
     """
 
+    number = (client and client.number) or number
     region = client and get_region_name_by_dt_id(client.region)
-    return _get_subscriber_contract_bercut_data((client and client.number) or number, region)
+    response = _get_subscriber_contract_bercut_data(number, region)
+
+    if db_session is not None and response.get('fio'):
+        _store_subscriber_profile(db_session, number, response)
+    return response
+
+
+def _store_subscriber_profile(db_session, number, contract_data):
+    try:
+        SubscriberProfile.store(
+            db_session, number, contract_data['fio'],
+            source=SubscriberProfile.SOURCE_CONTRACT,
+            doctype=contract_data.get('doctype'),
+            sex=contract_data.get('sex'),
+            citizenship=contract_data.get('citizenship'),
+            commit=False,
+        )
+    except Exception as err:
+        print('SubscriberProfile.store({}): {}'.format(number, err))
 
 
 BERCUT_GENDER_MAPPING = {
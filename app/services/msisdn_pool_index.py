@@ -0,0 +1,197 @@
+# -*- encoding: utf-8 -*-
+
+import re
+import threading
+import time
+from itertools import islice
+
+from concurrent.futures import ThreadPoolExecutor
+
+from app.services.msisdn_score import score_msisdn
+from mc_cache_msisdn_pool import get_cached_numbers_info
+
+
+__all__ = ('MsisdnPoolIndex', 'msisdn_pool_index')
+
+
+class _RegionIndex(object):
+
+    def __init__(self):
+        self.numbers = {}  # number -> (seq, tier, score)
+        self.grams = {}  # n-gram -> set(number)
+        self.listings = {}  # tier -> [number, ...] по убыванию красоты
+        self.seq = 0
+        self.updated = 0
+
+    def sort_key(self, number):
+        (seq, _, score) = self.numbers[number]
+        return -score, seq
+
+    def get_listing(self, tier):
+        tier = tier or '*'
+        listing = self.listings.get(tier)
+        if listing is None:
+            listing = self.listings[tier] = sorted((
+                number for number, (_, number_tier, _) in self.numbers.items()
+                if tier == '*' or number_tier == tier
+            ), key=self.sort_key)
+        return listing
+
+
+class MsisdnPoolIndex(object):
+    u"""
+    Поиск по кэшированному пулу номеров (get_cached_numbers_info)
+    в памяти процесса:
+
+        msisdn_pool_index.search(region, '777')      # подстрока
+        msisdn_pool_index.search(region, '958*12')   # * - любые цифры, ? - одна
+        msisdn_pool_index.listing(region, tier, offset, count)
+
+    Для каждого региона строится индекс цифровых n-грамм; кандидаты
+    берутся пересечением n-грамм из фрагментов маски и проверяются
+    регуляркой. Индекс обновляется в фоне раз в REFRESH_INTERVAL:
+    добавляются новые номера и удаляются пропавшие из пула.
+
+    Красота номера (score_msisdn) считается один раз при добавлении;
+    выдача отсортирована по ней, отсортированные списки по тирам
+    пересобираются только после изменения пула.
+    """
+
+    NGRAM = 3
+    REFRESH_INTERVAL = 60  # sec
+
+    executor = ThreadPoolExecutor(max_workers=1)
+
+    def __init__(self):
+        self._regions = {}
+        self._refreshing = set()
+        self._lock = threading.RLock()
+
+    def search(self, region, mask, tier=None, exclude=()):
+        u"""-> [(number, tier), ...], сначала красивые"""
+        region_index = self._get_region_index(region)
+        pattern = self._compile(mask)
+
+        with self._lock:
+            found = sorted((
+                number for number in self._candidates(region_index, mask)
+                if (
+                    number not in exclude and
+                    pattern.search(number) and
+                    (not tier or tier == '*' or region_index.numbers[number][1] == tier)
+                )
+            ), key=region_index.sort_key)
+            return [(number, region_index.numbers[number][1]) for number in found]
+
+    def listing(self, region, tier=None, offset=0, count=20, exclude=()):
+        u"""-> [(number, tier), ...] со смещением offset, сначала красивые"""
+        region_index = self._get_region_index(region)
+        with self._lock:
+            listing = region_index.get_listing(tier)
+            if exclude:
+                listing = (number for number in listing if number not in exclude)
+            return [
+                (number, region_index.numbers[number][1])
+                for number in islice(listing, offset, offset + count)
+            ]
+
+    def remove(self, number):
+        number = unicode(number)
+        with self._lock:
+            for region_index in self._regions.values():
+                self._remove(region_index, number)
+
+    def refresh(self, region):
+        numbers = dict(
+            (unicode(number), tier)
+            for tier, reg_dt_id, number in get_cached_numbers_info('*', region)
+        )
+        with self._lock:
+            region_index = self._regions.setdefault(region, _RegionIndex())
+            for number in set(region_index.numbers) - set(numbers):
+                self._remove(region_index, number)
+            for number, tier in numbers.items():
+                if number not in region_index.numbers:
+                    self._add(region_index, number, tier)
+                elif region_index.numbers[number][1] != tier:
+                    (seq, _, score) = region_index.numbers[number]
+                    region_index.numbers[number] = (seq, tier, score)
+                    region_index.listings = {}
+            region_index.updated = time.time()
+        return region_index
+
+    def _get_region_index(self, region):
+        region_index = self._regions.get(region)
+        if region_index is None:
+            return self.refresh(region)
+        if region_index.updated + self.REFRESH_INTERVAL < time.time():
+            self._refresh_async(region)
+        return region_index
+
+    def _refresh_async(self, region):
+        with self._lock:
+            if region in self._refreshing:
+                return
+            self._refreshing.add(region)
+
+        def refresh():
+            try:
+                self.refresh(region)
+            except Exception as err:
+                print('MsisdnPoolIndex.refresh({}): {}'.format(region, err))
+            finally:
+                with self._lock:
+                    self._refreshing.discard(region)
+
+        self.executor.submit(refresh)
+
+    def _ngrams(self, digits):
+        return set(
+            digits[i:i + self.NGRAM]
+            for i in xrange(len(digits) - self.NGRAM + 1)
+        )
+
+    def _add(self, region_index, number, tier):
+        region_index.seq += 1
+        region_index.numbers[number] = (region_index.seq, tier, score_msisdn(number))
+        region_index.listings = {}
+        for gram in self._ngrams(number):
+            region_index.grams.setdefault(gram, set()).add(number)
+
+    def _remove(self, region_index, number):
+        if region_index.numbers.pop(number, None) is None:
+            return
+        region_index.listings = {}
+        for gram in self._ngrams(number):
+            numbers = region_index.grams.get(gram)
+            if numbers is not None:
+                numbers.discard(number)
+                if not numbers:
+                    del region_index.grams[gram]
+
+    def _candidates(self, region_index, mask):
+        grams = set()
+        for fragment in re.split(r'[^0-9]+', mask or ''):
+            grams.update(self._ngrams(fragment))
+        if not grams:
+            return list(region_index.numbers)
+
+        candidates = None
+        for gram in sorted(grams, key=lambda g: len(region_index.grams.get(g, ()))):
+            numbers = region_index.grams.get(gram, set())
+            candidates = numbers.copy() if candidates is None else candidates & numbers
+            if not candidates:
+                break
+        return candidates
+
+    @staticmethod
+    def _compile(mask):
+        return re.compile(u''.join(
+            u'[0-9]*' if char == u'*' else
+            u'[0-9]' if char == u'?' else
+            re.escape(char)
+            for char in unicode(mask or u'')
+        ))
+
+
+msisdn_pool_index = MsisdnPoolIndex()
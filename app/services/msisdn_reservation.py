@@ -0,0 +1,158 @@
+# -*- encoding: utf-8 -*-
+
+import json
+import time
+import uuid
+
+import lazy_object_proxy
+
+from app.api.bercut_mvno_api import MVNOApi
+from app_utils.redis_utils import get_current_redis
+
+
+__all__ = ('MsisdnReservation', )
+
+
+class MsisdnReservation(object):
+    u"""
+    Короткая бронь номера на время смены номера:
+
+        reserve:msisdn:{msisdn}   -> "{client_id}:{token}", SET NX с TTL
+        reserve:msisdn:expires    -> hash {msisdn: {region, expires}}
+
+    Бронь ставится в Redis и в Bercut (MVNOApi.reserveMsisdn), поэтому
+    один номер не уходит двум абонентам, а забронированные номера не
+    показываются в списке. Брони, которые не завершили и не отпустили,
+    возвращает в Bercut sweep() (sweep_msisdn_reservations.py).
+
+    Отпускает бронь только запрос, который её поставил (token совпадает,
+    проверка и удаление - один Lua-скрипт). Повторный запрос того же
+    абонента продлевает чужую бронь, но release() для него ничего не делает.
+
+    Поля branch_id, region и log_* нужны MVNOApi как у заказа.
+    """
+
+    redis_session = lazy_object_proxy.Proxy(get_current_redis)
+
+    KEY_TEMPLATE = 'reserve:msisdn:{msisdn}'
+    EXPIRES_KEY = 'reserve:msisdn:expires'
+    TIMEOUT = 5 * 60  # sec
+
+    DELETE_OWNED_SCRIPT = (
+        "if redis.call('get', KEYS[1]) == ARGV[1] then "
+        "return redis.call('del', KEYS[1]) end return 0"
+    )
+
+    branch_id = None
+    completed = False
+
+    def __init__(self, msisdn, client_id, region, token=None):
+        self.msisdn = unicode(msisdn)[-10:]
+        self.client_id = client_id
+        self.region = region
+        self.token = token
+
+    @property
+    def owned(self):
+        return self.token is not None
+
+    @classmethod
+    def get_key(cls, msisdn):
+        return cls.KEY_TEMPLATE.format(msisdn=msisdn)
+
+    @classmethod
+    def acquire(cls, msisdn, client_id, region):
+        u"""
+        -> MsisdnReservation | None, если номер уже забронирован другим.
+        Ошибки Redis и Bercut пробрасываются, бронь в Redis при ошибке
+        Bercut снимается.
+        """
+        reservation = cls(msisdn, client_id, region)
+        key = cls.get_key(reservation.msisdn)
+        token = u'{}:{}'.format(client_id, uuid.uuid4().hex)
+        acquired = cls.redis_session.set(key, token, nx=True, ex=cls.TIMEOUT)
+        if acquired:
+            reservation.token = token
+        else:
+            # повторный запрос того же абонента продлевает его бронь
+            owner = cls.redis_session.get(key) or ''
+            if owner.split(':')[0] != unicode(client_id):
+                return None
+            cls.redis_session.expire(key, cls.TIMEOUT)
+
+        cls.redis_session.hset(cls.EXPIRES_KEY, reservation.msisdn, json.dumps({
+            'region': region,
+            'expires': time.time() + cls.TIMEOUT,
+        }))
+        if acquired:
+            try:
+                MVNOApi.reserveMsisdn(reservation)
+            except Exception:
+                reservation._forget()
+                raise
+        return reservation
+
+    def complete(self):
+        u"""
+        Номер ушёл абоненту, возвращать в Bercut не нужно; бронь снимается,
+        кто бы её ни поставил, чтобы её владелец уже не вернул номер
+        """
+        self.completed = True
+        self._forget()
+
+    def release(self):
+        u"""Номер не понадобился: снять свою бронь и вернуть номер в Bercut"""
+        if not self.owned:
+            return
+        try:
+            deleted = self.redis_session.eval(
+                self.DELETE_OWNED_SCRIPT, 1, self.get_key(self.msisdn), self.token,
+            )
+        except Exception as err:
+            print('MsisdnReservation.release({}): {}'.format(self.msisdn, err))
+            return
+        if deleted:
+            self._return()
+
+    def _return(self):
+        u"""
+        Вернуть номер в Bercut, ключ брони уже снят; если не вышло,
+        запись в EXPIRES_KEY остаётся, и sweep() повторит возврат
+        """
+        try:
+            MVNOApi.returnMsisdn(self)
+            self.redis_session.hdel(self.EXPIRES_KEY, self.msisdn)
+        except Exception as err:
+            print('MsisdnReservation.return({}): {}'.format(self.msisdn, err))
+
+    def _forget(self):
+        try:
+            pipe = self.redis_session.pipeline(transaction=False)
+            pipe.delete(self.get_key(self.msisdn))
+            pipe.hdel(self.EXPIRES_KEY, self.msisdn)
+            pipe.execute()
+        except Exception as err:
+            print('MsisdnReservation.forget({}): {}'.format(self.msisdn, err))
+
+    @classmethod
+    def get_reserved(cls):
+        u"""-> set номеров с бронью (в том числе ещё не возвращённой sweep)"""
+        try:
+            return set(cls.redis_session.hkeys(cls.EXPIRES_KEY))
+        except Exception as err:
+            print('MsisdnReservation.get_reserved: {}'.format(err))
+            return set()
+
+    @classmethod
+    def sweep(cls, utcnow=None):
+        u"""Вернуть в Bercut просроченные брони -> количество возвращённых"""
+        utcnow = utcnow or time.time()
+        returned = 0
+        for msisdn, data in cls.redis_session.hgetall(cls.EXPIRES_KEY).items():
+            data = json.loads(data)
+            if data['expires'] > utcnow or cls.redis_session.exists(cls.get_key(msisdn)):
+                continue
+            reservation = cls(msisdn, None, data['region'])
+            reservation._return()
+            returned += not cls.redis_session.hexists(cls.EXPIRES_KEY, msisdn)
+        return returned
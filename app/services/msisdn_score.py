@@ -0,0 +1,50 @@
+# -*- encoding: utf-8 -*-
+
+__all__ = ('score_msisdn', )
+
+
+def _longest_run(digits, step):
+    u"""Самая длинная цепочка, где каждая следующая цифра = предыдущая + step"""
+    longest = run = 1
+    for prev, cur in zip(digits, digits[1:]):
+        run = run + 1 if int(cur) - int(prev) == step else 1
+        longest = max(longest, run)
+    return longest
+
+
+def score_msisdn(number):
+    u"""
+    Красота номера (чем больше, тем красивее) по последним 7 цифрам:
+    повторы (777), последовательности (1234, 9876), зеркальные половины
+    (1221, 123321), повторы пар (1212) и круглые окончания (100, 000).
+    """
+    digits = unicode(number)[-7:]
+    if len(digits) < 4 or not digits.isdigit():
+        return 0
+
+    score = 0
+
+    repeat = _longest_run(digits, 0)
+    if repeat >= 3:
+        score += (10, 30, 60, 100, 150)[min(repeat, 7) - 3]
+
+    sequence = max(_longest_run(digits, 1), _longest_run(digits, -1))
+    if sequence >= 3:
+        score += (sequence - 2) * 15
+
+    for size, points in ((6, 40), (4, 20)):
+        tail = digits[-size:]
+        if len(set(tail)) > 1 and tail == tail[::-1]:
+            score += points
+            break
+
+    tail = digits[-4:]
+    if tail[:2] == tail[2:] and tail[0] != tail[1]:
+        score += 15
+
+    zeros = len(digits) - len(digits.rstrip('0'))
+    if zeros >= 2:
+        score += (10, 25, 45)[min(zeros, 4) - 2]
+
+    score += (7 - len(set(digits))) * 3
+    return score
@@ -0,0 +1,136 @@
+# -*- encoding: utf-8 -*-
+
+import bisect
+import threading
+import time
+
+from app.models import NumberingPlanRange
+from app_models import Port
+from app_utils.db_utils import create_dbsession
+from methods_simple import get_reg_op, normalize_number_to_number
+
+
+__all__ = (
+    'NumberingPlanIndex', 'numbering_plan_index',
+    'get_reg_op_many', 'get_reg_op_indexed',
+)
+
+
+class NumberingPlanIndex(object):
+    u"""
+    Отсортированные диапазоны NumberingPlanRange в памяти процесса:
+
+        index.lookup(9581234567) -> (region, operator) | None
+
+    Индекс загружается при старте процесса (start(), см. app.startup)
+    и перезагружается фоновым потоком раз в REFRESH_INTERVAL; новая версия
+    подменяет старую целиком. Пока индекс не загружен, номера определяются
+    через get_reg_op.
+    """
+
+    REFRESH_INTERVAL = 60 * 60  # sec
+
+    def __init__(self):
+        self._index = ((), ())
+        self._lock = threading.Lock()
+        self._refresh_thread = None
+
+    @property
+    def is_loaded(self):
+        return bool(self._index[0])
+
+    def lookup(self, number):
+        starts, ranges = self._index
+        pos = bisect.bisect_right(starts, number) - 1
+        if pos < 0:
+            return None
+        number_to, region, operator = ranges[pos]
+        if number > number_to:
+            return None
+        return region, operator
+
+    def load(self, db_session=None):
+        own_session = db_session is None
+        db_session = db_session or create_dbsession()
+        try:
+            rows = db_session.query(
+                NumberingPlanRange.number_from,
+                NumberingPlanRange.number_to,
+                NumberingPlanRange.region,
+                NumberingPlanRange.operator,
+            ).filter(
+                NumberingPlanRange.deleted == None,
+            ).order_by(NumberingPlanRange.number_from).all()
+        finally:
+            if own_session:
+                db_session.close()
+
+        self._index = (
+            tuple(row.number_from for row in rows),
+            tuple((row.number_to, row.region, row.operator) for row in rows),
+        )
+        return len(rows)
+
+    def start(self):
+        if self._refresh_thread is not None:
+            return
+        with self._lock:
+            if self._refresh_thread is not None:
+                return
+            try:
+                self.load()
+            except Exception as err:
+                print('NumberingPlanIndex.load: {}'.format(err))
+            self._refresh_thread = threading.Thread(
+                target=self._refresh_loop, name='numbering-plan-refresh',
+            )
+            self._refresh_thread.daemon = True
+            self._refresh_thread.start()
+
+    def _refresh_loop(self):
+        while True:
+            time.sleep(self.REFRESH_INTERVAL)
+            try:
+                self.load()
+            except Exception as err:
+                print('NumberingPlanIndex.load: {}'.format(err))
+
+
+numbering_plan_index = NumberingPlanIndex()
+
+
+def get_reg_op_many(numbers, db_session, index=numbering_plan_index):
+    u"""
+    get_reg_op для набора номеров -> {number: (region, operator)}
+
+    Номера ищутся в NumberingPlanIndex; через get_reg_op идут только
+    перенесённые (MNP) номера и те, которых нет в индексе.
+    """
+    client_ids = {}
+    for number in set(numbers):
+        client_id = number and normalize_number_to_number(unicode(number))
+        client_ids[number] = client_id if client_id and client_id.isdigit() else None
+
+    ported = set()
+    if index.is_loaded:
+        known = list(set(filter(None, client_ids.values())))
+        for i in xrange(0, len(known), NumberingPlanRange.IN_CHUNK_SIZE):
+            ported.update(number for (number, ) in db_session.query(
+                Port.number
+            ).filter(
+                Port.number.in_(known[i:i + NumberingPlanRange.IN_CHUNK_SIZE])
+            ).distinct())
+
+    reg_ops = {}
+    for number, client_id in client_ids.items():
+        reg_op = (
+            client_id and client_id not in ported and
+            index.lookup(int(client_id))
+        )
+        reg_ops[number] = reg_op or get_reg_op(number, db_session)
+    return reg_ops
+
+
+def get_reg_op_indexed(number, db_session, index=numbering_plan_index):
+    u"""get_reg_op одного номера через NumberingPlanIndex"""
+    return get_reg_op_many([number], db_session, index=index)[number]
@@ -0,0 +1,109 @@
+# -*- encoding: utf-8 -*-
+
+import datetime
+
+from app.models import PushPartition, PushSchedule
+from app.services.regions import get_region_timezone_by_dt_id
+from app_models import Client_lk
+
+
+__all__ = ('PushScheduler', )
+
+
+class PushScheduler(object):
+    u"""
+    Отправка рассылок по часовым поясам абонентов:
+
+        PushScheduler(db_session).handler()  # запускается периодически
+
+    Аудитория делится на части по смещению региона от UTC; часть
+    отправляется, только когда местное время попадает в
+    [AVAILABLE_DT_HOUR_START, AVAILABLE_DT_HOUR_END). У каждой части
+    свой курсор, так что запуски за день продолжают, а не повторяют.
+    Состав частей сохраняется в рассылке при первом запуске.
+    """
+
+    # для абонентов без региона
+    DEFAULT_TIMEZONE = 3  # hours, MSK
+    OTHER_PARTITION_KEY = 'other'
+
+    def __init__(self, db_session, dispatcher=None):
+        self.db_session = db_session
+        self.dispatcher = dispatcher
+
+    def handler(self, utcnow=None):
+        utcnow = utcnow or datetime.datetime.utcnow()
+        push_schedules = self.db_session.query(PushSchedule).filter(
+            PushSchedule.trigger <= utcnow,
+            PushSchedule.completed == None,
+            PushSchedule.deleted == None,
+        ).order_by(PushSchedule.trigger).all()
+
+        for push_schedule in push_schedules:
+            try:
+                self.send(push_schedule, utcnow)
+            except Exception as err:
+                print('PushScheduler.send({}): {}'.format(push_schedule.id, err))
+                self.db_session.rollback()
+
+    def send(self, push_schedule, utcnow=None):
+        utcnow = utcnow or datetime.datetime.utcnow()
+        if push_schedule.is_expired(utcnow):
+            return push_schedule.send(self.db_session)
+
+        partitions = push_schedule.get_partition_plan()
+        if not partitions:
+            partitions = self.get_partitions(push_schedule)
+            push_schedule.set_partition_plan(partitions)
+            push_schedule.save(self.db_session)
+
+        for partition in partitions:
+            if push_schedule.is_partition_done(partition):
+                continue
+            if not self.is_available(partition.timezone, utcnow):
+                continue
+            push_schedule.send(
+                self.db_session,
+                dispatcher=self.dispatcher or push_schedule.get_dispatcher(),
+                partition=partition,
+            )
+
+        if all(push_schedule.is_partition_done(p) for p in partitions):
+            push_schedule.completed = utcnow
+            push_schedule.save(self.db_session)
+
+    def get_partitions(self, push_schedule):
+        u"""-> [PushPartition, ...], восточные пояса раньше"""
+        regions = push_schedule.audience.get('regions') or [
+            region for (region, ) in self.db_session.query(
+                Client_lk.region
+            ).filter(
+                Client_lk.region != None,
+            ).distinct()
+        ]
+
+        timezone_regions = {}
+        for region in regions:
+            timezone_regions.setdefault(
+                get_region_timezone_by_dt_id(region), []
+            ).append(region)
+
+        partitions = [
+            PushPartition(timezone, regions=timezone_regions[timezone], timezone=timezone)
+            for timezone in sorted(timezone_regions, reverse=True)
+        ]
+        if not push_schedule.audience.get('regions'):
+            partitions.append(PushPartition(
+                self.OTHER_PARTITION_KEY,
+                exclude_regions=regions,
+                timezone=self.DEFAULT_TIMEZONE,
+            ))
+        return partitions
+
+    def is_available(self, timezone, utcnow):
+        local_hour = (utcnow + datetime.timedelta(hours=timezone)).hour
+        return (
+            PushSchedule.AVAILABLE_DT_HOUR_START <=
+            local_hour <
+            PushSchedule.AVAILABLE_DT_HOUR_END
+        )
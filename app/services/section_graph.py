@@ -0,0 +1,109 @@
+# -*- encoding: utf-8 -*-
+
+import time
+from collections import OrderedDict
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+
+__all__ = ('SectionGraph', )
+
+
+class SectionGraph(object):
+    u"""
+    Собирает ответ из независимых секций, выполняя их в пуле потоков:
+
+        graph = SectionGraph()
+        graph.add('tariff', build_tariff, timeout=10)
+        graph.add('banner', build_banner, depends=['tariff'])
+        results = graph.run()  # OrderedDict([('tariff', ...), ('banner', ...)])
+
+    start() запускает готовые секции и сразу возвращает управление, так что
+    вызывающий поток может делать свою работу, пока они выполняются;
+    run() дожидается остальных.
+
+    Секция стартует, когда завершились все её зависимости (успешно или нет).
+    Если секция упала или не уложилась в timeout, её результатом
+    становится default, так что run() всегда возвращает все секции.
+    """
+
+    MAX_WORKERS = 32
+    DEFAULT_TIMEOUT = 5  # sec
+
+    executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+
+    def __init__(self, executor=None, on_error=None):
+        self.executor = executor or self.executor
+        self.on_error = on_error
+        self.sections = OrderedDict()
+        self._results = None
+        self._running = None
+        self._waiting = None
+
+    def add(self, name, func, depends=(), timeout=None, default=None):
+        for depend in depends:
+            if depend not in self.sections:
+                raise ValueError(u'section "{}" depends on unknown "{}"'.format(
+                    name, depend
+                ))
+        self.sections[name] = (
+            func, tuple(depends), timeout or self.DEFAULT_TIMEOUT, default
+        )
+        return self
+
+    def start(self):
+        if self._waiting is None:
+            self._results = {}
+            self._running = {}
+            self._waiting = list(self.sections)
+            self._submit_ready()
+        return self
+
+    def _submit_ready(self):
+        for name in list(self._waiting):
+            func, depends, timeout, _ = self.sections[name]
+            if all(depend in self._results for depend in depends):
+                self._waiting.remove(name)
+                self._running[self.executor.submit(func)] = (
+                    name, time.time() + timeout
+                )
+
+    def run(self):
+        self.start()
+        results = self._results
+        running = self._running
+        waiting = self._waiting
+
+        while waiting or running:
+            self._submit_ready()
+
+            next_deadline = min(deadline for _, deadline in running.values())
+            done, _ = wait(
+                list(running),
+                timeout=max(next_deadline - time.time(), 0),
+                return_when=FIRST_COMPLETED,
+            )
+
+            for future in done:
+                name, _ = running.pop(future)
+                try:
+                    results[name] = future.result()
+                except Exception as err:
+                    results[name] = self._degrade(name, err)
+
+            utcnow = time.time()
+            for future, (name, deadline) in list(running.items()):
+                if deadline <= utcnow:
+                    running.pop(future)
+                    future.cancel()
+                    results[name] = self._degrade(name, 'timeout')
+
+        return OrderedDict((name, results[name]) for name in self.sections)
+
+    def _degrade(self, name, error):
+        if self.on_error is not None:
+            try:
+                self.on_error(name, error)
+            except Exception:
+                pass
+        return self.sections[name][3]
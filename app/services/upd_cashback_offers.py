@@ -1,14 +1,90 @@
 # -*- encoding: utf-8 -*-
 
+import datetime
+
+from sqlalchemy import and_, case, func
+
 from app.api import SbtCashbackApi
-from app.models import Cashback
+from app.models import Cashback, CashbackWatermark
 from app_models import DeviceData
 
 
-__all__ = ('upd_cashback_offers', )
+__all__ = (
+    'upd_cashback_offers',
+    'get_cashback_watermark',
+    'store_cashback_watermark',
+)
+
+
+# запас на записи, которые партнёр досылает с опозданием
+WATERMARK_OVERLAP = datetime.timedelta(days=1)
+# открытые кешбэки старше этого уже не держат watermark
+OPEN_CASHBACK_MAX_AGE = datetime.timedelta(days=90)
+
+
+def _get_watermark_click(db_session, number, utcnow=None):
+    u"""
+    Открытые кешбэки ещё могут поменять статус, поэтому пока они есть,
+    берём самый ранний из них (не старше OPEN_CASHBACK_MAX_AGE),
+    иначе - последний известный клик.
+    """
+    utcnow = utcnow or datetime.datetime.utcnow()
+    open_since = Cashback.utc_datetime_to_timestamp(utcnow - OPEN_CASHBACK_MAX_AGE)
+    (min_open_click, max_click) = db_session.query(
+        func.min(case([(
+            and_(
+                Cashback.status_id == Cashback.STATUS_OPEN,
+                Cashback.click_tm >= open_since,
+            ),
+            Cashback.click_tm,
+        )])),
+        func.max(Cashback.click_tm),
+    ).filter(
+        Cashback.client_id == number,
+        Cashback.deleted == None,
+    ).one()
+    return min_open_click or max_click
+
+
+def get_cashback_watermark(db_session, number):
+    u"""
+    -> datetime, с которого запрашивать success_user_offers, или None
+
+    Берётся из CashbackWatermark абонента, до первой сверки - по его кешбэкам.
+    """
+    click_tm = db_session.query(CashbackWatermark.click_tm).filter(
+        CashbackWatermark.client_id == number,
+    ).scalar() or _get_watermark_click(db_session, number)
+    if not click_tm:
+        return None
+    return datetime.datetime.utcfromtimestamp(click_tm) - WATERMARK_OVERLAP
+
+
+def store_cashback_watermark(db_session, number, utcnow=None):
+    u"""После удачной сверки сдвигает CashbackWatermark абонента вперёд, без commit"""
+    utcnow = utcnow or datetime.datetime.utcnow()
+    click_tm = _get_watermark_click(db_session, number, utcnow)
+    if not click_tm:
+        return
+    watermark = db_session.query(CashbackWatermark).filter(
+        CashbackWatermark.client_id == number,
+    ).first() or CashbackWatermark(client_id=number)
+    if watermark.click_tm is None or watermark.click_tm < click_tm:
+        watermark.click_tm = click_tm
+        watermark.updated = utcnow
+        watermark.save(db_session, commit=False)
 
 
 def upd_cashback_offers(db_session, number, start_dt=None, end_dt=None):
+    u"""
+    Синхронизация кешбэков абонента с партнёром.
+    Без start_dt запрашиваются только записи после get_cashback_watermark,
+    а после сверки watermark абонента сдвигается вперёд.
+    Каталог офферов берётся через CashbackApi.catalog_cache; ошибки
+    запроса кешбэков и каталога не глушатся, вызывающий видит, что сверка
+    не удалась. Ошибка деталей одного оффера пропускает только этот оффер
+    и оставляет watermark на месте, следующая сверка его повторит.
+    """
     (device_id, device_uid) = db_session.query(
         DeviceData.id, DeviceData.device_id
     ).distinct(
@@ -24,60 +100,62 @@ def upd_cashback_offers(db_session, number, start_dt=None, end_dt=None):
     if not device_uid:
         return
 
-    try:
-        api = SbtCashbackApi(device_uid, number)
-        success_offers = api.api.success_user_offers(
-            start_dt=start_dt, end_dt=end_dt
-        )
+    incremental = start_dt is None and end_dt is None
+    if start_dt is None:
+        start_dt = get_cashback_watermark(db_session, number)
 
-        if not success_offers:
-            return
+    api = SbtCashbackApi(device_uid, number)
+    success_offers = api.api.success_user_offers(
+        start_dt=start_dt, end_dt=end_dt
+    )
 
-        available_offers = dict(
-            (of["name"], of)
-            for of in api.available_offers()
-        )
-    except:
+    if not success_offers:
+        if incremental:
+            store_cashback_watermark(db_session, number)
+            db_session.commit()
         return
 
-    closed_cashbacks_items_data = [
-        item.data for item in db_session.query(
-            Cashback.data,
+    offer_clicks = set(
+        Cashback.to_click_tm(offer['click_tm']) for offer in success_offers
+    ) - set([None]) or set([0])
+    known_cashbacks = dict(
+        ((offer_name, click_tm), (cashback_id, status_id))
+        for (cashback_id, offer_name, click_tm, status_id) in db_session.query(
+            Cashback.id, Cashback.offer_name, Cashback.click_tm, Cashback.status_id,
         ).filter(
-            Cashback.status != Cashback.STATUS_OPEN,
             Cashback.client_id == number,
+            Cashback.click_tm >= min(offer_clicks),
+            Cashback.click_tm <= max(offer_clicks),
             Cashback.deleted == None,
-        ).all()
-    ]
-
-    closed_cashbacks = set((
-        (cacheback_data or {}).get('offer_name'),
-        (cacheback_data or {}).get('click_tm'),
-    ) for cacheback_data in closed_cashbacks_items_data)
-
-    opened_cashbacks = dict(
-        ((c.name, c.clicked), c)
-        for c in db_session.query(Cashback).filter(
-            Cashback.status == Cashback.STATUS_OPEN,
-            Cashback.client_id == number,
-            Cashback.deleted == None,
-        ).all()
+        )
     )
 
+    new_offers = [
+        offer for offer in success_offers
+        if (offer['offer_name'], Cashback.to_click_tm(offer['click_tm'])) not in known_cashbacks
+    ]
+    available_offers = {}
+    if new_offers:
+        available_offers = dict(
+            (of["name"], of)
+            for of in api.available_offers()
+        )
+
+    skipped = 0
     for offer in success_offers:
-        offer_key = (offer['offer_name'], offer['click_tm'])
-        if offer_key in opened_cashbacks:
-            if offer['status'] == 'open':
+        offer_key = (offer['offer_name'], Cashback.to_click_tm(offer['click_tm']))
+        if offer_key in known_cashbacks:
+            (cashback_id, status_id) = known_cashbacks[offer_key]
+            if status_id != Cashback.STATUS_OPEN or offer['status'] == 'open':
                 continue
 
-            cashback = opened_cashbacks.get(offer_key)
+            cashback = db_session.query(Cashback).filter(
+                Cashback.id == cashback_id,
+            ).one()
             cashback.amount = offer['amount']
             cashback.status = offer['status']
             cashback.save(db_session, commit=False)
 
-        elif offer_key in closed_cashbacks:
-            continue
-
         else:
             cashback = Cashback(
                 client_id=number,
@@ -87,7 +165,14 @@ def upd_cashback_offers(db_session, number, start_dt=None, end_dt=None):
                 offer.update(available_offers[offer["offer_name"]])
 
             if offer.get("id"):
-                offer_details = api.offer_details(offer['id'])
+                try:
+                    offer_details = api.offer_details(offer['id'])
+                except Exception as err:
+                    print('upd_cashback_offers({}): offer {}: {}'.format(
+                        number, offer['id'], err
+                    ))
+                    skipped += 1
+                    continue
                 if offer_details:
                     offer['reward_delay'] = offer_details['reward_delay']
 
@@ -95,4 +180,7 @@ def upd_cashback_offers(db_session, number, start_dt=None, end_dt=None):
             cashback.device_id = device_id
             cashback.save(db_session, commit=False)
 
+    if incremental and not skipped:
+        db_session.flush()
+        store_cashback_watermark(db_session, number)
     db_session.commit()
@@ -0,0 +1,118 @@
+# -*- encoding: utf-8 -*-
+
+import json
+
+import lazy_object_proxy
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
+
+from app.models import ActiveDeviceWiFi, BillingEvent, ClientFavourite
+from app_models import UserInfo
+from app_utils.redis_utils import get_current_redis
+
+
+__all__ = ('UserInfoCache', )
+
+
+class UserInfoCache(object):
+    u"""
+    Кэш собранных секций ответа userinfo (sbt_data, appConfig):
+
+        cache:userinfo:version:{client_id}              -> версия
+        cache:userinfo:{client_id}:{version}:{variant}  -> секции
+
+    Версия увеличивается после коммита изменений, влияющих на ответ
+    (тариф, избранные номера, WiFi Звонки, события биллинга), и старые
+    ключи просто перестают читаться.
+    """
+
+    redis_session = lazy_object_proxy.Proxy(get_current_redis)
+
+    CACHE_VERSION_KEY_TEMPLATE = 'cache:userinfo:version:{client_id}'
+    CACHE_SECTIONS_KEY_TEMPLATE = 'cache:userinfo:{client_id}:{version}:{variant}'
+    CACHE_TIMEOUT = 5 * 60  # sec
+    CACHE_VERSION_TIMEOUT = 24 * 60 * 60  # sec
+
+    SESSION_INFO_KEY = 'userinfo_cache_bump'
+
+    @classmethod
+    def get_version_key(cls, client_id):
+        return cls.CACHE_VERSION_KEY_TEMPLATE.format(client_id=client_id)
+
+    @classmethod
+    def get_sections_key(cls, client_id, version, variant):
+        return cls.CACHE_SECTIONS_KEY_TEMPLATE.format(
+            client_id=client_id, version=version, variant=variant,
+        )
+
+    @classmethod
+    def get_sections(cls, client_id, variant):
+        u"""-> (version, {section: data} | None)"""
+        try:
+            version = int(cls.redis_session.get(cls.get_version_key(client_id)) or 0)
+            sections = cls.redis_session.get(
+                cls.get_sections_key(client_id, version, variant)
+            )
+        except Exception as err:
+            print('UserInfoCache.get_sections: {}'.format(err))
+            return None, None
+        return version, sections and json.loads(sections) or None
+
+    @classmethod
+    def set_sections(cls, client_id, variant, version, sections):
+        if version is None:
+            return
+        try:
+            cls.redis_session.setex(
+                cls.get_sections_key(client_id, version, variant),
+                cls.CACHE_TIMEOUT, json.dumps(sections),
+            )
+        except Exception as err:
+            print('UserInfoCache.set_sections: {}'.format(err))
+
+    @classmethod
+    def bump(cls, *client_ids):
+        client_ids = set(filter(None, client_ids))
+        if not client_ids:
+            return
+        try:
+            pipe = cls.redis_session.pipeline(transaction=False)
+            for client_id in client_ids:
+                pipe.incr(cls.get_version_key(client_id))
+                pipe.expire(cls.get_version_key(client_id), cls.CACHE_VERSION_TIMEOUT)
+            pipe.execute()
+        except Exception as err:
+            print('UserInfoCache.bump({}): {}'.format(client_ids, err))
+
+    @classmethod
+    def bump_on_commit(cls, db_session, client_id):
+        if db_session is None:
+            cls.bump(client_id)
+        else:
+            db_session.info.setdefault(cls.SESSION_INFO_KEY, set()).add(client_id)
+
+
+@event.listens_for(ClientFavourite, 'after_insert', propagate=True)
+@event.listens_for(ClientFavourite, 'after_update', propagate=True)
+@event.listens_for(ActiveDeviceWiFi, 'after_insert', propagate=True)
+@event.listens_for(ActiveDeviceWiFi, 'after_update', propagate=True)
+@event.listens_for(UserInfo, 'after_insert', propagate=True)
+@event.listens_for(UserInfo, 'after_update', propagate=True)
+def _bump_client(mapper, connection, target):
+    UserInfoCache.bump_on_commit(object_session(target), target.client_id)
+
+
+@event.listens_for(BillingEvent, 'after_insert', propagate=True)
+def _bump_billing_event(mapper, connection, target):
+    if target.msisdn:
+        UserInfoCache.bump_on_commit(object_session(target), target.msisdn[-10:])
+
+
+@event.listens_for(Session, 'after_commit')
+def _bump_committed(db_session):
+    UserInfoCache.bump(*db_session.info.pop(UserInfoCache.SESSION_INFO_KEY, ()))
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_rolled_back(db_session):
+    db_session.info.pop(UserInfoCache.SESSION_INFO_KEY, None)
@@ -0,0 +1,41 @@
+# -*- encoding: utf-8 -*-
+
+from app.api.bercut_mvno_api import MVNOApi
+from app.services import numbering_plan_index
+from app_models import Client_lk
+from app_utils.db_utils import create_dbsession
+
+
+__all__ = ('on_app_start', )
+
+
+def on_app_start():
+    u"""
+    Подготовка процесса веб-приложения: вызывается там, где собирается
+    tornado.web.Application, до запуска IOLoop. Импорт app.* побочных
+    эффектов не имеет, поэтому скрипты и утилиты сюда не попадают.
+    """
+    # план нумерации нужен хендлерам (BaseHandler.region) с первого запроса
+    numbering_plan_index.start()
+    warmup_mvno_api()
+
+
+def warmup_mvno_api():
+    u"""
+    Справочники MVNOApi (branch_id регионов абонентов, msisdnTypeId);
+    если не вышло, они заполнятся при первых запросах
+    """
+    db_session = create_dbsession()
+    try:
+        regions = [
+            region for (region, ) in db_session.query(
+                Client_lk.region
+            ).filter(
+                Client_lk.region != None,
+            ).distinct()
+        ]
+        MVNOApi.warmup(regions)
+    except Exception as err:
+        print('MVNOApi.warmup: {}'.format(err))
+    finally:
+        db_session.close()
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+
+import __import_utils__
+with __import_utils__.up_import(1):
+    import app.services
+    from app.services import MsisdnReservation
+
+
+class SweepMsisdnReservations(object):
+    u"""
+    Возврат в Bercut номеров, бронь которых истекла, а смена номера
+    так и не завершилась. Запускается по крону раз в минуту:
+
+        python sweep_msisdn_reservations.py
+    """
+
+    def handler(self):
+        returned = MsisdnReservation.sweep()
+        if returned:
+            print('sweep msisdn reservations: returned {}'.format(returned))
+
+
+if __name__ == '__main__':
+    SweepMsisdnReservations().handler()
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+
+import json
+import sys
+import time
+import traceback
+from collections import deque
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from sqlalchemy import func
+
+import __import_utils__
+with __import_utils__.up_import(1):
+    from app_utils.db_utils import create_dbsession
+    from app_utils.redis_utils import get_current_redis
+    from app.api import CashbackApi
+    from app.services import upd_cashback_offers
+    from app_models import DeviceData
+
+
+class SyncCashbackOffers(object):
+    u"""
+    Ночная сверка кешбэков всех абонентов с устройствами.
+
+    Абоненты читаются потоком от недавно активных (max DeviceData.id)
+    к давно не заходившим и обрабатываются в пуле из workers потоков,
+    у каждого своя сессия БД; HTTP-соединения общие - CashbackApi.session,
+    каталог офферов - CashbackApi.catalog_cache.
+
+    Позиция сохраняется в Redis вместе со временем начала запуска:
+    перезапуск в пределах CHECKPOINT_TIMEOUT от начала продолжает с неё,
+    а следующий ночной запуск начинает заново, с самых активных.
+    Законченный запуск позицию удаляет.
+
+        python sync_cashback_offers.py [workers]
+    """
+
+    WORKERS = 8
+    STREAM_YIELD_PER = 1000
+    LOG_EVERY = 1000
+
+    CHECKPOINT_KEY = 'cashback:sync:checkpoint'
+    CHECKPOINT_TIMEOUT = 12 * 60 * 60  # sec, от начала запуска
+
+    def __init__(self, db_session=None, workers=None):
+        self.db_session = db_session or create_dbsession()
+        self.workers = min(workers or self.WORKERS, CashbackApi.POOL_MAXSIZE)
+        self.redis_session = get_current_redis()
+        self.started = time.time()
+
+    def handler(self):
+        checkpoint = self.get_checkpoint()
+        executor = ThreadPoolExecutor(max_workers=self.workers)
+        in_flight = {}
+        done_positions = set()
+        submitted = deque()
+        processed = failed = 0
+        started = time.time()
+        completed = False
+
+        try:
+            for (number, last_device_id) in self.iter_clients(checkpoint):
+                if len(in_flight) >= self.workers * 2:
+                    done, _ = wait(list(in_flight), return_when=FIRST_COMPLETED)
+                    for future in done:
+                        done_positions.add(in_flight.pop(future))
+                        failed += not future.result()
+                        processed += 1
+                        if processed % self.LOG_EVERY == 0:
+                            self.log_progress(processed, failed, started)
+                    checkpoint = self.advance_checkpoint(
+                        submitted, done_positions, checkpoint
+                    )
+
+                submitted.append(last_device_id)
+                in_flight[executor.submit(self.sync_client, number)] = last_device_id
+
+            for future in in_flight:
+                failed += not future.result()
+                processed += 1
+            completed = True
+        finally:
+            executor.shutdown(wait=True)
+            self.db_session.close()
+            if completed:
+                self.redis_session.delete(self.CHECKPOINT_KEY)
+
+        self.log_progress(processed, failed, started)
+
+    def iter_clients(self, checkpoint=None):
+        u"""-> (client_id, max DeviceData.id) от последних активных"""
+        last_device_id = func.max(DeviceData.id)
+        query = self.db_session.query(
+            DeviceData.client_id, last_device_id,
+        ).filter(
+            DeviceData.client_id != None,
+            DeviceData.device_id != None,
+        ).group_by(
+            DeviceData.client_id
+        )
+        if checkpoint:
+            query = query.having(last_device_id < checkpoint)
+        return query.order_by(last_device_id.desc()).execution_options(
+            stream_results=True
+        ).yield_per(self.STREAM_YIELD_PER)
+
+    def sync_client(self, number):
+        db_session = create_dbsession()
+        try:
+            upd_cashback_offers(db_session, number)
+            return True
+        except Exception:
+            traceback.print_exc()
+            db_session.rollback()
+            return False
+        finally:
+            db_session.close()
+
+    def get_checkpoint(self):
+        u"""-> позиция прерванного запуска, начатого меньше CHECKPOINT_TIMEOUT назад"""
+        checkpoint = self.redis_session.get(self.CHECKPOINT_KEY)
+        try:
+            checkpoint = json.loads(checkpoint)
+            (started, position) = (checkpoint['started'], int(checkpoint['position']))
+        except Exception:
+            return None
+        if started + self.CHECKPOINT_TIMEOUT <= time.time():
+            return None
+        self.started = started
+        return position
+
+    def advance_checkpoint(self, submitted, done_positions, checkpoint):
+        u"""Сохраняет позицию последнего абонента, до которого всё обработано"""
+        while submitted and submitted[0] in done_positions:
+            checkpoint = submitted.popleft()
+            done_positions.discard(checkpoint)
+        timeout = int(self.started + self.CHECKPOINT_TIMEOUT - time.time())
+        if checkpoint and timeout > 0:
+            self.redis_session.setex(
+                self.CHECKPOINT_KEY, timeout,
+                json.dumps({'started': self.started, 'position': checkpoint}),
+            )
+        return checkpoint
+
+    def log_progress(self, processed, failed, started):
+        elapsed = max(time.time() - started, 1)
+        print('sync cashback offers: {} clients, {} failed, {:.1f} clients/sec'.format(
+            processed, failed, processed / elapsed
+        ))
+
+
+if __name__ == '__main__':
+    SyncCashbackOffers(
+        workers=int(sys.argv[1]) if len(sys.argv) > 1 else None
+    ).handler()
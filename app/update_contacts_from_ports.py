@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+import csv
+import sys
+
+import __import_utils__
+with __import_utils__.up_import(1):
+    from app_utils.db_utils import create_dbsession
+    import app.services
+    from app.models import Contact
+    from app_models import Client_lk
+    from methods_simple import get_reg_op, normalize_number_to_number
+
+
+class UpdateContactsFromPorts(object):
+    u"""
+    Пересчёт operator/region/calls_available контактов по файлам
+    перенесённых номеров (csv Port_All_Full: Number,OwnerId,Mnc,Route,
+    RegionCode,...). Файлы читаются потоково, изменения применяются
+    через Contact.update_many пачками.
+
+    Все номера в файле перенесены, поэтому индекс плана нумерации им
+    не подходит. region/operator берутся по колонкам самого файла:
+    каждая пара (OwnerId, RegionCode) переводится в термины get_reg_op
+    один раз, по первому её номеру.
+
+        python update_contacts_from_ports.py Port_All_Full.csv [...]
+    """
+
+    BATCH_SIZE = Contact.IN_CHUNK_SIZE
+
+    OWNER_ID_COLUMN = 1
+    REGION_CODE_COLUMN = 4
+
+    def __init__(self, db_session=None, batch_size=None):
+        self.db_session = db_session or create_dbsession()
+        self.batch_size = batch_size or self.BATCH_SIZE
+        self.owner_reg_ops = {}  # (OwnerId, RegionCode) -> (region, operator)
+
+    def handler(self, *paths):
+        updated = 0
+        for path in paths:
+            batch = []
+            for number, owner in self.read_ports(path):
+                batch.append((number, owner))
+                if len(batch) >= self.batch_size:
+                    updated += self.update_batch(batch)
+                    batch = []
+            if batch:
+                updated += self.update_batch(batch)
+            print('{}: updated {} contacts'.format(path, updated))
+
+    def get_reg_op(self, number, owner):
+        reg_op = self.owner_reg_ops.get(owner)
+        if reg_op is None:
+            reg_op = self.owner_reg_ops[owner] = get_reg_op(number, self.db_session)
+        return reg_op
+
+    def update_batch(self, ports):
+        reg_ops = dict(
+            (number, self.get_reg_op(number, owner)) for number, owner in ports
+        )
+        calls_available = Contact.calls_available_for_clients(
+            self.db_session, [
+                number for number, (_, operator) in reg_ops.items()
+                if operator in Client_lk.sbTELECOM_OPERATORS
+            ]
+        )
+        return Contact.update_many(self.db_session, [
+            (number, {
+                'region': region,
+                'operator': operator,
+                'calls_available': number in calls_available,
+            }) for number, (region, operator) in reg_ops.items()
+        ])
+
+    @classmethod
+    def read_ports(cls, path):
+        u"""-> (number, (OwnerId, RegionCode)), строки без номера пропускаются"""
+        owner_columns = max(cls.OWNER_ID_COLUMN, cls.REGION_CODE_COLUMN)
+        with open(path, 'rb') as f:
+            for row in csv.reader(f, delimiter=','):
+                if len(row) <= owner_columns:
+                    continue
+                number = normalize_number_to_number(row[0].strip())
+                if number and number.isdigit():
+                    yield number, (
+                        row[cls.OWNER_ID_COLUMN].strip(),
+                        row[cls.REGION_CODE_COLUMN].strip(),
+                    )
+
+
+if __name__ == '__main__':
+    UpdateContactsFromPorts().handler(*sys.argv[1:])